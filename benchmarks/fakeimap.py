@@ -0,0 +1,431 @@
+"""An in-process IMAP4 server on localhost, serving a fixed list of messages, for benchmarks and manual testing.
+
+It implements just enough of RFC 3501 for pynemail: LOGIN, SELECT, SEARCH and SORT (with a few search keys, and
+ESEARCH/ESORT results if those capabilities are advertised), FETCH (FLAGS, UID, INTERNALDATE, RFC822.SIZE,
+BODYSTRUCTURE and BODY sections, whole or partial), STORE, EXPUNGE, NOOP and IDLE, all optionally prefixed by UID. If
+CONDSTORE is advertised, every message has a MODSEQ and FETCH takes a CHANGEDSINCE modifier, and if QRESYNC is, ENABLE
+QRESYNC turns EXPUNGE responses into VANISHED ones (RFC 7162). Every command can be delayed to simulate the round trip
+to a remote server.
+
+>>> import imaplib
+>>> server = FakeImapServer([(b'Subject: Hi\\r\\n\\r\\nHello\\r\\n', [])]).start()
+>>> client = imaplib.IMAP4(*server.address)
+>>> _ = client.login('user', 'password'), client.select()
+>>> client.search(None, 'ALL')
+('OK', [b'1'])
+>>> server.stop()
+"""
+import email
+import imaplib
+import pathlib
+import re
+import socketserver
+import threading
+import time
+
+from datetime import datetime, timezone
+from email.message import Message
+from email.policy import compat32
+from email.utils import parsedate_to_datetime
+from typing import List, Optional, Sequence, Set, Tuple
+
+
+_ITEM = re.compile(r'BODY(?:\.PEEK)?\[([^\]]*)\](?:<(\d+)\.(\d+)>)?|RFC822\.HEADER|RFC822\.SIZE|RFC822|FLAGS|UID|'
+                   r'BODYSTRUCTURE|MODSEQ|INTERNALDATE', re.IGNORECASE)
+_TOKEN = re.compile(r'"(?:[^"\\]|\\.)*"|\(|\)|[^\s()]+')
+_CHANGEDSINCE = re.compile(r'\s*\(CHANGEDSINCE (\d+)( VANISHED)?\)\s*$', re.IGNORECASE)
+
+
+class FakeMessage:
+
+    __slots__ = ('uid', 'data', 'flags', 'modseq', '_parsed')
+
+    def __init__(self, uid: int, data: bytes, flags: Set[str], modseq: int = 1) -> None:
+        self.uid = uid
+        self.data = data
+        self.flags = flags
+        self.modseq = modseq
+        self._parsed = None  # type: Optional[Message]
+
+    def parsed(self) -> Message:
+        if self._parsed is None:
+            self._parsed = email.message_from_bytes(self.data, policy=compat32)
+        return self._parsed
+
+    def header(self) -> bytes:
+        end = self.data.find(b'\r\n\r\n')
+        return self.data if end < 0 else self.data[:end + 4]
+
+    def text(self) -> bytes:
+        end = self.data.find(b'\r\n\r\n')
+        return b'' if end < 0 else self.data[end + 4:]
+
+    def internaldate(self) -> str:
+        # The arrival time, which for the generated messages may as well be the Date header.
+        try:
+            date = parsedate_to_datetime(self.parsed()['Date'])
+        except (TypeError, ValueError):
+            date = datetime.fromtimestamp(0, timezone.utc)
+        return imaplib.Time2Internaldate(date)
+
+
+def _quote(value: Optional[str]) -> str:
+    if value is None:
+        return 'NIL'
+    return '"{}"'.format(value.replace('\\', '\\\\').replace('"', '\\"'))
+
+
+def _params(params: Sequence[Tuple[str, str]]) -> str:
+    if not params:
+        return 'NIL'
+    return '({})'.format(' '.join('{} {}'.format(_quote(k), _quote(v)) for k, v in params))
+
+
+def _payload(part: Message) -> bytes:
+    payload = part.get_payload()
+    return payload.encode('ascii', 'surrogateescape') if isinstance(payload, str) else b''
+
+
+def body_structure(part: Message) -> str:
+    """Describe a message part as a BODYSTRUCTURE, without the optional extension data of message/rfc822 parts."""
+    if part.is_multipart():
+        children = ''.join(body_structure(child) for child in part.get_payload())
+        return '({} {} {} NIL NIL NIL)'.format(children, _quote(part.get_content_subtype()),
+                                               _params([('boundary', part.get_boundary())]))
+    params = [(k, v) for k, v in part.get_params(header='content-type', failobj=[])[1:]]
+    payload = _payload(part)
+    fields = [_quote(part.get_content_maintype()), _quote(part.get_content_subtype()), _params(params),
+              _quote(part.get('content-id')), _quote(part.get('content-description')),
+              _quote(part.get('content-transfer-encoding', '7bit')), str(len(payload))]
+    if part.get_content_maintype() == 'text':
+        fields.append(str(payload.count(b'\n')))
+    disposition = part.get_content_disposition()
+    if disposition is None:
+        fields.append('NIL NIL')
+    else:
+        dparams = part.get_params(header='content-disposition', failobj=[])[1:]
+        fields.append('NIL ({} {})'.format(_quote(disposition), _params(dparams)))
+    fields.append('NIL NIL')
+    return '({})'.format(' '.join(fields))
+
+
+def body_section(message: FakeMessage, section: str) -> bytes:
+    """Return the contents of a BODY[section], e.g. '', 'HEADER', 'TEXT', '1.2' or 'HEADER.FIELDS (FROM TO)'."""
+    section = section.upper()
+    if section == '':
+        return message.data
+    if section == 'HEADER':
+        return message.header()
+    if section == 'TEXT':
+        return message.text()
+    if section.startswith('HEADER.FIELDS'):
+        wanted = section[section.index('(') + 1:section.rindex(')')].split()
+        lines = re.split(rb'\r\n(?![ \t])', message.header().rstrip(b'\r\n'))
+        return b''.join(line + b'\r\n' for line in lines
+                        if line.split(b':')[0].decode('ascii', 'replace').upper() in wanted) + b'\r\n'
+    part = message.parsed()
+    for index in section.split('.'):
+        if part.is_multipart():
+            part = part.get_payload()[int(index) - 1]
+        elif index != '1':
+            return b''
+    return _payload(part)
+
+
+def sequence_set(spec: str, largest: int) -> List[int]:
+    nums = []  # type: List[int]
+    for item in spec.split(','):
+        first, _, last = item.partition(':')
+        start = largest if first == '*' else int(first)
+        stop = start if not last else (largest if last == '*' else int(last))
+        nums.extend(range(min(start, stop), max(start, stop) + 1))
+    return nums
+
+
+class FakeImapHandler(socketserver.StreamRequestHandler):
+
+    # Responses are written a line at a time, which Nagle's algorithm would hold back for the client's delayed ACK.
+    disable_nagle_algorithm = True
+
+    def send(self, data) -> None:
+        self.wfile.write(data.encode() if isinstance(data, str) else data)
+
+    def handle(self) -> None:
+        self.qresync = False
+        self.exists = 0
+        self.send('* OK fake IMAP4rev1 server ready\r\n')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            time.sleep(self.server.latency)
+            tag, _, rest = line.decode('utf-8', 'replace').strip().partition(' ')
+            command, _, args = rest.partition(' ')
+            command = command.upper()
+            uid = command == 'UID'
+            if uid:
+                command, _, args = args.partition(' ')
+                command = command.upper()
+            with self.server.lock:
+                if command == 'LOGOUT':
+                    self.send('* BYE\r\n{} OK LOGOUT completed\r\n'.format(tag))
+                    return
+                result = getattr(self, 'do_' + command, None)
+                if result is None:
+                    self.send('{} BAD unknown command\r\n'.format(tag))
+                    continue
+                result(tag, args, uid)
+            self.send('{} OK {} completed\r\n'.format(tag, command))
+
+    def do_CAPABILITY(self, tag, args, uid):
+        self.send('* CAPABILITY IMAP4rev1 {}\r\n'.format(' '.join(self.server.capabilities)))
+
+    def do_LOGIN(self, tag, args, uid):
+        pass
+
+    def do_ENABLE(self, tag, args, uid):
+        enabled = [name for name in args.upper().split() if name in self.server.capabilities]
+        self.qresync = self.qresync or 'QRESYNC' in enabled
+        self.send('* ENABLED {}\r\n'.format(' '.join(enabled)).replace(' \r\n', '\r\n'))
+
+    def do_SELECT(self, tag, args, uid):
+        server = self.server
+        self.exists = len(server.messages)
+        self.send('* {} EXISTS\r\n* 0 RECENT\r\n* FLAGS (\\Answered \\Flagged \\Deleted \\Seen \\Draft)\r\n'
+                  .format(len(server.messages)))
+        self.send('* OK [UIDVALIDITY {}]\r\n* OK [UIDNEXT {}]\r\n'.format(server.uidvalidity, server.uidnext))
+        if 'CONDSTORE' in server.capabilities:
+            self.send('* OK [HIGHESTMODSEQ {}]\r\n'.format(server.highestmodseq))
+
+    def do_NOOP(self, tag, args, uid):
+        # New messages are announced, but not other connections' expunges or flag changes.
+        if len(self.server.messages) > self.exists:
+            self.exists = len(self.server.messages)
+            self.send('* {} EXISTS\r\n'.format(self.exists))
+
+    def do_CLOSE(self, tag, args, uid):
+        pass
+
+    def do_IDLE(self, tag, args, uid):
+        self.send('+ idling\r\n')
+        self.server.lock.release()
+        try:
+            self.rfile.readline()
+        finally:
+            self.server.lock.acquire()
+
+    def _select(self, spec: str, uid: bool) -> List[Tuple[int, FakeMessage]]:
+        messages = self.server.messages
+        if uid:
+            uids = set(sequence_set(spec, messages[-1].uid if messages else 0))
+            return [(i, m) for i, m in enumerate(messages, 1) if m.uid in uids]
+        return [(n, messages[n - 1]) for n in sequence_set(spec, len(messages)) if 0 < n <= len(messages)]
+
+    def _search(self, tokens: List[str]) -> List[Tuple[int, FakeMessage]]:
+        hits = list(enumerate(self.server.messages, 1))
+        while tokens:
+            key = tokens.pop(0).upper()
+            if key in ('UNSEEN', 'SEEN', 'FLAGGED', 'DELETED', 'ANSWERED'):
+                flag = '\\' + key.replace('UN', '').capitalize()
+                hits = [h for h in hits if (flag in h[1].flags) != key.startswith('UN')]
+            elif key in ('FROM', 'SUBJECT', 'TO'):
+                value = tokens.pop(0).strip('"').lower()
+                hits = [h for h in hits if value in str(h[1].parsed().get(key, '')).lower()]
+            elif key == 'UID':
+                messages = self.server.messages
+                uids = set(sequence_set(tokens.pop(0), messages[-1].uid if messages else 0))
+                hits = [h for h in hits if h[1].uid in uids]
+            elif key[0].isdigit() or key[0] == '*':
+                nums = set(sequence_set(key, len(self.server.messages)))
+                hits = [h for h in hits if h[0] in nums]
+        return hits
+
+    def _search_results(self, tag: str, command: str, hits: List[Tuple[int, FakeMessage]], uid: bool,
+                        esearch: bool) -> None:
+        nums = [str(m.uid if uid else n) for n, m in hits]
+        if esearch:
+            self.send('* ESEARCH (TAG "{}"){}{}\r\n'.format(tag, ' UID' if uid else '',
+                                                            ' ALL ' + ','.join(nums) if nums else ''))
+        else:
+            self.send('* {} {}\r\n'.format(command, ' '.join(nums)).replace(' \r\n', '\r\n'))
+
+    def do_SEARCH(self, tag, args, uid):
+        tokens = _TOKEN.findall(args)
+        esearch = tokens[:4] == ['RETURN', '(', 'ALL', ')']
+        tokens = tokens[4:] if esearch else tokens
+        if tokens[:1] == ['CHARSET']:
+            tokens = tokens[2:]
+        self._search_results(tag, 'SEARCH', self._search(tokens), uid, esearch)
+
+    def do_SORT(self, tag, args, uid):
+        tokens = _TOKEN.findall(args)
+        esearch = tokens[:4] == ['RETURN', '(', 'ALL', ')']
+        tokens = tokens[4:] if esearch else tokens
+        end = tokens.index(')')
+        program, tokens = [t.upper() for t in tokens[1:end]], tokens[end + 2:]  # Skip the charset.
+        hits = self._search(tokens)
+        reverse = program[0] == 'REVERSE'
+        key = program[-1]
+        if key == 'DATE':
+            hits.sort(key=lambda h: parsedate_to_datetime(h[1].parsed()['Date']), reverse=reverse)
+        elif key in ('FROM', 'SUBJECT'):
+            hits.sort(key=lambda h: str(h[1].parsed().get(key, '')).lower(), reverse=reverse)
+        elif reverse:
+            hits.reverse()
+        self._search_results(tag, 'SORT', hits, uid, esearch)
+
+    def do_FETCH(self, tag, args, uid):
+        spec, _, items = args.partition(' ')
+        selected = self._select(spec, uid)
+        changedsince = _CHANGEDSINCE.search(items)
+        if changedsince is not None:
+            items = items[:changedsince.start()]
+            modseq = int(changedsince.group(1))
+            selected = [(num, message) for num, message in selected if message.modseq > modseq]
+            if changedsince.group(2) and uid and self.qresync:
+                largest = max([m.uid for m in self.server.messages] + [u for u, _ in self.server.expunged] + [0])
+                wanted = set(sequence_set(spec, largest))
+                vanished = [u for u, m in self.server.expunged if m > modseq and u in wanted]
+                if vanished:
+                    self.send('* VANISHED (EARLIER) {}\r\n'.format(','.join(str(u) for u in vanished)))
+        for num, message in selected:
+            parts = []  # type: List[bytes]
+            if uid:
+                parts.append(b'UID %d' % message.uid)
+            if changedsince is not None:
+                parts.append(b'MODSEQ (%d)' % message.modseq)
+            for match in _ITEM.finditer(items):
+                item = match.group(0).upper()
+                if item == 'FLAGS':
+                    parts.append('FLAGS ({})'.format(' '.join(sorted(message.flags))).encode())
+                elif item == 'UID':
+                    if not uid:
+                        parts.append(b'UID %d' % message.uid)
+                elif item == 'MODSEQ':
+                    if changedsince is None:
+                        parts.append(b'MODSEQ (%d)' % message.modseq)
+                elif item == 'RFC822.SIZE':
+                    parts.append(b'RFC822.SIZE %d' % len(message.data))
+                elif item == 'INTERNALDATE':
+                    parts.append('INTERNALDATE {}'.format(message.internaldate()).encode())
+                elif item == 'BODYSTRUCTURE':
+                    parts.append(b'BODYSTRUCTURE ' + body_structure(message.parsed()).encode())
+                else:
+                    if item.startswith('RFC822'):
+                        section = {'RFC822': '', 'RFC822.HEADER': 'HEADER'}[item]
+                        name = item
+                    else:
+                        section = match.group(1)
+                        name = 'BODY[{}]'.format(section)
+                    data = body_section(message, section)
+                    if match.group(2) is not None:
+                        start = int(match.group(2))
+                        data = data[start:start + int(match.group(3))]
+                        name += '<{}>'.format(start)
+                    if ('.PEEK' not in item and 'HEADER' not in item and section != '' or item == 'RFC822') and \
+                            '\\Seen' not in message.flags:
+                        message.flags.add('\\Seen')
+                        self.server.touch(message)
+                    parts.append(name.encode() + b' {%d}\r\n' % len(data) + data)
+            self.send(b'* %d FETCH (' % num + b' '.join(parts) + b')\r\n')
+
+    def do_STORE(self, tag, args, uid):
+        spec, operation, flags = args.split(' ', 2)
+        flags = set(flags.strip('()').split())
+        condstore = 'CONDSTORE' in self.server.capabilities
+        for num, message in self._select(spec, uid):
+            old = set(message.flags)
+            if operation.upper().startswith('+'):
+                message.flags |= flags
+            elif operation.upper().startswith('-'):
+                message.flags -= flags
+            else:
+                message.flags = set(flags)
+            if message.flags != old:
+                self.server.touch(message)
+            if '.SILENT' not in operation.upper():
+                self.send('* {} FETCH ({}{}FLAGS ({}))\r\n'.format(
+                    num, 'UID {} '.format(message.uid) if uid else '',
+                    'MODSEQ ({}) '.format(message.modseq) if condstore else '', ' '.join(sorted(message.flags))))
+
+    def do_EXPUNGE(self, tag, args, uid):
+        messages = self.server.messages
+        wanted = set(sequence_set(args, messages[-1].uid)) if uid and messages else None
+        num = 1
+        while num <= len(messages):
+            message = messages[num - 1]
+            if '\\Deleted' in message.flags and (wanted is None or message.uid in wanted):
+                del messages[num - 1]
+                self.exists -= 1
+                self.server.highestmodseq += 1
+                self.server.expunged.append((message.uid, self.server.highestmodseq))
+                if self.qresync:
+                    self.send('* VANISHED {}\r\n'.format(message.uid))
+                else:
+                    self.send('* {} EXPUNGE\r\n'.format(num))
+            else:
+                num += 1
+
+
+class FakeImapServer(socketserver.ThreadingTCPServer):
+    """Serve a list of (message, flags) pairs over IMAP on localhost, delaying every command by ``latency`` seconds.
+
+    Every connection sees the same mailbox, and commands are handled one at a time. Of the changes made by others, a
+    connection is only told about new messages, in reply to NOOP, but the MODSEQs, if CONDSTORE is advertised, let it
+    find out about the rest.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, messages: Sequence[Tuple[bytes, Sequence[str]]], capabilities: Sequence[str] = ('IDLE', ),
+                 latency: float = 0.0) -> None:
+        super().__init__(('127.0.0.1', 0), FakeImapHandler)
+        self.messages = [FakeMessage(uid, data, set(flags)) for uid, (data, flags) in enumerate(messages, 1)]
+        self.capabilities = list(capabilities)
+        self.latency = latency
+        self.lock = threading.RLock()
+        self.uidvalidity = 1
+        self.uidnext = len(self.messages) + 1
+        self.highestmodseq = 1
+        self.expunged = []  # type: List[Tuple[int, int]]
+
+    def touch(self, message: FakeMessage) -> None:
+        """Give a message that has just changed the next MODSEQ."""
+        self.highestmodseq += 1
+        message.modseq = self.highestmodseq
+
+    def append(self, data: bytes, flags: Sequence[str] = ()) -> FakeMessage:
+        """Deliver a new message to the mailbox."""
+        with self.lock:
+            message = FakeMessage(self.uidnext, data, set(flags))
+            self.uidnext += 1
+            self.touch(message)
+            self.messages.append(message)
+            return message
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        return self.server_address[:2]
+
+    def start(self) -> 'FakeImapServer':
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+def messages_from_maildir(maildir: pathlib.Path) -> List[Tuple[bytes, List[str]]]:
+    """Read the messages in a maildir, oldest first, with their flags, for a FakeImapServer."""
+    flag_names = {'R': '\\Answered', 'S': '\\Seen', 'F': '\\Flagged', 'T': '\\Deleted', 'D': '\\Draft'}
+    paths = sorted((p for sub in ('new', 'cur') for p in (maildir / sub).iterdir()), key=lambda p: p.stat().st_mtime)
+    messages = []
+    for path in paths:
+        data = path.read_bytes()
+        if b'\r\n' not in data:
+            data = data.replace(b'\n', b'\r\n')
+        flags = path.name.partition(':2,')[2]
+        messages.append((data, [flag_names[c] for c in flags if c in flag_names]))
+    return messages
@@ -0,0 +1,125 @@
+"""Generate a synthetic maildir, reproducibly, for benchmarking.
+
+Run with ``python -m benchmarks.maildirgen DIR [COUNT]`` from the repository root; see ``--help`` for the mix of
+message structures and attachments.
+"""
+import argparse
+import os
+import pathlib
+import random
+
+from datetime import datetime, timedelta, timezone
+from email.message import EmailMessage
+from email.policy import SMTP
+from email.utils import format_datetime
+
+
+STRUCTURES = ('plain', 'alternative', 'mixed')
+START_DATE = datetime(2018, 1, 2, 10, 0, tzinfo=timezone.utc)
+
+_WORDS = ('the quick brown fox jumps over lazy dog lorem ipsum dolor sit amet meeting lunch report release '
+          'python curses inbox thread reply schedule budget review patch build server client').split()
+_ATTACHMENT_TYPES = (('application', 'pdf', 'pdf'), ('image', 'png', 'png'), ('application', 'zip', 'zip'))
+
+
+def _sentence(rng: random.Random, words: int) -> str:
+    return ' '.join(rng.choice(_WORDS) for _ in range(words)).capitalize() + '.'
+
+
+def _text(rng: random.Random, paragraphs: int) -> str:
+    return '\n\n'.join(' '.join(_sentence(rng, rng.randint(4, 16)) for _ in range(rng.randint(2, 8)))
+                       for _ in range(paragraphs)) + '\n'
+
+
+def make_message(rng: random.Random, num: int, structure: str = 'plain', attachments: int = 0,
+                 attachment_size: int = 64 * 1024, references: tuple = ()) -> EmailMessage:
+    """Build a single message, whose content is entirely determined by the state of ``rng`` and the arguments.
+
+    :param str structure: One of STRUCTURES: a single text/plain part, text and HTML alternatives, or alternatives
+        plus ``attachments`` attachments in a multipart/mixed.
+    :param tuple references: The message ids (without angle brackets) of the earlier messages in its thread.
+    """
+    sender = rng.randrange(200)
+    subject = _sentence(rng, rng.randint(2, 8))[:-1]
+    message = EmailMessage()
+    message['From'] = '"Sender {}" <sender{}@example.com>'.format(sender, sender)
+    message['To'] = 'me@example.com'
+    message['Subject'] = 'Re: ' + subject if references else subject
+    message['Date'] = format_datetime(START_DATE + timedelta(minutes=num))
+    message['Message-ID'] = '<{}@example.com>'.format(num)
+    if references:
+        message['In-Reply-To'] = '<{}>'.format(references[-1])
+        message['References'] = ' '.join('<{}>'.format(ref) for ref in references)
+    text = _text(rng, rng.randint(1, 12))
+    message.set_content(text)
+    if structure in ('alternative', 'mixed'):
+        html = ''.join('<p>{}</p>\n'.format(p.replace('\n', ' ')) for p in text.split('\n\n'))
+        message.add_alternative('<html><body>\n{}</body></html>\n'.format(html), subtype='html')
+    if structure == 'mixed':
+        message.make_mixed()
+        for i in range(attachments):
+            maintype, subtype, extension = rng.choice(_ATTACHMENT_TYPES)
+            size = rng.randint(attachment_size // 2, attachment_size * 3 // 2)
+            data = rng.getrandbits(8 * size).to_bytes(size, 'little')
+            message.add_attachment(data, maintype=maintype, subtype=subtype,
+                                   filename='attachment{}.{}'.format(i, extension))
+    # Fixed boundaries, so the output doesn't depend on the global random state.
+    for depth, part in enumerate(p for p in message.walk() if p.is_multipart()):
+        part.set_boundary('=_pynemail_{}_{}'.format(num, depth))
+    return message
+
+
+def generate_maildir(path: pathlib.Path, count: int, structures: tuple = STRUCTURES, attachments: int = 2,
+                     attachment_size: int = 64 * 1024, replies: float = 0.3, unread: float = 0.2,
+                     seed: int = 0) -> pathlib.Path:
+    """Fill a new maildir with ``count`` messages, which are the same every time for the same arguments.
+
+    :param tuple structures: The message structures to choose from, at random.
+    :param int attachments: The number of attachments in each multipart/mixed message.
+    :param int attachment_size: The average size of an attachment, in bytes.
+    :param float replies: The fraction of messages that reply to an earlier one.
+    :param float unread: The fraction of messages that are unread, and still in new/.
+    :return: The path of the maildir.
+    :rtype: pathlib.Path
+    """
+    rng = random.Random(seed)
+    for subdir in ('new', 'cur', 'tmp'):
+        (path / subdir).mkdir(parents=True, exist_ok=True)
+    threads = []  # type: list
+    for num in range(count):
+        references = ()  # type: tuple
+        if threads and rng.random() < replies:
+            thread = rng.choice(threads)
+            references = tuple(thread)
+            thread.append('{}@example.com'.format(num))
+        else:
+            threads.append(['{}@example.com'.format(num)])
+        message = make_message(rng, num, rng.choice(structures), attachments, attachment_size, references)
+        is_new = rng.random() < unread
+        flags = '' if is_new else ('FS' if rng.random() < 0.05 else 'S')
+        filename = '{}.M{}P0.bench:2,{}'.format(1500000000 + num, num, flags)
+        filepath = path / ('new' if is_new else 'cur') / filename
+        filepath.write_bytes(message.as_bytes(policy=SMTP))
+        mtime = 1500000000 + num * 60
+        os.utime(str(filepath), (mtime, mtime))
+    return path
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Generate a synthetic maildir for benchmarking')
+    parser.add_argument('path', type=pathlib.Path, help='The maildir to create')
+    parser.add_argument('count', type=int, nargs='?', default=10000, help='The number of messages (default: 10000)')
+    parser.add_argument('--structures', default=','.join(STRUCTURES),
+                        help='A comma separated mix of {} (default: all of them)'.format(', '.join(STRUCTURES)))
+    parser.add_argument('--attachments', type=int, default=2,
+                        help='The number of attachments in each multipart/mixed message (default: 2)')
+    parser.add_argument('--attachment-size', type=int, default=64 * 1024,
+                        help='The average size of an attachment in bytes (default: 65536)')
+    parser.add_argument('--seed', type=int, default=0, help='The random seed (default: 0)')
+    args = parser.parse_args()
+    generate_maildir(args.path, args.count, tuple(args.structures.split(',')), args.attachments,
+                     args.attachment_size, seed=args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""Measure the memory held per email by a listed inbox, on top of the header text itself.
+
+Run with ``python -m benchmarks.memory [COUNT]`` from the repository root.
+"""
+import pathlib
+import sys
+import tracemalloc
+
+from pynemail.maildirclient import MaildirEmail
+
+
+def make_summaries(count: int) -> list:
+    return [('/maildir/cur/{}.M{}P{}.host:2,S'.format(1500000000 + i, i, i), {
+        'From': '"Sender {}" <sender{}@example.com>'.format(i % 500, i % 500),
+        'To': 'me@example.com',
+        'Subject': 'Subject of message number {}'.format(i),
+        'Date': 'Tue, 02 Jan 2018 10:00:00 +0000',
+    }) for i in range(count)]
+
+
+def build_inbox(summaries: list) -> list:
+    mails = []
+    for path, summary in summaries:
+        mail = MaildirEmail(pathlib.Path(path), False)
+        mail.set_summary(summary)
+        mail.sender()
+        mail.unread()
+        mails.append(mail)
+    return mails
+
+
+def measure(count: int) -> tuple:
+    """Return the total and overhead bytes allocated per email while listing an inbox of the given size."""
+    summaries = make_summaries(count)
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    mails = build_inbox(summaries)
+    used = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+    # The path has to be stored somehow, so its text counts as data rather than overhead.
+    data = sum(sys.getsizeof(path) for path, _ in summaries)
+    del mails
+    return used / count, (used - data) / count
+
+
+def main() -> None:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    total, overhead = measure(count)
+    print('{:.0f} bytes per email, of which {:.0f} bytes is overhead ({} emails)'.format(total, overhead, count))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,338 @@
+"""Time the hot paths of pynemail against a synthetic maildir, and a fake IMAP server serving the same messages.
+
+Run with ``python -m benchmarks.run [--count N] [--output results.json]`` from the repository root. Each scenario is
+run ``--repeat`` times, and the minimum and median times are printed and saved as JSON, along with the parameters and
+platform, so they can be compared between releases. The inbox scenarios draw to a pseudo-terminal, so they don't need
+(or touch) a real one.
+"""
+import argparse
+import curses
+import fcntl
+import json
+import os
+import pathlib
+import platform
+import pty
+import statistics
+import struct
+import sys
+import tempfile
+import termios
+import threading
+import time
+
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Callable, Dict, Generator, List
+
+from pynemail.email import Email, EmailFlag
+from pynemail.imapclient import connect_imap, fetch_imap_body, load_imap_summaries, store_imap_flags
+from pynemail.imapindex import imap_index
+from pynemail.imapmailbox import ImapMailbox, get_mail_from_imap
+from pynemail.imapmirror import ImapMirror
+from pynemail.maildirclient import get_mail_from_maildir, rename_maildir_flags
+from pynemail.maildirindex import maildir_index
+from pynemail.main import setup_curses
+from pynemail.ui import InboxPage
+
+from .fakeimap import FakeImapServer, messages_from_maildir
+from .maildirgen import generate_maildir
+
+
+FIRST_PAGE = 50
+OPEN_COUNT = 10
+TOGGLE_COUNT = 100
+TERMINAL_SIZE = (50, 160)
+
+# Each scenario takes the shared setup and returns the time taken by the part being measured, in seconds.
+Scenario = Callable[['Bench'], float]
+SCENARIOS = []  # type: List[tuple]
+
+
+def scenario(name: str, description: str) -> Callable[[Scenario], Scenario]:
+    def register(func: Scenario) -> Scenario:
+        SCENARIOS.append((name, description, func))
+        return func
+    return register
+
+
+def _time(func: Callable[[], object]) -> float:
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+class Bench:
+    """The maildir, IMAP server and terminal shared by the scenarios, and a place for them to keep state between runs."""
+
+    def __init__(self, maildir: pathlib.Path, workdir: pathlib.Path, server: FakeImapServer, screen) -> None:
+        self.maildir = maildir
+        self.workdir = workdir
+        self.server = server
+        self.screen = screen
+        self.runs = 0
+        self.state = {}  # type: Dict[str, object]
+
+    def index_path(self) -> pathlib.Path:
+        self.runs += 1
+        return self.workdir / 'index{}.sqlite'.format(self.runs)
+
+    def imap_address(self) -> str:
+        return '{}:{}'.format(*self.server.address)
+
+    def imap(self):
+        if 'imap' not in self.state:
+            self.state['imap'] = connect_imap(self.imap_address(), 'password')
+        return self.state['imap']
+
+    def warm_imap_index(self):
+        if 'imap_index' not in self.state:
+            self.state['imap_index_context'] = context = imap_index(self.imap_address(), 'bench',
+                                                                    path=self.workdir / 'imap.sqlite')
+            self.state['imap_index'] = index = context.__enter__()
+            mailbox = ImapMailbox(self.imap(), index)
+            mailbox.list()
+            mailbox.save()
+        return self.state['imap_index']
+
+    def warm_index(self):
+        if 'index' not in self.state:
+            self.state['index_context'] = context = maildir_index(self.maildir, self.workdir / 'warm.sqlite')
+            self.state['index'] = index = context.__enter__()
+            get_mail_from_maildir(self.maildir, index)
+        return self.state['index']
+
+    def close(self) -> None:
+        if 'imap' in self.state:
+            self.state['imap'].logout()
+        for context in ('index_context', 'imap_index_context'):
+            if context in self.state:
+                self.state[context].__exit__(None, None, None)
+
+
+@scenario('maildir_list', 'List the maildir without an index, parsing only the first page of headers')
+def maildir_list(bench: Bench) -> float:
+    return _time(lambda: [m.sender() for m in get_mail_from_maildir(bench.maildir)[:FIRST_PAGE]])
+
+
+@scenario('maildir_index_build', 'List the maildir into an empty index, parsing the headers of every email')
+def maildir_index_build(bench: Bench) -> float:
+    with maildir_index(bench.maildir, bench.index_path()) as index:
+        return _time(lambda: get_mail_from_maildir(bench.maildir, index))
+
+
+@scenario('maildir_rescan', 'List the maildir again from an up to date index')
+def maildir_rescan(bench: Bench) -> float:
+    index = bench.warm_index()
+    return _time(lambda: get_mail_from_maildir(bench.maildir, index))
+
+
+@scenario('maildir_flag_toggle', 'Flag or unflag {} emails, renaming their files'.format(TOGGLE_COUNT))
+def maildir_flag_toggle(bench: Bench) -> float:
+    mails = get_mail_from_maildir(bench.maildir)[:TOGGLE_COUNT]
+    state = not mails[0].important()
+    return _time(lambda: rename_maildir_flags({(EmailFlag.FLAGGED, state): mails}))
+
+
+@scenario('imap_list', 'List the IMAP inbox and fetch the first page of summaries')
+def imap_list(bench: Bench) -> float:
+    client = bench.imap()
+    return _time(lambda: load_imap_summaries(client, get_mail_from_imap(client, preload=False)[:FIRST_PAGE]))
+
+
+@scenario('imap_list_all', 'List the IMAP inbox and fetch the summaries of every email')
+def imap_list_all(bench: Bench) -> float:
+    client = bench.imap()
+    return _time(lambda: get_mail_from_imap(client))
+
+
+@scenario('imap_open', 'Fetch the text bodies of {} IMAP emails'.format(OPEN_COUNT))
+def imap_open(bench: Bench) -> float:
+    client = bench.imap()
+    uids = [message.uid for message in bench.server.messages]
+    chosen = [uids[(bench.runs * OPEN_COUNT + i) % len(uids)] for i in range(OPEN_COUNT)]
+    bench.runs += 1
+    return _time(lambda: [fetch_imap_body(client, uid) for uid in chosen])
+
+
+@scenario('imap_flag_toggle', 'Flag or unflag {} IMAP emails with a single STORE'.format(TOGGLE_COUNT))
+def imap_flag_toggle(bench: Bench) -> float:
+    client = bench.imap()
+    mails = get_mail_from_imap(client)[:TOGGLE_COUNT]
+    state = not mails[0].important()
+    return _time(lambda: store_imap_flags(client, {(EmailFlag.FLAGGED, state): mails}))
+
+
+@scenario('imap_resync', 'Reconnect to the IMAP inbox and list it again, with summaries, from an up to date index')
+def imap_resync(bench: Bench) -> float:
+    index = bench.warm_imap_index()
+    client = connect_imap(bench.imap_address(), 'password')
+    try:
+        return _time(lambda: ImapMailbox(client, index).list())
+    finally:
+        client.logout()
+
+
+@scenario('mirror_build', 'Mirror the IMAP inbox into an empty maildir, downloading every message')
+def mirror_build(bench: Bench) -> float:
+    bench.runs += 1
+    client = connect_imap(bench.imap_address(), 'password')
+    try:
+        return _time(ImapMirror(bench.workdir / 'mirror{}'.format(bench.runs), client).sync)
+    finally:
+        client.logout()
+
+
+@scenario('mirror_resync', 'Sync an up to date mirror of the IMAP inbox, as if after reconnecting')
+def mirror_resync(bench: Bench) -> float:
+    if 'mirror' not in bench.state:
+        bench.state['mirror'] = mirror = ImapMirror(bench.workdir / 'mirror', bench.imap())
+        mirror.sync()
+    return _time(bench.state['mirror'].sync)
+
+
+@scenario('inbox_first_render', 'Create and draw the inbox, from a freshly listed maildir with an index')
+def inbox_first_render(bench: Bench) -> float:
+    mails = get_mail_from_maildir(bench.maildir, bench.warm_index())
+    bench.screen.clear()
+
+    def render():
+        page = InboxPage(bench.screen, mails)
+        page.render()
+        page.refresh()
+    return _time(render)
+
+
+@scenario('message_open', 'Open and draw an email from the inbox, parsing it from the maildir')
+def message_open(bench: Bench) -> float:
+    if 'page' not in bench.state:
+        bench.state['page'] = InboxPage(bench.screen, get_mail_from_maildir(bench.maildir, bench.warm_index()))
+    page = bench.state['page']
+    page.keypress(curses.KEY_DOWN)  # A different email each time, so it isn't cached.
+    page.render()
+    page.refresh()
+
+    def open_message():
+        page.keypress(10)  # ENTER
+        page.render()
+        page.refresh()
+    elapsed = _time(open_message)
+    page.keypress(27)  # ESC
+    return elapsed
+
+
+@contextmanager
+def pseudo_terminal(lines: int, cols: int) -> Generator:
+    """Run curses on a new pseudo-terminal of the given size, in place of stdin and stdout, and yield its screen.
+
+    Whatever curses writes is read and thrown away by a thread, so it never blocks on a full terminal.
+    """
+    master, slave = pty.openpty()
+    fcntl.ioctl(slave, termios.TIOCSWINSZ, struct.pack('HHHH', lines, cols, 0, 0))
+
+    def drain():
+        try:
+            while os.read(master, 65536):
+                pass
+        except OSError:
+            pass  # The slave end has been closed.
+    reader = threading.Thread(target=drain, daemon=True)
+    reader.start()
+    sys.stdout.flush()
+    saved = os.dup(0), os.dup(1)
+    os.dup2(slave, 0)
+    os.dup2(slave, 1)
+    os.environ['TERM'] = 'xterm-256color'
+    for name in ('LINES', 'COLUMNS'):
+        os.environ.pop(name, None)
+    try:
+        screen = curses.initscr()
+        curses.noecho()
+        curses.cbreak()
+        screen.keypad(True)
+        curses.start_color()
+        setup_curses(screen)
+        try:
+            yield screen
+        finally:
+            curses.endwin()
+    finally:
+        os.dup2(saved[0], 0)
+        os.dup2(saved[1], 1)
+        for fd in saved + (slave, ):
+            os.close(fd)
+        reader.join(1)
+        os.close(master)
+
+
+def run(bench: Bench, names: List[str], repeat: int) -> Dict[str, dict]:
+    results = {}
+    for name, description, func in SCENARIOS:
+        if names and name not in names:
+            continue
+        bench.runs = 0
+        times = [func(bench) for _ in range(repeat)]
+        results[name] = {
+            'description': description,
+            'times': times,
+            'min': min(times),
+            'median': statistics.median(times),
+        }
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Time the hot paths of pynemail')
+    parser.add_argument('--count', type=int, default=5000, help='The number of emails to generate (default: 5000)')
+    parser.add_argument('--maildir', type=pathlib.Path,
+                        help='Use an existing maildir, e.g. one from benchmarks.maildirgen, rather than generating one')
+    parser.add_argument('--repeat', type=int, default=5, help='The number of times to run each scenario (default: 5)')
+    parser.add_argument('--latency', type=float, default=0.0, metavar='SECONDS',
+                        help="The fake IMAP server's delay before every command (default: 0)")
+    parser.add_argument('--seed', type=int, default=0, help='The random seed for the generated maildir (default: 0)')
+    parser.add_argument('--scenario', action='append', default=[], choices=[name for name, _, _ in SCENARIOS],
+                        help='Only run the given scenario; may be repeated (default: all of them)')
+    parser.add_argument('--output', type=pathlib.Path, help='Save the results to this JSON file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='pynemail-bench-') as tmp:
+        workdir = pathlib.Path(tmp)
+        maildir = args.maildir
+        if maildir is None:
+            maildir = generate_maildir(workdir / 'Maildir', args.count, seed=args.seed)
+        server = FakeImapServer(messages_from_maildir(maildir),
+                                ('IDLE', 'SORT', 'ESEARCH', 'ENABLE', 'CONDSTORE', 'QRESYNC'), args.latency).start()
+        try:
+            with pseudo_terminal(*TERMINAL_SIZE) as screen:
+                bench = Bench(maildir, workdir, server, screen)
+                try:
+                    results = run(bench, args.scenario, args.repeat)
+                finally:
+                    bench.close()
+        finally:
+            server.stop()
+
+    report = {
+        'metadata': {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'count': len(server.messages),
+            'maildir': None if args.maildir is None else str(args.maildir),
+            'seed': args.seed,
+            'repeat': args.repeat,
+            'latency': args.latency,
+        },
+        'results': results,
+    }
+    for name, result in results.items():
+        print('{:<20} min {:9.2f}ms  median {:9.2f}ms  {}'.format(
+            name, result['min'] * 1000, result['median'] * 1000, result['description']))
+    if args.output is not None:
+        with args.output.open('w') as fp:
+            json.dump(report, fp, indent=2)
+
+
+if __name__ == '__main__':
+    main()
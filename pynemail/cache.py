@@ -0,0 +1,96 @@
+from collections import OrderedDict, namedtuple
+from typing import Any, Callable, Hashable, Optional
+
+
+SIZE_SUFFIXES = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+class CacheStats(namedtuple('CacheStats', ['hits', 'misses', 'evictions', 'entries', 'size', 'max_size'])):
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def __str__(self) -> str:
+        return '{} entries, {:.1f} MiB resident, {:.1%} hit rate ({} hits, {} misses, {} evictions)'.format(
+            self.entries, self.size / 1024 ** 2, self.hit_rate, self.hits, self.misses, self.evictions)
+
+
+def parse_size(text: str) -> int:
+    """Parse a size in bytes, with an optional K, M or G suffix.
+
+    >>> parse_size('64M')
+    67108864
+    """
+    text = text.strip().upper().rstrip('B')
+    multiplier = SIZE_SUFFIXES.get(text[-1:], 1)
+    if text[-1:] in SIZE_SUFFIXES:
+        text = text[:-1]
+    return int(float(text) * multiplier)
+
+
+class LRUCache:
+    """A cache that evicts the least recently used entries once a size or entry budget is exceeded.
+
+    :param int max_size: The maximum total size of the entries, as measured by ``sizeof``, or None for no limit.
+    :param int max_entries: The maximum number of entries, or None for no limit.
+    :param callable sizeof: Estimates the resident size of a value that's stored without an explicit size.
+    """
+
+    def __init__(self, max_size: Optional[int] = None, max_entries: Optional[int] = None,
+                 sizeof: Callable[[Any], int] = lambda value: 1) -> None:
+        self.max_size = max_size
+        self.max_entries = max_entries
+        self.sizeof = sizeof
+        self._entries = OrderedDict()  # type: OrderedDict
+        self._size = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            self._misses += 1
+            return default
+        self._hits += 1
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key: Hashable, value: Any, size: Optional[int] = None) -> None:
+        self.pop(key)
+        size = self.sizeof(value) if size is None else size
+        self._entries[key] = (value, size)
+        self._size += size
+        self._evict()
+
+    def pop(self, key: Hashable) -> Any:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        self._size -= entry[1]
+        return entry[0]
+
+    def _evict(self) -> None:
+        # The newest entry is always kept, even if it's bigger than the whole budget on its own.
+        while len(self._entries) > 1 and (
+                (self.max_size is not None and self._size > self.max_size) or
+                (self.max_entries is not None and len(self._entries) > self.max_entries)):
+            _, (_, size) = self._entries.popitem(last=False)
+            self._size -= size
+            self._evictions += 1
+
+    def resize(self, max_size: Optional[int] = None, max_entries: Optional[int] = None) -> None:
+        self.max_size = max_size
+        self.max_entries = max_entries
+        self._evict()
+
+    def stats(self) -> CacheStats:
+        return CacheStats(self._hits, self._misses, self._evictions, len(self._entries), self._size, self.max_size)
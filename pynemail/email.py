@@ -1,8 +1,34 @@
+import itertools
+import re
+import sys
+
 from email.message import EmailMessage
-from email.parser import BytesParser
+from email.parser import BytesHeaderParser, BytesParser
 from email.policy import default as default_policy
+from email.utils import parseaddr
 from enum import Enum
-from typing import List, Optional
+from typing import TYPE_CHECKING, BinaryIO, Dict, Iterable, List, Optional, Tuple
+
+from .cache import LRUCache
+
+if TYPE_CHECKING:
+    from .flagqueue import FlagQueue
+
+
+SUMMARY_HEADERS = ('From', 'To', 'Subject', 'Date', 'Message-ID', 'In-Reply-To', 'References')
+SUMMARY_FROM, SUMMARY_TO, SUMMARY_SUBJECT, SUMMARY_DATE, SUMMARY_MESSAGE_ID, SUMMARY_IN_REPLY_TO, SUMMARY_REFERENCES = \
+    range(7)
+DEFAULT_CACHE_SIZE = 64 * 1024 ** 2
+MESSAGE_PART_OVERHEAD = 1024
+# The most bytes of a message's text part that are fetched (and decoded) for a preview.
+PREVIEW_SIZE = 2048
+NO_BODY_TEXT = " PynEmail Error: Unable to read email body!"
+
+_cache_keys = itertools.count()
+_SUBJECT_PREFIX = re.compile(r'^\s*((re|fwd?|aw|sv)(\[\d+\])?:\s*)+', re.IGNORECASE)
+_MESSAGE_ID = re.compile(r'<([^<>\s]+)>')
+
+FlagChanges = Dict[Tuple['EmailFlag', bool], List['Email']]
 
 
 class EmailFlag(Enum):
@@ -14,20 +40,91 @@ class EmailFlag(Enum):
     DELETED = 'X'
     DRAFT = 'D'
 
+    @property
+    def bit(self) -> int:
+        """The bit representing this flag in a flag mask."""
+        return FLAG_BITS[self]
+
+
+FLAG_BITS = {flag: 1 << i for i, flag in enumerate(EmailFlag)}  # type: Dict[EmailFlag, int]
+
+
+def flags_to_mask(flags: Iterable[EmailFlag]) -> int:
+    mask = 0
+    for flag in flags:
+        mask |= FLAG_BITS[flag]
+    return mask
+
+
+def mask_to_flags(mask: int) -> List[EmailFlag]:
+    return [flag for flag, bit in FLAG_BITS.items() if mask & bit]
+
+
+def read_header_block(fp: BinaryIO) -> bytes:
+    """Read an email's headers from a file, stopping at the blank line that separates them from the body."""
+    lines = []
+    for line in fp:
+        if line in (b'\r\n', b'\n'):
+            break
+        lines.append(line)
+    return b''.join(lines)
+
+
+def estimate_message_size(message: EmailMessage) -> int:
+    """Roughly estimate the memory held by a parsed message, from the size of its payloads."""
+    size = 0
+    for part in message.walk():
+        payload = part.get_payload()
+        size += MESSAGE_PART_OVERHEAD + (len(payload) if isinstance(payload, (str, bytes)) else 0)
+    return size
+
+
+def summary_from_headers(headers: EmailMessage) -> Tuple[str, ...]:
+    """Extract the values of the SUMMARY_HEADERS, in order, using an empty string for any that are missing."""
+    return tuple(str(headers.get(name, '')) for name in SUMMARY_HEADERS)
+
+
+def base_subject(subject: str) -> str:
+    """Strip any reply and forward prefixes from a subject, so the emails in a conversation can be matched up.
+
+    >>> base_subject('Re: Fwd: RE: Lunch?')
+    'Lunch?'
+    """
+    return _SUBJECT_PREFIX.sub('', subject).strip()
+
+
+def parse_message_ids(value: str) -> List[str]:
+    """Extract the message ids from a Message-ID, In-Reply-To or References header, without their angle brackets.
+
+    >>> parse_message_ids('<a@example.com> (a comment) <b@example.com>')
+    ['a@example.com', 'b@example.com']
+    """
+    return _MESSAGE_ID.findall(value)
+
 
 class Email:
-    """A cached copy of a single email."""
+    """A cached copy of a single email.
+
+    The small summary headers and flags are kept for the lifetime of the email, but parsed messages and decoded bodies
+    live in a cache shared by all emails, which evicts the least recently used ones once its budget is exceeded.
+    Mailboxes can hold hundreds of thousands of emails, so instances use __slots__, the summary is a tuple and the
+    flags are a bit mask.
+    """
+
+    __slots__ = ('_cache_id', '_headers', '_flags', '_summary')
 
     parser = BytesParser(policy=default_policy)
+    header_parser = BytesHeaderParser(policy=default_policy)
+    cache = LRUCache(max_size=DEFAULT_CACHE_SIZE)
+    flag_queue = None  # type: Optional[FlagQueue]
 
     def __init__(self):
+        self._cache_id = None  # type: Optional[int]
         self._headers = None
-        self._message = None
-        self._body = None
-        self._from = None
-        self._flags = None
+        self._flags = None  # type: Optional[int]
+        self._summary = None  # type: Optional[Tuple[str, ...]]
 
-    def _get_flags(self) -> EmailMessage:
+    def _get_flags(self) -> int:
         raise NotImplementedError('Email._get_flags()')
 
     def _get_headers(self) -> EmailMessage:
@@ -36,20 +133,42 @@ class Email:
     def _get_message(self) -> EmailMessage:
         raise NotImplementedError('Email._get_message()')
 
+    def _get_body(self) -> Optional[str]:
+        """Return the plain text body, or None if there isn't one; backends may avoid parsing the whole message."""
+        body = self.message().get_body(preferencelist=('plain', ))
+        return None if body is None else body.get_content()
+
+    def _get_preview(self) -> Optional[str]:
+        """Return the start of the plain text body, or None if there isn't one, ideally without loading the rest."""
+        body = self._get_body()
+        return None if body is None else body[:PREVIEW_SIZE]
+
+    def _write_flags(self, changes: FlagChanges) -> None:
+        raise NotImplementedError('Email._write_flags()')
+
+    def _cache_key(self, kind: str) -> Tuple[int, str]:
+        # Most emails never have their body loaded, so only those that do are given a (unique) cache id.
+        if self._cache_id is None:
+            self._cache_id = next(_cache_keys)
+        return self._cache_id, kind
+
+    def has_flag(self, flag: EmailFlag) -> bool:
+        return bool(self.flag_mask() & FLAG_BITS[flag])
+
     def unread(self) -> bool:
-        return EmailFlag.SEEN not in self.flags()
+        return not self.has_flag(EmailFlag.SEEN)
 
     def important(self) -> bool:
-        return EmailFlag.FLAGGED in self.flags()
+        return self.has_flag(EmailFlag.FLAGGED)
 
     def replied(self) -> bool:
-        return EmailFlag.ANSWERED in self.flags()
+        return self.has_flag(EmailFlag.ANSWERED)
 
     def deleted(self) -> bool:
-        return EmailFlag.DELETED in self.flags()
+        return self.has_flag(EmailFlag.DELETED)
 
     def draft(self) -> bool:
-        return EmailFlag.DRAFT in self.flags()
+        return self.has_flag(EmailFlag.DRAFT)
 
     def headers(self) -> EmailMessage:
         if self._headers is None:
@@ -57,39 +176,118 @@ class Email:
         return self._headers
 
     def message(self) -> EmailMessage:
-        if self._message is None:
-            self._message = self._get_message()
-        return self._message
+        message = self.cache.get(self._cache_key('message'))
+        if message is None:
+            message = self._get_message()
+            self.cache.put(self._cache_key('message'), message, estimate_message_size(message))
+        return message
+
+    def has_message(self) -> bool:
+        return self._cache_id is not None and self._cache_key('message') in self.cache
 
     def body(self) -> str:
-        if self._body is None:
-            if self.unread():
-                self.set_flag(EmailFlag.SEEN, True)
-            body = self.message().get_body(preferencelist=('plain', ))
-            if body is None:
-                self._body = " PynEmail Error: Unable to read email body!"
-            else:
-                self._body = body.get_content()
-        return self._body
+        if self.unread():
+            self.set_flag(EmailFlag.SEEN, True)
+        body = self.cache.get(self._cache_key('body'))
+        if body is None:
+            body = self.load_body()
+            self.cache.put(self._cache_key('body'), body, sys.getsizeof(body))
+        return body
+
+    def load_body(self) -> str:
+        """Load the plain text body without caching it or marking the email as read, e.g. to prefetch it.
+
+        :return: The body, or an error message if there isn't one.
+        :rtype: str
+        """
+        body = self._get_body()
+        return NO_BODY_TEXT if body is None else body
+
+    def has_body(self) -> bool:
+        return self._cache_id is not None and self._cache_key('body') in self.cache
+
+    def set_body(self, body: str) -> None:
+        """Provide the decoded body up front, e.g. once it's been prefetched in the background."""
+        self.cache.put(self._cache_key('body'), body, sys.getsizeof(body))
+
+    def preview(self) -> str:
+        """Return the start of the body, for a preview, without marking the email as read.
+
+        If the whole body has already been loaded, the preview is taken from it, rather than being loaded separately.
+        """
+        body = self.cache.get(self._cache_key('body'))
+        if body is not None:
+            return body[:PREVIEW_SIZE]
+        preview = self.cache.get(self._cache_key('preview'))
+        if preview is None:
+            preview = self.load_preview()
+            self.set_preview(preview)
+        return preview
+
+    def load_preview(self) -> str:
+        """Load the start of the body without caching it, e.g. to prefetch it; see load_body()."""
+        preview = self._get_preview()
+        return NO_BODY_TEXT if preview is None else preview
+
+    def has_preview(self) -> bool:
+        return self._cache_id is not None and (self._cache_key('preview') in self.cache or self.has_body())
+
+    def set_preview(self, preview: str) -> None:
+        self.cache.put(self._cache_key('preview'), preview, sys.getsizeof(preview))
+
+    def _summary_fields(self) -> Tuple[str, ...]:
+        if self._summary is None:
+            headers = self._headers if self._headers is not None else self._get_headers()
+            self._summary = summary_from_headers(headers)
+        return self._summary
+
+    def summary(self) -> Dict[str, str]:
+        """Return the headers needed to list this email, keyed by header name.
+
+        :return: The value of each of the SUMMARY_HEADERS, or an empty string if it is missing.
+        :rtype: dict[str, str]
+        """
+        return dict(zip(SUMMARY_HEADERS, self._summary_fields()))
+
+    def set_summary(self, summary: Dict[str, str]) -> None:
+        """Provide the summary headers up front, e.g. from an index, so they never have to be parsed."""
+        self._summary = tuple(summary.get(name, '') for name in SUMMARY_HEADERS)
 
     def sender(self) -> str:
-        if self._from is None:
-            fro = self.headers()['From']
-            if ' ' in fro:
-                fro = ' '.join(fro.split(' ')[:-1]).strip()
-            if fro[0] == '"' and fro[-1] == '"':
-                fro = fro[1:-1]
-            self._from = fro
-        return self._from
+        fro = self._summary_fields()[SUMMARY_FROM]
+        if ' ' in fro:
+            fro = ' '.join(fro.split(' ')[:-1]).strip()
+        if fro[:1] == '"' and fro[-1:] == '"':
+            fro = fro[1:-1]
+        return fro
+
+    def sender_address(self) -> str:
+        """Return the sender's email address, in lower case."""
+        return parseaddr(self._summary_fields()[SUMMARY_FROM])[1].lower()
 
     def to(self) -> str:
-        return self.headers()['To']
+        return self._summary_fields()[SUMMARY_TO]
 
     def date(self) -> str:
-        return self.headers()['Date'][:-5]
+        return self._summary_fields()[SUMMARY_DATE][:-5]
 
     def subject(self) -> str:
-        return self.headers()['Subject']
+        return self._summary_fields()[SUMMARY_SUBJECT]
+
+    def message_id(self) -> Optional[str]:
+        ids = parse_message_ids(self._summary_fields()[SUMMARY_MESSAGE_ID])
+        return ids[0] if ids else None
+
+    def references(self) -> List[str]:
+        """Return the ids of the messages this one replies to, oldest first, from its References or In-Reply-To."""
+        fields = self._summary_fields()
+        return parse_message_ids(fields[SUMMARY_REFERENCES]) or parse_message_ids(fields[SUMMARY_IN_REPLY_TO])[:1]
+
+    def flag_mask(self) -> int:
+        """Return the flags set for this email, as a bit mask of EmailFlag.bit values."""
+        if self._flags is None:
+            self._flags = self._get_flags()
+        return self._flags
 
     def flags(self) -> List[EmailFlag]:
         """Return the flags set for this email.
@@ -97,26 +295,47 @@ class Email:
         :return: A list of flags.
         :rtype: list[EmailFlag]
         """
-        if self._flags is None:
-            self._flags = self._get_flags()
-        return self._flags
+        return mask_to_flags(self.flag_mask())
 
     def set_flag(self, flag: EmailFlag, state: bool) -> None:
         """Set or unset the given flag, based on the provided state.
 
         :param EmailFlag flag: The flag to manipulate.
         :param bool state: True to set the flag, False to unset the flag.
+
+        The change is visible straight away. If the class has a flag_queue, it's written to the mail store the next
+        time the queue is flushed, otherwise it's written before returning.
         """
-        raise NotImplementedError('Email.set_flag()')
+        mask = self.flag_mask()
+        newmask = mask | flag.bit if state else mask & ~flag.bit
+        if newmask == mask:
+            return
+        self._flags = newmask
+        if self.flag_queue is None:
+            self._write_flags({(flag, state): [self]})
+        else:
+            self.flag_queue.add(self, flag, state)
 
     def clear(self) -> None:
         """Clear all cached state to force the lazy initialisers to reload."""
         self.clear_flags()
         self._headers = None
-        self._message = None
-        self._body = None
-        self._from = None
+        self._summary = None
+        if self._cache_id is not None:
+            self.cache.pop(self._cache_key('message'))
+            self.cache.pop(self._cache_key('body'))
+            self.cache.pop(self._cache_key('preview'))
 
     def clear_flags(self) -> None:
-        """Clear all cached flags to force the lazy initialisers to reload."""
+        """Clear all cached flags to force the lazy initialisers to reload.
+
+        Changes still waiting in the flag_queue are kept, on top of whatever the mail store now says, so that they
+        aren't lost when another program changes the flags before the queue is flushed.
+        """
         self._flags = None
+        pending = {} if self.flag_queue is None else self.flag_queue.pending(self)
+        if pending:
+            mask = self._get_flags()
+            for flag, state in pending.items():
+                mask = mask | flag.bit if state else mask & ~flag.bit
+            self._flags = mask
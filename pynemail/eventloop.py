@@ -0,0 +1,111 @@
+import collections
+import heapq
+import itertools
+import os
+import selectors
+import threading
+import time
+
+from typing import Callable, Deque, List, Optional, Tuple
+
+
+class Timer:
+    """A callback scheduled by EventLoop.call_later(), which may be cancelled before it runs."""
+
+    def __init__(self, when: float, callback: Callable[[], None]) -> None:
+        self.when = when
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self) -> None:
+        self.cancelled = True
+
+
+class EventLoop:
+    """A minimal single-threaded event loop, waiting on file descriptors, timers and wakeups from other threads.
+
+    The loop sleeps in a single select() call until something happens, so an idle UI uses no CPU, and input is handled
+    as soon as it arrives. Background threads hand results back to the UI thread with call_soon_threadsafe(), which
+    wakes the loop through a pipe.
+    """
+
+    def __init__(self) -> None:
+        self._selector = selectors.DefaultSelector()
+        self._timers = []  # type: List[Tuple[float, int, Timer]]
+        self._sequence = itertools.count()
+        self._ready = collections.deque()  # type: Deque[Callable[[], None]]
+        self._lock = threading.Lock()
+        self._running = False
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        os.set_blocking(self._wakeup_read, False)
+        os.set_blocking(self._wakeup_write, False)
+        self.add_reader(self._wakeup_read, self._drain_wakeups)
+
+    def add_reader(self, fd: int, callback: Callable[[], None]) -> None:
+        self._selector.register(fd, selectors.EVENT_READ, callback)
+
+    def remove_reader(self, fd: int) -> None:
+        self._selector.unregister(fd)
+
+    def call_later(self, delay: float, callback: Callable[[], None]) -> Timer:
+        timer = Timer(time.monotonic() + delay, callback)
+        heapq.heappush(self._timers, (timer.when, next(self._sequence), timer))
+        return timer
+
+    def call_soon_threadsafe(self, callback: Callable[[], None]) -> None:
+        """Schedule a callback to run on the loop's thread; this may be called from any thread."""
+        with self._lock:
+            self._ready.append(callback)
+        try:
+            os.write(self._wakeup_write, b'\0')
+        except BlockingIOError:
+            pass  # The pipe is full, so the loop is bound to wake up anyway.
+
+    def _drain_wakeups(self) -> None:
+        try:
+            while os.read(self._wakeup_read, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _timeout(self) -> Optional[float]:
+        if self._ready:
+            return 0
+        while self._timers and self._timers[0][2].cancelled:
+            heapq.heappop(self._timers)
+        if not self._timers:
+            return None
+        return max(0, self._timers[0][0] - time.monotonic())
+
+    def run_once(self) -> None:
+        """Wait for the next batch of events, and run all their callbacks."""
+        for key, _ in self._selector.select(self._timeout()):
+            key.data()
+        now = time.monotonic()
+        while self._timers and self._timers[0][0] <= now:
+            _, _, timer = heapq.heappop(self._timers)
+            if not timer.cancelled:
+                timer.callback()
+        with self._lock:
+            ready, self._ready = self._ready, collections.deque()
+        for callback in ready:
+            callback()
+
+    def run(self, after: Optional[Callable[[], None]] = None) -> None:
+        """Run until stop() is called.
+
+        :param callable after: Called after each batch of events, e.g. to redraw the screen once for all of them.
+        """
+        self._running = True
+        while self._running:
+            self.run_once()
+            if self._running and after is not None:
+                after()
+
+    def stop(self) -> None:
+        self._running = False
+
+    def close(self) -> None:
+        self._selector.close()
+        os.close(self._wakeup_read)
+        os.close(self._wakeup_write)
@@ -0,0 +1,62 @@
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from .email import Email, EmailFlag, FlagChanges
+
+
+FLUSH_DELAY = 0.5
+
+
+class FlagQueue:
+    """Collect flag changes and write them to the mail store in batches.
+
+    Emails update their own flags as soon as they're changed, so the UI never waits for the mail store. The changes
+    are written ``delay`` seconds after the first one, so marking a run of emails, or reading quickly through an
+    inbox, costs one round of I/O rather than one per email. Setting and then unsetting a flag before the queue is
+    flushed cancels out.
+
+    :param callable write: Writes a batch of changes, grouped by (flag, state), to the mail store.
+    :param callable call_later: Schedules a callback after a delay, e.g. ``EventLoop.call_later``; it must return an
+        object with a ``cancel()`` method.
+    :param float delay: How long to wait for more changes before writing them, in seconds.
+    """
+
+    def __init__(self, write: Callable[[FlagChanges], None], call_later: Callable[[float, Callable[[], None]], Any],
+                 delay: float = FLUSH_DELAY) -> None:
+        self.write = write
+        self.call_later = call_later
+        self.delay = delay
+        self._changes = OrderedDict()  # type: Dict[Tuple[int, EmailFlag], Tuple[Email, bool, bool]]
+        self._timer = None  # type: Optional[Any]
+
+    def __len__(self) -> int:
+        return len(self._changes)
+
+    def add(self, email: Email, flag: EmailFlag, state: bool) -> None:
+        """Queue a change that has already been made to the email's flags in memory."""
+        key = (id(email), flag)
+        _, original, _ = self._changes.get(key, (email, not state, state))
+        if state == original:
+            del self._changes[key]
+        else:
+            self._changes[key] = (email, original, state)
+        if self._changes and self._timer is None:
+            self._timer = self.call_later(self.delay, self.flush)
+
+    def pending(self, email: Email) -> Dict[EmailFlag, bool]:
+        """Return the changes queued for the given email, as the state each flag is to be written with."""
+        if not self._changes:
+            return {}
+        return {flag: self._changes[(id(email), flag)][2] for flag in EmailFlag if (id(email), flag) in self._changes}
+
+    def flush(self) -> None:
+        """Write all the queued changes now."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        changes, self._changes = self._changes, OrderedDict()
+        batches = OrderedDict()  # type: FlagChanges
+        for (_, flag), (email, _, state) in changes.items():
+            batches.setdefault((flag, state), []).append(email)
+        if batches:
+            self.write(batches)
@@ -1,74 +1,339 @@
 import getpass
 import imaplib
+import os
+import select
+import threading
 import time
 
+from concurrent.futures import Future, ThreadPoolExecutor
 from contextlib import contextmanager
-from enum import Enum
-from typing import List, Dict, Generator
+from email.message import EmailMessage
+from typing import Callable, Dict, Generator, List, Optional, Tuple
 
-from .email import Email, EmailFlag
+from .email import Email, FlagChanges, PREVIEW_SIZE, summary_from_headers
+from .imappool import ImapClient, checkout
+from .imapparse import (
+    MAP_FLAG_TO_IMAP, ImapUpdate, compress_sequence_set, fetch_item, find_text_section, parse_imap_flags,
+    parse_imap_list, parse_imap_updates, parse_uid_fetch_response, part_headers, pending_updates, section_part,
+)
+from .mimestream import decode_text_part, extract_preview
+from .stats import timed
 
 
-MAP_FLAG_TO_IMAP = {
-    EmailFlag.ANSWERED: r'Answered',
-    EmailFlag.SEEN: r'\Seen',
-    EmailFlag.FLAGGED: r'\Flagged',
-    EmailFlag.DELETED: r'\Deleted',
-    EmailFlag.DRAFT: r'\Draft',
-}  # type: Dict[EmailFlag, str]
+SUMMARY_FIELDS = 'FROM TO SUBJECT DATE MESSAGE-ID IN-REPLY-TO REFERENCES'
+SUMMARY_FETCH_ITEMS = '(FLAGS BODY.PEEK[HEADER.FIELDS ({})])'.format(SUMMARY_FIELDS)
+FLAGS_FETCH_ITEMS = '(FLAGS)'
+SUMMARY_BATCH_SIZE = 2000
 
+# imaplib only knows about ENABLE (RFC 5161) from Python 3.9.
+imaplib.Commands.setdefault('ENABLE', ('AUTH', ))
 
-def parse_imap_flags(flagstr: List[bytes]) -> List[EmailFlag]:
-    parsed_flag_strings = [f.decode() for f in imaplib.ParseFlags(flagstr[0])]
-    flags = []
-    for flag in EmailFlag:
-        if MAP_FLAG_TO_IMAP[flag] in parsed_flag_strings:
-            flags.append(flag)
-    return flags
+
+@timed('imap.fetch')
+def fetch_imap_body(client: ImapClient, uid: int) -> Optional[str]:
+    """Fetch and decode just the plain text body of a message, using its BODYSTRUCTURE to find it.
+
+    Attachments and alternative parts are never downloaded, and BODY.PEEK is used so the message isn't marked as read.
+
+    :param int uid: The message's UID.
+    :return: The text, or None if the message doesn't have a plain text body.
+    :rtype: str
+    """
+    with checkout(client) as con:
+        return _fetch_imap_body(con, uid)
+
+
+def _fetch_imap_body(client: imaplib.IMAP4, uid: int) -> Optional[str]:
+    _, data = client.uid('FETCH', str(uid), '(BODYSTRUCTURE)')
+    structure = fetch_item(parse_imap_list(data), b'BODYSTRUCTURE')
+    section = find_text_section(structure) if isinstance(structure, list) else None
+    if section is None:
+        return None
+    _, data = client.uid('FETCH', str(uid), '(BODY.PEEK[{}])'.format(section))
+    payload = fetch_item(parse_imap_list(data), b'BODY[') or b''
+    return decode_text_part(part_headers(section_part(structure, section)) + payload)
+
+
+@timed('imap.fetch')
+def fetch_imap_preview(client: ImapClient, uid: int, size: int = PREVIEW_SIZE) -> Optional[str]:
+    """Fetch and decode the start of a message's plain text body, fetching no more than ``size`` bytes of it at once.
+
+    A single FETCH asks for the BODYSTRUCTURE and the start of the message's TEXT, which is usually enough to find the
+    start of the text part, even in a multipart message. If it isn't, e.g. because the text follows an attachment, the
+    start of the text part itself is fetched, using the section found in the BODYSTRUCTURE.
+
+    :param int uid: The message's UID.
+    :return: The start of the text, or None if the message doesn't have a plain text body.
+    :rtype: str
+    """
+    with checkout(client) as con:
+        _, data = con.uid('FETCH', str(uid), '(BODYSTRUCTURE BODY.PEEK[TEXT]<0.{}>)'.format(size))
+        response = parse_imap_list(data)
+        structure = fetch_item(response, b'BODYSTRUCTURE')
+        section = find_text_section(structure) if isinstance(structure, list) else None
+        if section is None:
+            return None
+        text = fetch_item(response, b'BODY[TEXT]') or b''
+        preview = extract_preview(part_headers(structure) + text, size, len(text) < size)
+        if preview is not None or not isinstance(structure[0], list):
+            return preview
+        _, data = con.uid('FETCH', str(uid), '(BODY.PEEK[{}]<0.{}>)'.format(section, size))
+    payload = fetch_item(parse_imap_list(data), b'BODY[') or b''
+    return extract_preview(part_headers(section_part(structure, section)) + payload, size, len(payload) < size)
+
+
+@timed('imap.fetch')
+def fetch_imap_message(client: ImapClient, uid: int) -> EmailMessage:
+    """Fetch and parse a whole message, by UID, using BODY.PEEK so that it isn't marked as read."""
+    with checkout(client) as con:
+        _, data = con.uid('FETCH', str(uid), '(BODY.PEEK[])')
+    return Email.parser.parsebytes(data[0][1])
+
+
+@timed('imap.store')
+def store_imap_flags(client: ImapClient, changes: FlagChanges) -> None:
+    """Write a batch of flag changes, with one STORE for each flag and state covering all the affected messages.
+
+    The server replies with the new flags of every message it changed, which are used to update the emails rather
+    than fetching their flags again.
+    """
+    with checkout(client) as con:
+        for mail, flags in _store_imap_flags(con, changes):
+            mail._flags = flags
+
+
+def _store_imap_flags(client: imaplib.IMAP4, changes: FlagChanges) -> List[Tuple['ImapEmail', int]]:
+    stored = []  # type: List[Tuple[ImapEmail, int]]
+    for (flag, state), mails in changes.items():
+        by_uid = {mail.uid(): mail for mail in mails}
+        command = '+FLAGS' if state else '-FLAGS'
+        _, data = client.uid('STORE', compress_sequence_set(by_uid), command, MAP_FLAG_TO_IMAP[flag])
+        for uid, result in parse_uid_fetch_response(data).items():
+            flags = result.flags()
+            if uid in by_uid and flags is not None:
+                stored.append((by_uid[uid], flags))
+    return stored
+
+
+class ImapFlagWriter:
+    """Write batches of flag changes on a background connection, so flushing a FlagQueue never waits for the server.
+
+    The batches are written in order, by a single worker. The server's replies are handed back through ``call_soon``,
+    e.g. ``EventLoop.call_soon_threadsafe``, so the emails' flags are only ever updated on the UI thread, and only if
+    they haven't been changed again in the meantime, as a later batch will bring those changes back.
+
+    :param client: The ImapPool (or connection) to use; its background connections are used.
+    :param callable call_soon: Runs a callback on the UI thread.
+    """
+
+    def __init__(self, client: ImapClient, call_soon: Callable[[Callable[[], None]], None]) -> None:
+        self.client = client
+        self.call_soon = call_soon
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = []  # type: List[Future]
+
+    def write(self, changes: FlagChanges) -> None:
+        """Queue a batch of changes, as for store_imap_flags()."""
+        written = {id(mail): mail._flags for batch in changes.values() for mail in batch}
+        self._pending = [future for future in self._pending if not future.done()]
+        self._pending.append(self.executor.submit(self._store, changes, written))
+
+    @timed('imap.store')
+    def _store(self, changes: FlagChanges, written: Dict[int, Optional[int]]) -> None:
+        with checkout(self.client, interactive=False) as con:
+            stored = _store_imap_flags(con, changes)
+
+        def apply():
+            for mail, flags in stored:
+                if mail._flags == written[id(mail)]:
+                    mail._flags = flags
+        self.call_soon(apply)
+
+    def wait(self) -> None:
+        """Wait until every batch so far has been written, e.g. before an EXPUNGE, raising the first error, if any."""
+        pending, self._pending = self._pending, []
+        for future in pending:
+            future.result()
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
 
 
 class ImapEmail(Email):
+    """A message in an IMAP mailbox, addressed by its UID, so it can be fetched on any connection to the mailbox."""
+
+    __slots__ = ('_uid', '_imapcon')
 
-    def __init__(self, imapcon: imaplib.IMAP4, num: int) -> None:
+    def __init__(self, imapcon: ImapClient, uid: int) -> None:
         super().__init__()
-        self._num = num
+        self._uid = int(uid)
         self._imapcon = imapcon
         self.clear()
 
+    @timed('imap.fetch')
     def _get_headers(self):
-        _, data = self._imapcon.fetch(self._num, '(RFC822.HEADER)')
+        with checkout(self._imapcon) as con:
+            _, data = con.uid('FETCH', str(self._uid), '(RFC822.HEADER)')
         return self.parser.parsebytes(data[0][1])
 
     def _get_message(self):
-        _, data = self._imapcon.fetch(self._num, '(RFC822)')
-        return self.parser.parsebytes(data[0][1])
+        return fetch_imap_message(self._imapcon, self._uid)
 
+    def _get_body(self):
+        return fetch_imap_body(self._imapcon, self._uid)
+
+    def _get_preview(self):
+        return fetch_imap_preview(self._imapcon, self._uid)
+
+    @timed('imap.fetch')
     def _get_flags(self):
-        _, flagstr = self._imapcon.fetch(self._num, '(FLAGS)')
+        with checkout(self._imapcon) as con:
+            _, flagstr = con.uid('FETCH', str(self._uid), '(FLAGS)')
         return parse_imap_flags(flagstr)
 
-    def set_flag(self, flag: EmailFlag, state: bool) -> None:
-        command = '+FLAGS' if state else '-FLAGS'
-        assert flag in MAP_FLAG_TO_IMAP
-        imap_flag = MAP_FLAG_TO_IMAP[flag]
-        self._imapcon.store(self._num, command, imap_flag)
-        self.clear_flags()
+    def uid(self) -> int:
+        return self._uid
 
+    def _write_flags(self, changes):
+        store_imap_flags(self._imapcon, changes)
 
-def poll_imap_server(client, new_mail_event):
-    while True:
-        recent_mail = client.recent()[1][0]
-        if recent_mail is not None:
-            new_mail_event.set()
-        time.sleep(10)
 
+class _UnbufferedReader:
+    """Read from a socket without any buffering in user space, so that select() on the socket can be trusted."""
 
-@contextmanager
-def imap_client(server: str, password: str) -> Generator:
-    server, port = server.split(':') if ':' in server else server, imaplib.IMAP4_PORT
-    M = imaplib.IMAP4(host=server, port=port)
+    def __init__(self, sock) -> None:
+        self._raw = sock.makefile('rb', buffering=0)
+
+    def readline(self, limit: int = -1) -> bytes:
+        return self._raw.readline(limit)
+
+    def read(self, size: int) -> bytes:
+        chunks = []
+        while size > 0:
+            chunk = self._raw.read(size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def close(self) -> None:
+        self._raw.close()
+
+
+class ImapIdleWatcher(threading.Thread):
+    """Watch a mailbox for changes on a dedicated connection, using IDLE (RFC 2177) if the server supports it.
+
+    Untagged EXISTS, EXPUNGE, FETCH (FLAGS) and VANISHED responses are parsed into ImapUpdates and passed to
+    ``on_updates``, on the watcher's thread. Servers without IDLE are polled with NOOP instead.
+    """
+
+    IDLE_TIMEOUT = 29 * 60  # Servers may drop idle clients after 30 minutes.
+    POLL_INTERVAL = 10
+
+    def __init__(self, connect: Callable[[], imaplib.IMAP4], on_updates: Callable[[List[ImapUpdate]], None]) -> None:
+        super().__init__(daemon=True)
+        self._connect = connect
+        self._on_updates = on_updates
+        self._stopped = threading.Event()
+        self._wakeup_read, self._wakeup_write = os.pipe()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        os.write(self._wakeup_write, b'\0')
+        self.join()
+        os.close(self._wakeup_read)
+        os.close(self._wakeup_write)
+
+    def run(self) -> None:
+        con = self._connect()
+        try:
+            if 'IDLE' in con.capabilities:
+                con.file.close()
+                con.file = _UnbufferedReader(con.sock)
+                while not self._stopped.is_set():
+                    self._idle(con)
+            else:
+                while not self._stopped.wait(self.POLL_INTERVAL):
+                    self._poll(con)
+        except (imaplib.IMAP4.error, OSError):
+            pass  # The watcher is a convenience; the UI keeps working without it.
+        finally:
+            try:
+                con.logout()
+            except (imaplib.IMAP4.error, OSError):
+                pass
+
+    def _idle(self, con: imaplib.IMAP4) -> None:
+        tag = con._new_tag()
+        con.send(tag + b' IDLE\r\n')
+        line = con.readline()
+        while line.startswith(b'* '):
+            self._dispatch([line])
+            line = con.readline()
+        if not line.startswith(b'+'):
+            raise imaplib.IMAP4.error('IDLE refused: {}'.format(line))
+        deadline = time.monotonic() + self.IDLE_TIMEOUT
+        while not self._stopped.is_set():
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            readable, _, _ = select.select([con.sock, self._wakeup_read], [], [], timeout)
+            if con.sock in readable:
+                line = con.readline()
+                if not line:
+                    raise imaplib.IMAP4.abort('connection closed during IDLE')
+                self._dispatch([line])
+        con.send(b'DONE\r\n')
+        lines = []
+        line = con.readline()
+        while not line.startswith(tag):
+            if not line:
+                raise imaplib.IMAP4.abort('connection closed while ending IDLE')
+            lines.append(line)
+            line = con.readline()
+        self._dispatch(lines)
+
+    def _poll(self, con: imaplib.IMAP4) -> None:
+        updates = poll_imap_updates(con)
+        if updates:
+            self._on_updates(updates)
+
+    def _dispatch(self, lines: List[bytes]) -> None:
+        updates = [update for line in lines for update in parse_imap_updates(line)]
+        if updates:
+            self._on_updates(updates)
+
+
+def poll_imap_updates(client: ImapClient) -> List[ImapUpdate]:
+    """Send a NOOP, and collect the updates the connection has received in reply; see pending_updates()."""
+    with checkout(client) as con:
+        con.noop()
+        return pending_updates(con)
+
+
+def connect_imap(server: str, password: str) -> imaplib.IMAP4:
+    """Open a new connection to the server, logged in and with the inbox selected.
+
+    QRESYNC, or failing that CONDSTORE, is enabled if the server supports it, which has to happen before the SELECT.
+    From then on, the server reports expunges as VANISHED UIDs rather than sequence numbers.
+    """
+    host, _, port = server.partition(':')
+    M = imaplib.IMAP4(host=host, port=int(port) if port else imaplib.IMAP4_PORT)
     M.login(getpass.getuser(), password)
+    if 'ENABLE' in M.capabilities:
+        for extension in ('QRESYNC', 'CONDSTORE'):
+            if extension in M.capabilities:
+                M._simple_command('ENABLE', extension)
+                M.untagged_responses.pop('ENABLED', None)
+                break
     M.select()
+    return M
+
+
+@contextmanager
+def imap_client(server: str, password: str) -> Generator:
+    M = connect_imap(server, password)
     try:
         yield M
     finally:
@@ -76,7 +341,34 @@ def imap_client(server: str, password: str) -> Generator:
         M.logout()
 
 
-def get_mail_from_imap(client: imaplib.IMAP4) -> List[ImapEmail]:
-    _, data = client.search("", 'ALL')
-    mails = [ImapEmail(client, num) for num in data[0].split()]
-    return list(reversed(mails))
+@timed('imap.fetch')
+def load_imap_summaries(client: ImapClient, mails: List[ImapEmail],
+                        batch_size: int = SUMMARY_BATCH_SIZE) -> None:
+    """Fill the header and flag caches of the given emails using as few FETCH commands as possible.
+
+    Only the headers needed to list the emails are fetched, using BODY.PEEK so that nothing is marked as read, and
+    only the flags of those whose summary is already known, e.g. from an ImapIndex.
+
+    :param client: The connection (or ImapPool) the emails belong to.
+    :param list[ImapEmail] mails: The emails to load; any already loaded are skipped.
+    :param int batch_size: The maximum number of messages requested by a single FETCH.
+    """
+    pending = {m.uid(): m for m in mails if m._summary is None or m._flags is None}
+    if not pending:
+        return
+    headers = sorted(uid for uid, mail in pending.items() if mail._summary is None)
+    flags_only = sorted(uid for uid, mail in pending.items() if mail._summary is not None)
+    with checkout(client) as con:
+        for uids, items in ((headers, SUMMARY_FETCH_ITEMS), (flags_only, FLAGS_FETCH_ITEMS)):
+            for i in range(0, len(uids), batch_size):
+                _, data = con.uid('FETCH', compress_sequence_set(uids[i:i + batch_size]), items)
+                for uid, result in parse_uid_fetch_response(data).items():
+                    mail = pending.get(uid)
+                    if mail is None:
+                        continue
+                    header = result.literal(b'BODY[HEADER')
+                    if header is not None:
+                        mail._summary = summary_from_headers(mail.header_parser.parsebytes(header))
+                    flags = result.flags()
+                    if flags is not None:
+                        mail._flags = flags
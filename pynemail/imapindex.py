@@ -0,0 +1,120 @@
+import hashlib
+import pathlib
+import sqlite3
+
+from contextlib import contextmanager
+from typing import Dict, Generator, Iterable, Optional, Set, Tuple
+
+from .email import SUMMARY_HEADERS
+from .maildirindex import cache_dir
+
+
+SCHEMA_VERSION = 1
+
+ImapIndexEntry = Tuple[Optional[int], Optional[Tuple[str, ...]]]
+
+
+def default_imap_index_path(server: str, user: str, mailbox: str = 'INBOX') -> pathlib.Path:
+    digest = hashlib.sha1('imap://{}@{}/{}'.format(user, server, mailbox).encode()).hexdigest()
+    return cache_dir() / (digest + '.sqlite')
+
+
+class ImapIndex:
+    """A persistent record of the UIDs in an IMAP mailbox, with the summary headers and flags of each message.
+
+    A UID only identifies the same message while the mailbox's UIDVALIDITY is unchanged, so the entries are stored
+    alongside it, and forgotten by ``reset()`` when it changes. A message's summary never changes, but its flags can,
+    so they're stored alongside the mailbox's HIGHESTMODSEQ (RFC 7162) at the time, and are only as good as the
+    server's answer to what has changed since then.
+    """
+
+    def __init__(self, path: pathlib.Path) -> None:
+        self._columns = ['header_' + name.lower().replace('-', '_') for name in SUMMARY_HEADERS]
+        self._db = sqlite3.connect(str(path))
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._create_schema()
+        self.uidvalidity = None  # type: Optional[int]
+        self.highestmodseq = None  # type: Optional[int]
+        self._entries = {}  # type: Dict[int, ImapIndexEntry]
+        self._load()
+
+    def _create_schema(self) -> None:
+        version = self._db.execute('PRAGMA user_version').fetchone()[0]
+        if version != SCHEMA_VERSION:
+            self._db.execute('DROP TABLE IF EXISTS mailbox')
+            self._db.execute('DROP TABLE IF EXISTS messages')
+        self._db.execute('CREATE TABLE IF NOT EXISTS mailbox (name TEXT PRIMARY KEY, value INTEGER)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS messages (uid INTEGER PRIMARY KEY, flags INTEGER, {})'
+                         .format(', '.join('{} TEXT'.format(c) for c in self._columns)))
+        self._db.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+        self._db.commit()
+
+    def _load(self) -> None:
+        state = dict(self._db.execute('SELECT name, value FROM mailbox'))
+        self.uidvalidity = state.get('uidvalidity')
+        self.highestmodseq = state.get('highestmodseq')
+        rows = self._db.execute('SELECT uid, flags, {} FROM messages'.format(', '.join(self._columns)))
+        for row in rows:
+            self._entries[row[0]] = (row[1], None if row[2] is None else tuple(row[2:]))
+
+    def __contains__(self, uid: int) -> bool:
+        return uid in self._entries
+
+    def uids(self) -> Set[int]:
+        return set(self._entries)
+
+    def lookup(self, uid: int) -> Optional[ImapIndexEntry]:
+        """Return the stored flags and summary of a message, either of which may be None if they weren't known.
+
+        :return: The flags and summary, or None if the UID isn't in the index.
+        :rtype: tuple
+        """
+        return self._entries.get(uid)
+
+    def store(self, uid: int, flags: Optional[int], summary: Optional[Tuple[str, ...]] = None) -> None:
+        """Record a message's flags and summary; a summary of None keeps the one already stored, if any."""
+        old = self._entries.get(uid)
+        if summary is None and old is not None:
+            summary = old[1]
+        if old == (flags, summary):
+            return
+        self._entries[uid] = (flags, summary)
+        placeholders = ', '.join('?' * len(self._columns))
+        self._db.execute('INSERT OR REPLACE INTO messages VALUES (?, ?, {})'.format(placeholders),
+                         [uid, flags] + list(summary or (None, ) * len(self._columns)))
+
+    def remove(self, uids: Iterable[int]) -> None:
+        uids = [uid for uid in uids if uid in self._entries]
+        for uid in uids:
+            del self._entries[uid]
+        self._db.executemany('DELETE FROM messages WHERE uid = ?', ((uid, ) for uid in uids))
+
+    def reset(self, uidvalidity: int) -> None:
+        """Forget every message, as the mailbox's UIDs have been reassigned."""
+        self._entries.clear()
+        self._db.execute('DELETE FROM messages')
+        self.set_state(uidvalidity, None)
+
+    def set_state(self, uidvalidity: int, highestmodseq: Optional[int]) -> None:
+        self.uidvalidity, self.highestmodseq = uidvalidity, highestmodseq
+        self._db.executemany('INSERT OR REPLACE INTO mailbox VALUES (?, ?)',
+                             [('uidvalidity', uidvalidity), ('highestmodseq', highestmodseq)])
+
+    def commit(self) -> None:
+        self._db.commit()
+
+    def close(self) -> None:
+        self._db.commit()
+        self._db.close()
+
+
+@contextmanager
+def imap_index(server: str, user: str, mailbox: str = 'INBOX', path: Optional[pathlib.Path] = None) -> Generator:
+    path = default_imap_index_path(server, user, mailbox) if path is None else path
+    path.parent.mkdir(parents=True, exist_ok=True)
+    index = ImapIndex(path)
+    try:
+        yield index
+    finally:
+        index.close()
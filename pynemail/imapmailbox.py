@@ -0,0 +1,273 @@
+import imaplib
+
+from typing import Dict, List, Optional, Set, Tuple
+
+from .email import EmailFlag, FLAG_BITS
+from .imapclient import FLAGS_FETCH_ITEMS, ImapEmail, load_imap_summaries
+from .imapindex import ImapIndex
+from .imappool import ImapClient, checkout
+from .imapparse import (
+    ImapUpdate, compress_sequence_set, parse_fetch_response, parse_uid_fetch_response, pending_updates,
+    pending_vanished,
+)
+from .imapsearch import run_imap_search, search_imap
+from .stats import timed
+
+
+def _last_number(values: list) -> Optional[int]:
+    numbers = [int(value) for value in values if isinstance(value, bytes) and value.isdigit()]
+    return numbers[-1] if numbers else None
+
+
+def select_imap_mailbox(client: imaplib.IMAP4) -> Tuple[int, Optional[int], Optional[int]]:
+    """Select the mailbox again, to get its state as of now, and start from a clean slate of untagged responses.
+
+    :return: The number of messages, the UIDVALIDITY and, if the server supports CONDSTORE, the HIGHESTMODSEQ.
+    :rtype: tuple
+    """
+    _, data = client.select()
+    exists = _last_number(data) or 0
+    uidvalidity = _last_number(client.untagged_responses.pop('UIDVALIDITY', []))
+    highestmodseq = _last_number(client.untagged_responses.pop('HIGHESTMODSEQ', []))
+    return exists, uidvalidity, highestmodseq
+
+
+def fetch_imap_flags(client: imaplib.IMAP4, changedsince: Optional[int] = None,
+                     vanished: bool = False) -> Tuple[Dict[int, int], Set[int]]:
+    """Fetch the flags of every message or, with CONDSTORE, only of those changed since a MODSEQ.
+
+    :param int changedsince: The HIGHESTMODSEQ of the mailbox when its flags were last known.
+    :param bool vanished: Ask for the UIDs of the messages expunged since then too, which needs QRESYNC.
+    :return: The flags by UID, and the UIDs that have been expunged.
+    :rtype: tuple[dict[int, int], set[int]]
+    """
+    items = FLAGS_FETCH_ITEMS
+    if changedsince is not None:
+        items += ' (CHANGEDSINCE {}{})'.format(changedsince, ' VANISHED' if vanished else '')
+    _, data = client.uid('FETCH', '1:*', items)
+    flags = {}  # type: Dict[int, int]
+    for uid, result in parse_uid_fetch_response(data).items():
+        mask = result.flags()
+        if mask is not None:
+            flags[uid] = mask
+    expunged = {update.num for update in pending_vanished(client)} if vanished else set()
+    return flags, expunged
+
+
+class ImapMailbox:
+    """The selected mailbox, as the interactive connection sees it, listed as ImapEmails addressed by UID.
+
+    UIDs, unlike sequence numbers, don't change when other messages are expunged, so the emails can be fetched on any
+    of an ImapPool's connections. The EXPUNGE and FETCH responses the interactive connection receives still use
+    sequence numbers, though, so the mailbox keeps every UID, in sequence number order, to follow them.
+
+    Whenever the interactive connection is a new one, i.e. on startup or after the last one was dropped, the mailbox is
+    resynchronised. If its UIDVALIDITY hasn't changed, and the server supports CONDSTORE (RFC 7162), only the flags
+    that have changed since the last HIGHESTMODSEQ are fetched; with QRESYNC, the UIDs of the messages expunged since
+    then come with them, so the UIDs don't have to be listed again either. With an ImapIndex, all of that, and the
+    summaries, is kept between runs.
+
+    :param client: The connection (or ImapPool) to use.
+    :param ImapIndex index: Where to keep the UIDs, flags and summaries between runs, if anywhere.
+    :param str criteria: The SEARCH criteria of the messages to list; see search_imap().
+    :param str sort: The order to list them in; see search_imap().
+    """
+
+    def __init__(self, client: ImapClient, index: Optional[ImapIndex] = None, criteria: str = 'ALL',
+                 sort: Optional[str] = None) -> None:
+        self.client = client
+        self.index = index
+        self.criteria = criteria
+        self.sort = sort
+        self.uidvalidity = None if index is None else index.uidvalidity
+        self.highestmodseq = None if index is None else index.highestmodseq
+        self.uids = []  # type: List[int]
+        self._emails = {}  # type: Dict[int, ImapEmail]
+        self._connection = None  # type: Optional[imaplib.IMAP4]
+
+    def _email(self, uid: int) -> ImapEmail:
+        mail = self._emails.get(uid)
+        if mail is None:
+            mail = self._emails[uid] = ImapEmail(self.client, uid)
+            entry = None if self.index is None else self.index.lookup(uid)
+            if entry is not None:
+                flags, mail._summary = entry
+                if self.highestmodseq is not None:
+                    mail._flags = flags
+        return mail
+
+    @timed('imap.sync')
+    def _resync(self, client: imaplib.IMAP4) -> None:
+        exists, uidvalidity, highestmodseq = select_imap_mailbox(client)
+        if uidvalidity != self.uidvalidity:
+            # Every UID refers to a different message now, if any.
+            self.uids, self.highestmodseq = [], None
+            self._emails.clear()
+            if self.index is not None:
+                self.index.reset(uidvalidity)
+            self.uidvalidity = uidvalidity
+        known = self.uids or (sorted(self.index.uids()) if self.index is not None else [])
+        changed = {}  # type: Dict[int, int]
+        uids = None  # type: Optional[List[int]]
+        condstore = highestmodseq is not None and self.highestmodseq is not None
+        if condstore and exists:
+            qresync = 'QRESYNC' in client.capabilities and bool(known)
+            changed, vanished = fetch_imap_flags(client, self.highestmodseq, qresync)
+            if qresync:
+                uids = sorted({uid for uid in known if uid not in vanished} | set(changed))
+                if len(uids) != exists:
+                    uids = None  # Something's been missed, so list them after all.
+        self.uids = run_imap_search(client, 'ALL', None)[::-1] if uids is None else uids
+        present = set(self.uids)
+        for uid in [uid for uid in self._emails if uid not in present]:
+            del self._emails[uid]
+        if self.index is not None:
+            self.index.remove(self.index.uids() - present)
+        if condstore:
+            for uid, flags in changed.items():
+                mail = self._emails.get(uid)
+                if mail is not None:
+                    mail._flags = flags
+                elif self.index is not None:
+                    self.index.store(uid, flags)
+        else:
+            # Nothing says which flags have changed, so they all have to be fetched again.
+            for mail in self._emails.values():
+                mail._flags = None
+        self.highestmodseq = highestmodseq
+        self._connection = client
+
+    def list(self, preload: bool = True) -> List[ImapEmail]:
+        """List the messages matching the criteria, in order; see search_imap().
+
+        :param bool preload: Fetch the summaries of every message that isn't in the index as well.
+        """
+        with checkout(self.client) as con:
+            if con is not self._connection:
+                self._resync(con)
+            if self.criteria == 'ALL' and self.sort in (None, 'arrival'):
+                uids = self.uids[::-1]  # Newest first, which is all there is to it.
+            else:
+                uids = run_imap_search(con, self.criteria, self.sort)
+            mails = [self._email(uid) for uid in uids]
+        if preload:
+            load_imap_summaries(self.client, mails)
+        return mails
+
+    def refresh(self, mails: List[ImapEmail]) -> List[ImapEmail]:
+        """Bring a list of emails from list() up to date, with a NOOP and any updates the server sends in reply.
+
+        If the interactive connection is a new one, its updates would be meaningless, so the mailbox is resynchronised
+        and listed again instead, without preloading anything.
+        """
+        with checkout(self.client) as con:
+            if con is not self._connection:
+                return self.list(preload=False)
+            con.noop()
+            return self.apply(mails, pending_updates(con))
+
+    def apply(self, mails: List[ImapEmail], updates: List[ImapUpdate]) -> List[ImapEmail]:
+        """Apply updates received on the interactive connection to a list of emails, newest first.
+
+        Sequence numbers are specific to a connection, so the updates must come from the interactive one, e.g. through
+        poll_imap_updates(), rather than from an ImapIdleWatcher.
+
+        New messages are added to the top of the list, or if it's sorted, the server sorts the list again with the new
+        messages in it. If the list is filtered, only those matching the criteria are added, which the server checks
+        with a SEARCH over just the new messages.
+
+        :return: The updated list of emails.
+        :rtype: list[ImapEmail]
+        """
+        removed = {update.num for update in updates if update.kind == 'VANISHED'}
+        if removed:
+            self.uids = [uid for uid in self.uids if uid not in removed]
+        added = []  # type: List[int]
+        for update in updates:
+            if update.kind == 'EXPUNGE':
+                if 0 < update.num <= len(self.uids):
+                    removed.add(self.uids.pop(update.num - 1))
+            elif update.kind == 'FETCH':
+                mail = self._emails.get(self.uids[update.num - 1]) if 0 < update.num <= len(self.uids) else None
+                if mail is not None:
+                    mail._flags = update.flags
+            elif update.kind == 'EXISTS' and update.num > len(self.uids):
+                with checkout(self.client) as con:
+                    _, data = con.fetch('{}:{}'.format(len(self.uids) + 1, update.num), '(UID)')
+                results = parse_fetch_response(data)
+                new = [results[num].uid() for num in sorted(results)]
+                self.uids.extend(uid for uid in new if uid is not None)
+                added.extend(uid for uid in new if uid is not None)
+        for uid in removed:
+            self._emails.pop(uid, None)
+        mails = [mail for mail in mails if mail.uid() not in removed]
+        if added:
+            if self.criteria != 'ALL':
+                added = search_imap(self.client, 'UID {} {}'.format(compress_sequence_set(added), self.criteria))
+            listed = {mail.uid() for mail in mails}
+            new_mails = [self._email(uid) for uid in sorted(added, reverse=True) if uid not in listed]
+            load_imap_summaries(self.client, new_mails)
+            mails = new_mails + mails
+            if new_mails and self.sort not in (None, 'arrival'):
+                mails = self._sorted(mails)
+        return mails
+
+    def _sorted(self, mails: List[ImapEmail]) -> List[ImapEmail]:
+        # The server sorts the listed UIDs, rather than the criteria, so emails that no longer match, e.g. UNSEEN
+        # ones that have since been read, stay in the list, as they would have without the new ones.
+        by_uid = {mail.uid(): mail for mail in mails}
+        order = search_imap(self.client, 'UID {}'.format(compress_sequence_set(list(by_uid))), self.sort)
+        sorted_mails = [by_uid.pop(uid) for uid in order if uid in by_uid]
+        return sorted_mails + [mail for mail in mails if mail.uid() in by_uid]
+
+    @timed('imap.expunge')
+    def expunge(self, mails: List[ImapEmail]) -> List[ImapEmail]:
+        """Permanently remove the given emails that are flagged as deleted, with a single EXPUNGE.
+
+        With UIDPLUS (RFC 4315), a UID EXPUNGE removes just those messages. Otherwise, a plain EXPUNGE also removes any
+        other message in the mailbox that's flagged as deleted, e.g. by another client.
+
+        :return: The emails that are left.
+        :rtype: list[ImapEmail]
+        """
+        deleted_bit = FLAG_BITS[EmailFlag.DELETED]
+        uids = sorted(m.uid() for m in mails if m._flags is not None and m._flags & deleted_bit)
+        with checkout(self.client) as con:
+            if 'UIDPLUS' not in con.capabilities:
+                _, data = con.expunge()
+            elif uids:
+                con.uid('EXPUNGE', compress_sequence_set(uids))
+                # imaplib hands back the untagged responses of a UID command as if it were a FETCH.
+                data = con.untagged_responses.pop('EXPUNGE', [])
+            else:
+                return mails
+            if con is not self._connection:
+                return self.list(preload=False)
+            updates = [ImapUpdate('EXPUNGE', int(num), None) for num in data if num]
+            updates.extend(pending_vanished(con))
+        return self.apply(mails, updates)
+
+    def save(self) -> None:
+        """Write the UIDs, and whatever is known about each message, to the index, if there is one."""
+        index = self.index
+        if index is None or self.uidvalidity is None:
+            return
+        index.remove(index.uids() - set(self.uids))
+        trusted = self.highestmodseq is not None
+        for uid in self.uids:
+            mail = self._emails.get(uid)
+            if mail is not None:
+                index.store(uid, mail._flags if trusted else None, mail._summary)
+            elif uid not in index:
+                index.store(uid, None)
+        index.set_state(self.uidvalidity, self.highestmodseq)
+        index.commit()
+
+
+def get_mail_from_imap(client: ImapClient, preload: bool = True, criteria: str = 'ALL',
+                       sort: Optional[str] = None) -> List[ImapEmail]:
+    """List the messages matching the criteria, newest first or in the given sort order; see search_imap()."""
+    mails = [ImapEmail(client, uid) for uid in search_imap(client, criteria, sort)]
+    if preload:
+        load_imap_summaries(client, mails)
+    return mails
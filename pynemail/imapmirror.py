@@ -0,0 +1,489 @@
+import imaplib
+import os
+import pathlib
+import re
+import socket
+import sqlite3
+import threading
+import time
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from .email import EmailFlag, FLAG_BITS
+from .imapmailbox import fetch_imap_flags, select_imap_mailbox
+from .imappool import ImapClient, ImapPool, checkout
+from .imapparse import MAP_FLAG_TO_IMAP, compress_sequence_set, parse_uid_fetch_response
+from .imapsearch import search_imap
+from .maildirclient import MAP_MAILDIR_TO_BIT, maildir_key, parse_maildir_flags, update_maildir_flags
+from .stats import timed
+
+
+SCHEMA_VERSION = 1
+STATE_FILENAME = '.pynemail-mirror.sqlite'
+SYNC_INTERVAL = 300.0
+
+# Messages at least this big are downloaded in chunks, on their own connection, so several download at once and an
+# interrupted download carries on from where it stopped.
+LARGE_MESSAGE_SIZE = 1024 * 1024
+CHUNK_SIZE = 256 * 1024
+# The total size of the smaller messages downloaded with each FETCH.
+DOWNLOAD_BATCH_SIZE = 4 * 1024 * 1024
+METADATA_BATCH_SIZE = 2000
+
+_MIRROR_KEY = re.compile(r'^\d+\.U\d+V\d+\.')
+_RFC822_SIZE = re.compile(rb'\bRFC822\.SIZE (\d+)', re.IGNORECASE)
+
+MirrorEntry = Tuple[Optional[str], int]
+NewMessage = Tuple[int, str, int, int]
+
+
+def mirror_key(uid: int, uidvalidity: int, internaldate: float) -> str:
+    """Build the unique part of a mirrored message's filename, which starts with its arrival time, like any other.
+
+    >>> mirror_key(42, 7, 1500000000.5).startswith('1500000000.U42V7.')
+    True
+    """
+    host = socket.gethostname().replace('/', r'\057').replace(':', r'\072')
+    return '{}.U{}V{}.{}'.format(int(internaldate), uid, uidvalidity, host)
+
+
+def maildir_flag_string(flags: int) -> str:
+    """Return the maildir flag characters for a bit mask of EmailFlag.bit values.
+
+    >>> maildir_flag_string(FLAG_BITS[EmailFlag.SEEN] | FLAG_BITS[EmailFlag.FLAGGED])
+    'FS'
+    """
+    return ''.join(sorted(c for c, bit in MAP_MAILDIR_TO_BIT.items() if flags & bit))
+
+
+class MirrorState:
+    """What a mirror knew about the mailbox at the end of its last sync, kept in a SQLite database in the maildir.
+
+    Each UID is stored with the key of its file and the flags both sides agreed on, which is what's needed to tell
+    which side has changed a message's flags since. A key of None means the file was deleted locally, but the message
+    is still waiting to be expunged on the server.
+    """
+
+    def __init__(self, path: pathlib.Path) -> None:
+        # Opened by the syncer's thread, but closed by whichever thread closes the mirror, once the syncer's stopped.
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        version = self._db.execute('PRAGMA user_version').fetchone()[0]
+        if version != SCHEMA_VERSION:
+            self._db.execute('DROP TABLE IF EXISTS mailbox')
+            self._db.execute('DROP TABLE IF EXISTS messages')
+        self._db.execute('CREATE TABLE IF NOT EXISTS mailbox (name TEXT PRIMARY KEY, value INTEGER)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS messages (uid INTEGER PRIMARY KEY, key TEXT, flags INTEGER)')
+        self._db.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+        self._db.commit()
+        state = dict(self._db.execute('SELECT name, value FROM mailbox'))
+        self.uidvalidity = state.get('uidvalidity')  # type: Optional[int]
+        self.highestmodseq = state.get('highestmodseq')  # type: Optional[int]
+        self.entries = {}  # type: Dict[int, MirrorEntry]
+        self._uids = {}  # type: Dict[str, int]
+        for uid, key, flags in self._db.execute('SELECT uid, key, flags FROM messages'):
+            self.entries[uid] = (key, flags)
+            if key is not None:
+                self._uids[key] = uid
+
+    def uid(self, key: str) -> Optional[int]:
+        """Return the UID of the message mirrored with the given key, if any."""
+        return self._uids.get(key)
+
+    def store(self, uid: int, key: Optional[str], flags: int) -> None:
+        old = self.entries.get(uid)
+        if old != (key, flags):
+            if old is not None and old[0] is not None:
+                self._uids.pop(old[0], None)
+            if key is not None:
+                self._uids[key] = uid
+            self.entries[uid] = (key, flags)
+            self._db.execute('INSERT OR REPLACE INTO messages VALUES (?, ?, ?)', (uid, key, flags))
+
+    def remove(self, uids: Iterable[int]) -> None:
+        uids = [uid for uid in uids if uid in self.entries]
+        for uid in uids:
+            key, _ = self.entries.pop(uid)
+            if key is not None:
+                self._uids.pop(key, None)
+        self._db.executemany('DELETE FROM messages WHERE uid = ?', ((uid, ) for uid in uids))
+
+    def set_state(self, uidvalidity: Optional[int], highestmodseq: Optional[int]) -> None:
+        self.uidvalidity, self.highestmodseq = uidvalidity, highestmodseq
+        self._db.executemany('INSERT OR REPLACE INTO mailbox VALUES (?, ?)',
+                             [('uidvalidity', uidvalidity), ('highestmodseq', highestmodseq)])
+
+    def commit(self) -> None:
+        self._db.commit()
+
+    def close(self) -> None:
+        self._db.commit()
+        self._db.close()
+
+
+class ImapMirror:
+    """Keep a local maildir as a mirror of an IMAP mailbox, so that it can be read without waiting on the network.
+
+    Each sync only carries what has changed on either side since the last one:
+
+    * New messages on the server are downloaded into tmp/, and delivered to cur/ once complete, with their flags in
+      the filename as usual. Large messages are downloaded in chunks, several at once if the client is an ImapPool, and
+      a download that's interrupted carries on from the end of its file in tmp/ next time.
+    * Flags are compared with those both sides agreed on last time, so a change made on either side is copied to the
+      other one; if both sides changed a message, each flag follows whichever side changed it, or the local one.
+    * Messages expunged on the server are deleted locally, and messages deleted locally, e.g. by an expunge in
+      pynemail, are flagged as deleted on the server, and expunged there too if it supports UIDPLUS.
+
+    With CONDSTORE (RFC 7162), only the flags changed since the last sync are fetched; with QRESYNC, the UIDs expunged
+    since then come with them, so the UIDs don't have to be listed either. If the mailbox's UIDVALIDITY changes, the
+    mirror's messages are deleted and downloaded again, along with any local flag changes that hadn't been synced.
+
+    When just a few files are known to have changed locally, push() copies their changes to the server without
+    looking at the rest of the mailbox on either side.
+
+    :param pathlib.Path maildir: The maildir to keep the mirror in; it's created if it doesn't exist.
+    :param client: The connection (or ImapPool) to use; with an ImapPool, only its background connections are used,
+        as syncs run in the background.
+    """
+
+    def __init__(self, maildir: pathlib.Path, client: ImapClient) -> None:
+        self.maildir = maildir
+        self.client = client
+        for subdir in ('cur', 'new', 'tmp'):
+            (maildir / subdir).mkdir(parents=True, exist_ok=True)
+        self._state = None  # type: Optional[MirrorState]
+        self._executor = None  # type: Optional[ThreadPoolExecutor]
+        if isinstance(client, ImapPool) and client.size > 2:
+            # One worker for each background connection but the one the sync holds, as imaplib connections aren't
+            # thread-safe. Without any to spare, large messages are downloaded on the sync's own connection.
+            self._executor = ThreadPoolExecutor(max_workers=client.size - 2)
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown()
+        if self._state is not None:
+            self._state.close()
+            self._state = None
+
+    def _open_state(self) -> MirrorState:
+        # Kept open between syncs, rather than loading every entry again each time.
+        if self._state is None:
+            self._state = MirrorState(self.maildir / STATE_FILENAME)
+        return self._state
+
+    @timed('mirror.sync')
+    def sync(self) -> None:
+        """Bring the maildir and the mailbox up to date with each other."""
+        state = self._open_state()
+        with checkout(self.client, interactive=False) as con:
+            self._sync(con, state)
+
+    @timed('mirror.push')
+    def push(self, paths: Iterable[pathlib.Path]) -> None:
+        """Copy the flags of the given files to the server, or expunge their messages there if they've been deleted.
+
+        Only the changed flags are stored, so any changes made on the server in the meantime are kept, and the next
+        sync() brings them back. If the mailbox's UIDVALIDITY has changed, it's a full sync() after all.
+
+        :param paths: The files that have changed, as they were last seen; files that have been renamed since are
+            found by their keys.
+        """
+        state = self._open_state()
+        with checkout(self.client, interactive=False) as con:
+            _, uidvalidity, _ = select_imap_mailbox(con)
+            if uidvalidity != state.uidvalidity:
+                self._sync(con, state)
+                return
+            stores = {}  # type: Dict[Tuple[str, bool], List[int]]
+            deleted = []  # type: List[int]
+            for key, path in {maildir_key(path): path for path in paths}.items():
+                uid = state.uid(key)
+                if uid is None:
+                    continue  # Not mirrored yet, or not at all.
+                if not path.exists():
+                    path = self._find(key)
+                    if path is None:
+                        deleted.append(uid)
+                        continue
+                base = state.entries[uid][1]
+                local_flags = parse_maildir_flags(path)
+                self._add_stores(stores, uid, local_flags, base)
+                state.store(uid, key, local_flags)
+            self._store(con, stores)
+            if deleted:
+                self._expunge(con, state, deleted)
+        state.commit()
+
+    def _sync(self, con: imaplib.IMAP4, state: MirrorState) -> None:
+        exists, uidvalidity, highestmodseq = select_imap_mailbox(con)
+        if uidvalidity != state.uidvalidity:
+            self._delete(key for key, _ in state.entries.values())
+            state.remove(list(state.entries))
+            state.set_state(uidvalidity, None)
+            state.commit()
+        known = set(state.entries)
+        uids = None  # type: Optional[Set[int]]
+        if not exists:
+            server_flags = {}  # type: Dict[int, int]
+            uids = set()
+        elif highestmodseq is not None and state.highestmodseq is not None:
+            qresync = 'QRESYNC' in con.capabilities and bool(known)
+            server_flags, vanished = fetch_imap_flags(con, state.highestmodseq, qresync)
+            if qresync:
+                uids = (known - vanished) | set(server_flags)
+                if len(uids) != exists:
+                    uids = None  # Something's been missed, so list them after all.
+            if uids is None:
+                uids = set(search_imap(con))
+        else:
+            server_flags, _ = fetch_imap_flags(con)
+            uids = set(server_flags)
+
+        # Expunged on the server.
+        gone = known - uids
+        self._delete(state.entries[uid][0] for uid in gone)
+        state.remove(gone)
+
+        local = self._scan()
+        stores = {}  # type: Dict[Tuple[str, bool], List[int]]
+        deleted = []  # type: List[int]
+        for uid in sorted(known & uids):
+            key, base = state.entries[uid]
+            if key is None:
+                continue  # Still waiting to be expunged.
+            path = local.get(key) or self._find(key)
+            if path is None:
+                deleted.append(uid)
+                continue
+            local_flags = parse_maildir_flags(path)
+            server = server_flags.get(uid, base)
+            # Each flag follows whichever side changed it, or the local one if both did.
+            changed_locally = local_flags ^ base
+            merged = (server & ~changed_locally) | (local_flags & changed_locally)
+            if merged != local_flags or ':' not in path.name:
+                try:
+                    self._rename(path, key, merged)
+                except FileNotFoundError:
+                    continue  # Renamed in the meantime, so leave it for the next sync.
+            self._add_stores(stores, uid, merged, server)
+            state.store(uid, key, merged)
+        self._store(con, stores)
+        if deleted:
+            self._expunge(con, state, deleted)
+        state.commit()
+
+        new = sorted(uids - known)
+        if new:
+            self._download(con, state, new)
+        self._clean_tmp()
+        state.set_state(uidvalidity, highestmodseq)
+        state.commit()
+
+    @staticmethod
+    def _add_stores(stores: Dict[Tuple[str, bool], List[int]], uid: int, flags: int, server: int) -> None:
+        for flag, imap_flag in MAP_FLAG_TO_IMAP.items():
+            bit = FLAG_BITS[flag]
+            if (flags ^ server) & bit:
+                stores.setdefault((imap_flag, bool(flags & bit)), []).append(uid)
+
+    @staticmethod
+    def _store(con: imaplib.IMAP4, stores: Dict[Tuple[str, bool], List[int]]) -> None:
+        for (imap_flag, on), changed in sorted(stores.items()):
+            con.uid('STORE', compress_sequence_set(changed), '+FLAGS.SILENT' if on else '-FLAGS.SILENT', imap_flag)
+
+    def _expunge(self, con: imaplib.IMAP4, state: MirrorState, uids: List[int]) -> None:
+        deleted_bit = FLAG_BITS[EmailFlag.DELETED]
+        sequence_set = compress_sequence_set(uids)
+        con.uid('STORE', sequence_set, '+FLAGS.SILENT', MAP_FLAG_TO_IMAP[EmailFlag.DELETED])
+        if 'UIDPLUS' in con.capabilities:
+            con.uid('EXPUNGE', sequence_set)
+            state.remove(uids)
+        else:
+            # A plain EXPUNGE would remove every other message flagged as deleted too, so leave it to the server's
+            # other clients; until then, it mustn't be downloaded again.
+            for uid in uids:
+                state.store(uid, None, state.entries[uid][1] | deleted_bit)
+
+    def _download(self, con: imaplib.IMAP4, state: MirrorState, uids: List[int]) -> None:
+        small = []  # type: List[NewMessage]
+        large = []  # type: List[NewMessage]
+        for start in range(0, len(uids), METADATA_BATCH_SIZE):
+            batch = uids[start:start + METADATA_BATCH_SIZE]
+            _, data = con.uid('FETCH', compress_sequence_set(batch), '(FLAGS INTERNALDATE RFC822.SIZE)')
+            for uid, result in sorted(parse_uid_fetch_response(data).items()):
+                size = _RFC822_SIZE.search(result.items)
+                date = imaplib.Internaldate2tuple(result.items)
+                internaldate = 0.0 if date is None else time.mktime(date)
+                message = (uid, mirror_key(uid, state.uidvalidity, internaldate), result.flags() or 0,
+                           int(size.group(1)) if size else 0)
+                (large if message[3] >= LARGE_MESSAGE_SIZE else small).append(message)
+
+        futures = []  # type: List[Tuple[NewMessage, Future]]
+        if self._executor is not None:
+            # On the background connections, while this one gets on with the smaller messages.
+            futures = [(message, self._executor.submit(self._download_large, self.client, message))
+                       for message in large]
+            large = []
+        batch, batch_size = [], 0
+        for message in small:
+            batch.append(message)
+            batch_size += message[3]
+            if batch_size >= DOWNLOAD_BATCH_SIZE:
+                self._download_small(con, state, batch)
+                batch, batch_size = [], 0
+        if batch:
+            self._download_small(con, state, batch)
+        for message in large:
+            if self._download_large(con, message):
+                self._deliver(state, message)
+        for message, future in futures:
+            if future.result():
+                self._deliver(state, message)
+
+    def _download_small(self, con: imaplib.IMAP4, state: MirrorState, messages: List[NewMessage]) -> None:
+        _, data = con.uid('FETCH', compress_sequence_set(m[0] for m in messages), '(BODY.PEEK[])')
+        results = parse_uid_fetch_response(data)
+        for message in messages:
+            result = results.get(message[0])
+            body = None if result is None else result.literal(b'BODY[')
+            if body is None:
+                continue  # Expunged in the meantime.
+            with (self.maildir / 'tmp' / message[1]).open('wb') as fp:
+                fp.write(body)
+            self._deliver(state, message)
+        state.commit()
+
+    def _download_large(self, client: ImapClient, message: NewMessage) -> bool:
+        uid, key = message[0], message[1]
+        with checkout(client, interactive=False) as con, (self.maildir / 'tmp' / key).open('ab') as fp:
+            offset = fp.tell()
+            while True:
+                _, data = con.uid('FETCH', str(uid), '(BODY.PEEK[]<{}.{}>)'.format(offset, CHUNK_SIZE))
+                result = parse_uid_fetch_response(data).get(uid)
+                if result is None:
+                    return False  # Expunged in the meantime.
+                chunk = result.literal(b'BODY[') or b''
+                fp.write(chunk)
+                # Flushed as it goes, so an interrupted download keeps what it had.
+                fp.flush()
+                offset += len(chunk)
+                if len(chunk) < CHUNK_SIZE:
+                    return True
+
+    def _deliver(self, state: MirrorState, message: NewMessage) -> None:
+        uid, key, flags, _ = message
+        tmp = self.maildir / 'tmp' / key
+        internaldate = float(key.split('.', 1)[0])
+        os.utime(str(tmp), (internaldate, internaldate))
+        tmp.rename(self.maildir / 'cur' / '{}:2,{}'.format(key, maildir_flag_string(flags)))
+        state.store(uid, key, flags)
+
+    def _scan(self) -> Dict[str, pathlib.Path]:
+        local = {}  # type: Dict[str, pathlib.Path]
+        for subdir in ('new', 'cur'):
+            for entry in os.scandir(str(self.maildir / subdir)):
+                if _MIRROR_KEY.match(entry.name):
+                    path = pathlib.Path(entry.path)
+                    local[maildir_key(path)] = path
+        return local
+
+    def _find(self, key: str) -> Optional[pathlib.Path]:
+        # A file that was renamed during the scan may have been missed, and it mustn't be taken for a deletion.
+        for subdir in ('new', 'cur'):
+            for path in (self.maildir / subdir).glob(key + '*'):
+                if maildir_key(path) == key:
+                    return path
+        return None
+
+    def _rename(self, path: pathlib.Path, key: str, flags: int) -> pathlib.Path:
+        if ':' in path.name:
+            return update_maildir_flags(path, flags)
+        newpath = self.maildir / 'cur' / '{}:2,{}'.format(key, maildir_flag_string(flags))
+        path.rename(newpath)
+        return newpath
+
+    def _delete(self, keys: Iterable[Optional[str]]) -> None:
+        for key in keys:
+            path = None if key is None else self._find(key)
+            if path is not None:
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+
+    def _clean_tmp(self) -> None:
+        # Every download has been delivered, so anything left is from messages that have gone since.
+        for entry in os.scandir(str(self.maildir / 'tmp')):
+            if _MIRROR_KEY.match(entry.name):
+                os.unlink(entry.path)
+
+
+class ImapMirrorSyncer(threading.Thread):
+    """Sync an ImapMirror in the background: straight away, whenever request() is called, and every so often.
+
+    A request can name the files that have changed locally, e.g. after flags were written, in which case just those
+    are pushed to the server; otherwise, or when the interval is up, it's a full sync.
+
+    A sync that fails, e.g. because the network is down, is just tried again the next time, as the maildir can still
+    be read in the meantime. Stopping the syncer runs one last sync if one was requested since the last one started,
+    so that changes made just before quitting still reach the server, unless the last one failed, as the server may
+    well be out of reach, and the changes are still in the maildir for next time.
+
+    :param ImapMirror mirror: The mirror to sync.
+    :param float interval: The most seconds to go without a sync.
+    """
+
+    def __init__(self, mirror: ImapMirror, interval: float = SYNC_INTERVAL) -> None:
+        super().__init__(daemon=True)
+        self.mirror = mirror
+        self.interval = interval
+        self.error = None  # type: Optional[Exception]
+        self._lock = threading.Lock()
+        self._full = False
+        self._paths = []  # type: List[pathlib.Path]
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+
+    def request(self, paths: Optional[Iterable[pathlib.Path]] = None) -> None:
+        """Ask for a sync, of just the given files if they're the only things that have changed."""
+        with self._lock:
+            if paths is None:
+                self._full = True
+            else:
+                self._paths.extend(paths)
+        self._wakeup.set()
+
+    def stop(self) -> None:
+        if self.ident is None:
+            return  # Never started.
+        self._stopped.set()
+        self._wakeup.set()
+        self.join()
+
+    def _sync(self, full: bool) -> None:
+        with self._lock:
+            full, self._full = full or self._full, False
+            paths, self._paths = self._paths, []
+            self._wakeup.clear()
+        try:
+            if full:
+                self.mirror.sync()
+            elif paths:
+                self.mirror.push(paths)
+        except (imaplib.IMAP4.error, OSError) as e:
+            # Any local changes that weren't pushed are still in the maildir, so the next full sync picks them up.
+            self.error = e
+        else:
+            self.error = None
+
+    def run(self) -> None:
+        self._sync(True)
+        while True:
+            requested = self._wakeup.wait(self.interval)
+            if self._stopped.is_set():
+                if self.error is None and (self._full or self._paths):
+                    self._sync(False)
+                return
+            self._sync(not requested)
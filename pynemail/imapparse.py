@@ -0,0 +1,318 @@
+import imaplib
+import re
+
+from collections import namedtuple
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .email import EmailFlag, FLAG_BITS
+
+
+MAP_FLAG_TO_IMAP = {
+    EmailFlag.ANSWERED: r'\Answered',
+    EmailFlag.SEEN: r'\Seen',
+    EmailFlag.FLAGGED: r'\Flagged',
+    EmailFlag.DELETED: r'\Deleted',
+    EmailFlag.DRAFT: r'\Draft',
+}  # type: Dict[EmailFlag, str]
+
+MAP_IMAP_TO_BIT = {imap_flag.lower(): FLAG_BITS[flag] for flag, imap_flag in MAP_FLAG_TO_IMAP.items()}
+
+_FETCH_NUM = re.compile(rb'^\s*(\d+) \(')
+_FETCH_UID = re.compile(rb'\bUID (\d+)', re.IGNORECASE)
+_UNTAGGED_UPDATE = re.compile(rb'^\* (\d+) (EXISTS|EXPUNGE|FETCH)\b(.*)', re.IGNORECASE)
+_VANISHED = re.compile(rb'^(?:\* VANISHED )?(?:\(EARLIER\) )?([\d:,]+)$', re.IGNORECASE)
+
+# An untagged response saying the mailbox has changed. ``num`` is a sequence number, except for VANISHED (RFC 7162),
+# the replacement for EXPUNGE once QRESYNC is enabled, where it's a UID.
+ImapUpdate = namedtuple('ImapUpdate', ['kind', 'num', 'flags'])
+_LITERAL_NAMES = (b'BODY[', b'BINARY[', b'RFC822')
+_LIST_TOKEN = re.compile(rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|\{(\d+)\}|([^\s()"]+))')
+_QUOTED_CHAR = re.compile(rb'\\(.)')
+
+
+def parse_imap_flags(flagstr: List[bytes]) -> int:
+    """Parse the FLAGS of a FETCH response into a bit mask of EmailFlag.bit values."""
+    mask = 0
+    for flag in imaplib.ParseFlags(flagstr[0]):
+        mask |= MAP_IMAP_TO_BIT.get(flag.decode().lower(), 0)
+    return mask
+
+
+def compress_sequence_set(nums: Iterable[int]) -> str:
+    """Build the shortest IMAP sequence set covering the given numbers.
+
+    >>> compress_sequence_set([3, 1, 2, 7])
+    '1:3,7'
+    """
+    ranges = []  # type: List[List[int]]
+    for num in sorted(set(nums)):
+        if ranges and ranges[-1][1] == num - 1:
+            ranges[-1][1] = num
+        else:
+            ranges.append([num, num])
+    return ','.join(str(a) if a == b else '{}:{}'.format(a, b) for a, b in ranges)
+
+
+class FetchResult:
+    """The data items returned for a single message by a FETCH command."""
+
+    def __init__(self, num: int) -> None:
+        self.num = num
+        self.items = b''
+        self.literals = {}  # type: Dict[bytes, bytes]
+
+    def literal(self, prefix: bytes) -> Optional[bytes]:
+        """Return the first literal whose item name starts with the given prefix."""
+        for name, value in self.literals.items():
+            if name.upper().startswith(prefix.upper()):
+                return value
+        return None
+
+    def flags(self) -> Optional[int]:
+        if b'FLAGS (' not in self.items:
+            return None
+        return parse_imap_flags([self.items])
+
+    def uid(self) -> Optional[int]:
+        match = _FETCH_UID.search(self.items)
+        return None if match is None else int(match.group(1))
+
+
+def parse_uid_fetch_response(data: list) -> Dict[int, FetchResult]:
+    """Group the pieces of an imaplib UID FETCH (or UID STORE) response by UID; see parse_fetch_response()."""
+    results = {}  # type: Dict[int, FetchResult]
+    for result in parse_fetch_response(data).values():
+        uid = result.uid()
+        if uid is not None:
+            results[uid] = result
+    return results
+
+
+def parse_fetch_response(data: list) -> Dict[int, FetchResult]:
+    """Group the pieces of an imaplib FETCH response by message number.
+
+    imaplib returns a flat list in which every literal is a (prefix, literal) tuple, and the text following a
+    literal (often just the closing parenthesis, but possibly more data items) is a separate bytes object.
+
+    :param list data: The data returned by ``IMAP4.fetch()``.
+    :return: The parsed results, keyed by message number.
+    :rtype: dict[int, FetchResult]
+    """
+    results = {}  # type: Dict[int, FetchResult]
+    current = None  # type: Optional[FetchResult]
+    for item in data:
+        if item is None:
+            continue
+        literal = None
+        if isinstance(item, tuple):
+            item, literal = item
+        match = _FETCH_NUM.match(item)
+        if match:
+            num = int(match.group(1))
+            current = results.setdefault(num, FetchResult(num))
+        if current is None:
+            continue
+        if literal is None:
+            current.items += item
+            continue
+        start = max(item.rfind(name) for name in _LITERAL_NAMES)
+        end = item.rfind(b' {')
+        current.items += item[:start]
+        current.literals[item[start:end].strip()] = literal
+    return results
+
+
+def parse_imap_list(data: list) -> list:
+    """Parse the parenthesised lists of an imaplib response into nested Python lists.
+
+    NIL becomes None, numbers become ints, and quoted strings, literals and atoms become bytes.
+
+    >>> parse_imap_list([b'1 (UID 7 BODY[1] "hi" X-GM-LABELS (NIL))'])
+    [1, [b'UID', 7, b'BODY[1]', b'hi', b'X-GM-LABELS', [None]]]
+    """
+    stack = [[]]  # type: List[list]
+    for item in data:
+        if item is None:
+            continue
+        literal = None
+        if isinstance(item, tuple):
+            item, literal = item
+        pos = 0
+        match = _LIST_TOKEN.match(item, pos)
+        while match:
+            pos = match.end()
+            opening, closing, quoted, size, atom = match.groups()
+            if opening:
+                stack.append([])
+            elif closing:
+                if len(stack) > 1:
+                    value = stack.pop()
+                    stack[-1].append(value)
+            elif quoted is not None:
+                stack[-1].append(_QUOTED_CHAR.sub(rb'\1', quoted))
+            elif size is not None:
+                stack[-1].append(literal)  # imaplib has already read the literal that follows its size.
+            elif atom.upper() == b'NIL':
+                stack[-1].append(None)
+            else:
+                stack[-1].append(int(atom) if atom.isdigit() else atom)
+            match = _LIST_TOKEN.match(item, pos)
+    return stack[0]
+
+
+def fetch_item(response: list, name: bytes):
+    """Return the value of a data item from a FETCH response parsed by parse_imap_list()."""
+    items = response[1] if len(response) > 1 and isinstance(response[1], list) else []
+    for key, value in zip(items[::2], items[1::2]):
+        if isinstance(key, bytes) and key.upper().startswith(name):
+            return value
+    return None
+
+
+def _text(value) -> str:
+    return value.decode('ascii', 'replace') if isinstance(value, bytes) else ''
+
+
+def _params(value) -> Dict[str, str]:
+    values = value if isinstance(value, list) else []
+    return {_text(k).lower(): _text(v) for k, v in zip(values[::2], values[1::2])}
+
+
+def _split_multipart(structure: list) -> Tuple[List[list], list]:
+    """Split a multipart BODYSTRUCTURE into its parts, and the subtype and extension data that follow them."""
+    count = 0
+    while count < len(structure) and isinstance(structure[count], list):
+        count += 1
+    return structure[:count], structure[count:]
+
+
+def find_text_section(structure: list, section: str = '') -> Optional[str]:
+    """Find the plain text body in a BODYSTRUCTURE, following the same rules as mimestream.find_text_part().
+
+    The server spells out every part's type, so unlike find_text_part() there are no defaults to worry about.
+
+    :param list structure: The BODYSTRUCTURE, as parsed by parse_imap_list().
+    :return: The section number of the text part, e.g. '1.1', or None if there isn't one.
+    :rtype: str
+    """
+    if structure and isinstance(structure[0], list):
+        children, rest = _split_multipart(structure)
+        subtype = _text(rest[0]).lower() if rest else 'mixed'
+        disposition = rest[2] if len(rest) > 2 else None
+        if isinstance(disposition, list) and _text(disposition[0]).lower() == 'attachment':
+            return None
+        sections = ['{}.{}'.format(section, i) if section else str(i) for i in range(1, len(children) + 1)]
+        parts = list(zip(sections, children))
+        if subtype == 'related' and parts:
+            root = _params(rest[1] if len(rest) > 1 else None).get('start')
+            parts = [p for p in parts if root and len(p[1]) > 3 and _text(p[1][3]) == root][:1] or parts[:1]
+        for child_section, child in parts:
+            found = find_text_section(child, child_section)
+            if found is not None:
+                return found
+        return None
+    if len(structure) < 7:
+        return None
+    maintype, subtype = _text(structure[0]).lower(), _text(structure[1]).lower()
+    disposition_index = {'text': 9, 'message': 11}.get(maintype, 8)
+    disposition = structure[disposition_index] if len(structure) > disposition_index else None
+    if isinstance(disposition, list) and _text(disposition[0]).lower() == 'attachment':
+        return None
+    if maintype == 'text' and subtype == 'plain':
+        return section or '1'
+    return None
+
+
+def section_part(structure: list, section: str) -> list:
+    """Return the part of a BODYSTRUCTURE with the given section number."""
+    part = structure
+    for index in section.split('.'):
+        if isinstance(part[0], list):
+            part = part[int(index) - 1]
+    return part
+
+
+def part_headers(part: list) -> bytes:
+    """Rebuild enough of a part's MIME headers from its BODYSTRUCTURE to decode its body."""
+    children, rest = _split_multipart(part)
+    if children:
+        content_type = 'multipart/' + (_text(rest[0]).lower() if rest else 'mixed')
+        params, encoding = _params(rest[1] if len(rest) > 1 else None), '7bit'
+    else:
+        content_type = '{}/{}'.format(_text(part[0]).lower(), _text(part[1]).lower())
+        params, encoding = _params(part[2]), _text(part[5]) or '7bit'
+    content_type += ''.join('; {}="{}"'.format(name, value.replace('"', '')) for name, value in params.items())
+    headers = 'Content-Type: {}\r\nContent-Transfer-Encoding: {}\r\n\r\n'.format(content_type, encoding)
+    return headers.encode('ascii', 'replace')
+
+
+def parse_imap_updates(line: bytes) -> List[ImapUpdate]:
+    """Parse an untagged EXISTS, EXPUNGE, FETCH or VANISHED response, as sent during IDLE or in reply to NOOP.
+
+    A VANISHED response can cover any number of messages, so there is an update for each of them.
+
+    >>> parse_imap_updates(b'* 3 EXPUNGE')
+    [ImapUpdate(kind='EXPUNGE', num=3, flags=None)]
+    >>> parse_imap_updates(b'* VANISHED 8:9')
+    [ImapUpdate(kind='VANISHED', num=8, flags=None), ImapUpdate(kind='VANISHED', num=9, flags=None)]
+    """
+    line = line.strip()
+    if line[:11].upper() == b'* VANISHED ':
+        return _vanished_updates(line)
+    match = _UNTAGGED_UPDATE.match(line)
+    if match is None:
+        return []
+    kind = match.group(2).upper().decode()
+    flags = None
+    if kind == 'FETCH':
+        if b'FLAGS (' not in match.group(3):
+            return []
+        flags = parse_imap_flags([match.group(3)])
+    return [ImapUpdate(kind, int(match.group(1)), flags)]
+
+
+def _vanished_updates(data: bytes) -> List[ImapUpdate]:
+    match = _VANISHED.match(data.strip())
+    if match is None:
+        return []
+    return [ImapUpdate('VANISHED', uid, None) for uid in expand_sequence_set(match.group(1).decode())]
+
+
+def pending_vanished(client: imaplib.IMAP4) -> List[ImapUpdate]:
+    """Collect the VANISHED responses the connection has received, as ImapUpdates."""
+    updates = []  # type: List[ImapUpdate]
+    for data in client.untagged_responses.pop('VANISHED', []):
+        if isinstance(data, bytes):
+            updates.extend(_vanished_updates(data))
+    return updates
+
+
+def pending_updates(client: imaplib.IMAP4) -> List[ImapUpdate]:
+    """Collect the VANISHED, EXPUNGE, FETCH and EXISTS responses the connection has received, as ImapUpdates.
+
+    imaplib files untagged responses by type, so the order in which they arrived is lost. Expunges come first, as
+    FETCH and EXISTS responses refer to the sequence numbers left afterwards.
+    """
+    updates = pending_vanished(client)
+    for kind in ('EXPUNGE', 'FETCH', 'EXISTS'):
+        for data in client.untagged_responses.pop(kind, []):
+            if not isinstance(data, bytes):
+                continue
+            num, _, rest = data.partition(b' ')
+            updates.extend(parse_imap_updates(b' '.join(part for part in (b'*', num, kind.encode(), rest) if part)))
+    client.untagged_responses.pop('RECENT', None)
+    return updates
+
+
+def expand_sequence_set(sequence_set: str) -> List[int]:
+    """Expand an IMAP sequence set, keeping its order, as the ESORT ALL result is in sort order.
+
+    >>> expand_sequence_set('1:3,7,5:4')
+    [1, 2, 3, 7, 5, 4]
+    """
+    nums = []  # type: List[int]
+    for part in sequence_set.split(','):
+        first, _, last = part.partition(':')
+        start, stop = int(first), int(last or first)
+        nums.extend(range(start, stop + 1) if start <= stop else range(start, stop - 1, -1))
+    return nums
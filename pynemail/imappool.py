@@ -0,0 +1,159 @@
+import imaplib
+import threading
+import time
+
+from contextlib import contextmanager
+from typing import Callable, Generator, Optional, Union
+
+
+HEALTH_CHECK_INTERVAL = 60.0
+
+
+class _Slot:
+
+    __slots__ = ('connection', 'last_used', 'owner', 'depth')
+
+    def __init__(self) -> None:
+        self.connection = None  # type: Optional[imaplib.IMAP4]
+        self.last_used = 0.0
+        self.owner = None  # type: Optional[int]
+        self.depth = 0
+
+
+class ImapPool:
+    """A few authenticated connections to one mailbox, with the mailbox selected, shared between threads.
+
+    One connection is kept for interactive requests, i.e. those the UI is waiting for, so they never queue behind
+    background work such as prefetching; the rest are shared by background work. The interactive connection is always
+    the same session, so the sequence numbers and unsolicited responses it sees are consistent, which is what the
+    inbox's list of emails follows.
+
+    Connections are opened when they're first needed. One that's been idle for a while is checked with a NOOP before
+    it's handed out, and one that fails (e.g. the server dropped it) is replaced with a new connection, logged in and
+    with the mailbox selected again, the next time it's needed.
+
+    :param callable connect: Opens a new connection, logged in and with the mailbox selected, e.g. connect_imap().
+    :param int size: The number of connections, including the interactive one; at least 2.
+    """
+
+    def __init__(self, connect: Callable[[], imaplib.IMAP4], size: int = 3,
+                 check_interval: float = HEALTH_CHECK_INTERVAL) -> None:
+        assert size >= 2
+        self._connect = connect
+        self.check_interval = check_interval
+        self._slots = [_Slot() for _ in range(size)]
+        self._cond = threading.Condition()
+        self._closed = False
+
+    @property
+    def size(self) -> int:
+        return len(self._slots)
+
+    def _acquire(self, interactive: bool) -> _Slot:
+        me = threading.get_ident()
+        candidates = self._slots[:1] if interactive else self._slots[1:]
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise imaplib.IMAP4.error('The connection pool is closed')
+                # Re-entrant, so a function that checks out a connection can call another that does the same.
+                for slot in candidates:
+                    if slot.owner == me:
+                        slot.depth += 1
+                        return slot
+                free = [slot for slot in candidates if slot.owner is None]
+                if free:
+                    # Prefer a connection that's already open.
+                    slot = max(free, key=lambda s: (s.connection is not None, s.last_used))
+                    slot.owner, slot.depth = me, 1
+                    return slot
+                self._cond.wait()
+
+    def _release(self, slot: _Slot) -> None:
+        with self._cond:
+            slot.depth -= 1
+            if slot.depth == 0:
+                slot.owner = None
+                slot.last_used = time.monotonic()
+                self._cond.notify_all()
+        if self._closed and slot.owner is None:
+            self._disconnect(slot)
+
+    def _disconnect(self, slot: _Slot) -> None:
+        con, slot.connection = slot.connection, None
+        if con is not None:
+            try:
+                con.logout()
+            except (imaplib.IMAP4.error, OSError):
+                pass
+
+    def _is_healthy(self, con: imaplib.IMAP4) -> bool:
+        try:
+            con.noop()
+        except (imaplib.IMAP4.error, OSError):
+            return False
+        return True
+
+    @contextmanager
+    def connection(self, interactive: bool = False) -> Generator:
+        """Check out a connection for the duration of the ``with`` block.
+
+        A thread that already has a connection from the same lane gets the same one again.
+
+        :param bool interactive: Use the interactive connection, rather than one of the background ones.
+        """
+        slot = self._acquire(interactive)
+        try:
+            if slot.depth == 1:
+                stale = time.monotonic() - slot.last_used > self.check_interval
+                if slot.connection is not None and stale and not self._is_healthy(slot.connection):
+                    self._disconnect(slot)
+                if slot.connection is None:
+                    slot.connection = self._connect()
+            yield slot.connection
+        except (imaplib.IMAP4.abort, OSError):
+            # The connection is broken, so drop it; the next request gets a new one.
+            if slot.depth == 1:
+                self._disconnect(slot)
+            raise
+        finally:
+            if slot.depth == 1 and not interactive and slot.connection is not None:
+                # Background work never looks at unsolicited responses, so don't let them pile up.
+                slot.connection.untagged_responses.clear()
+            self._release(slot)
+
+    def close(self) -> None:
+        """Close the mailbox and log out of every connection; any that are checked out are logged out when returned.
+
+        The interactive connection's mailbox is closed first, as imap_client() does, which expunges messages flagged as
+        deleted.
+        """
+        with self._cond:
+            self._closed = True
+            idle = [slot for slot in self._slots if slot.owner is None]
+            self._cond.notify_all()
+        for slot in idle:
+            if slot is self._slots[0] and slot.connection is not None:
+                try:
+                    slot.connection.close()
+                except (imaplib.IMAP4.error, OSError):
+                    pass
+            self._disconnect(slot)
+
+
+ImapClient = Union[imaplib.IMAP4, ImapPool]
+
+
+@contextmanager
+def checkout(client: ImapClient, interactive: bool = True) -> Generator:
+    """Yield a connection from ``client``, if it's an ImapPool, or ``client`` itself, if it's already a connection.
+
+    >>> with checkout('a connection') as con:
+    ...     con
+    'a connection'
+    """
+    if isinstance(client, ImapPool):
+        with client.connection(interactive) as con:
+            yield con
+    else:
+        yield client
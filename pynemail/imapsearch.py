@@ -0,0 +1,151 @@
+import imaplib
+
+from typing import Dict, List, Optional, Set
+
+from .imapclient import ImapEmail, load_imap_summaries
+from .imappool import ImapClient, checkout
+from .imapparse import expand_sequence_set, parse_imap_list
+from .search import search_words
+from .stats import timed
+from .threads import Container, ThreadIndex, thread_roots
+
+
+# The orders the inbox can be sorted in, as IMAP SORT (RFC 5256) criteria. Without SORT, only arrival order is possible.
+SORT_ORDERS = {
+    'arrival': 'REVERSE ARRIVAL',
+    'date': 'REVERSE DATE',
+    'from': 'FROM',
+    'subject': 'SUBJECT',
+}  # type: Dict[str, str]
+
+
+def _esearch_all(client: imaplib.IMAP4, typ: str, data: list) -> List[int]:
+    """Return the ALL result of the ESEARCH response (RFC 4731) to a SEARCH or SORT with RETURN (ALL)."""
+    _, data = client._untagged_response(typ, data, 'ESEARCH')
+    response = parse_imap_list(data)
+    for name, value in zip(response, response[1:]):
+        if isinstance(name, bytes) and name.upper() == b'ALL':
+            return expand_sequence_set(value.decode('ascii', 'replace') if isinstance(value, bytes) else str(value))
+    return []  # There's no ALL when nothing matches.
+
+
+@timed('imap.search')
+def search_imap(client: ImapClient, criteria: str = 'ALL', sort: Optional[str] = None) -> List[int]:
+    """Find the messages matching some IMAP search criteria, in the order they should be listed.
+
+    The server does the filtering and sorting, so nothing but the UIDs is downloaded. ESORT and ESEARCH are used
+    when the server supports them, as they return a compact sequence set rather than every UID.
+
+    :param str criteria: The SEARCH criteria, e.g. 'UNSEEN' or 'FROM bob SINCE 1-Jan-2018'.
+    :param str sort: One of the SORT_ORDERS, ignored unless the server supports SORT; the default is newest first.
+    :return: The UIDs of the matching messages.
+    :rtype: list[int]
+    """
+    with checkout(client) as con:
+        return run_imap_search(con, criteria, sort)
+
+
+def run_imap_search(client: imaplib.IMAP4, criteria: str, sort: Optional[str]) -> List[int]:
+    """As search_imap(), on a connection that's already checked out, e.g. while resynchronising a mailbox."""
+    capabilities = client.capabilities
+    if sort is not None and sort != 'arrival' and 'SORT' in capabilities:
+        program = '({})'.format(SORT_ORDERS[sort])
+        if 'ESORT' in capabilities:
+            typ, data = client._simple_command('UID', 'SORT', 'RETURN (ALL)', program, 'UTF-8', criteria)
+            return _esearch_all(client, typ, data)
+        _, data = client.uid('SORT', program, 'UTF-8', criteria)
+        return [int(uid) for uid in data[0].split()]
+    if 'ESEARCH' in capabilities:
+        typ, data = client._simple_command('UID', 'SEARCH', 'RETURN (ALL)', criteria)
+        uids = _esearch_all(client, typ, data)
+    else:
+        _, data = client.uid('SEARCH', criteria)
+        uids = [int(uid) for uid in data[0].split()]
+    # UIDs are assigned in order of arrival.
+    return sorted(uids, reverse=True)
+
+
+def _build_thread(items: list, parent: Container, mails: Dict[int, ImapEmail],
+                  containers: Dict[int, Container]) -> None:
+    # A run of UIDs is a chain of replies, and each list after it is a branch of replies to the last one.
+    for item in items:
+        if isinstance(item, list):
+            _build_thread(item, parent, mails, containers)
+        elif isinstance(item, int):
+            container = Container(mails.get(item))
+            container.set_parent(parent)
+            if container.email is not None:
+                containers[id(container.email)] = container
+            parent = container
+
+
+@timed('imap.thread')
+def thread_imap(client: ImapClient, mails: List[ImapEmail], criteria: str = 'ALL') -> List[Container]:
+    """Group the messages matching the criteria into threads on the server, with THREAD REFERENCES (RFC 5256).
+
+    :return: The roots of the threads containing the given emails, ordered by their first email in the list.
+    :rtype: list[Container]
+    """
+    with checkout(client) as con:
+        _, data = con.uid('THREAD', 'REFERENCES', 'UTF-8', criteria)
+    by_uid = {mail.uid(): mail for mail in mails}
+    containers = {}  # type: Dict[int, Container]
+    for thread in parse_imap_list(data):
+        if not isinstance(thread, list):
+            continue
+        # A thread whose first message is missing starts with a list of branches, so give them a common parent.
+        top = Container()
+        _build_thread(thread, top, by_uid, containers)
+        if len(top.children) == 1:
+            next(iter(top.children.values())).set_parent(None)
+    return thread_roots(mails, containers)
+
+
+class ImapThreads:
+    """Group a mailbox's messages into threads, on the server if it supports THREAD=REFERENCES.
+
+    Otherwise the messages are threaded locally with a ThreadIndex, which means fetching the summary of every message
+    in the list first.
+    """
+
+    def __init__(self, client: ImapClient, criteria: str = 'ALL') -> None:
+        self.client = client
+        self.criteria = criteria
+        self._index = ThreadIndex()
+
+    def threads(self, mails: List[ImapEmail]) -> List[Container]:
+        with checkout(self.client) as con:
+            capabilities = con.capabilities
+        if 'THREAD=REFERENCES' in capabilities:
+            return thread_imap(self.client, mails, self.criteria)
+        load_imap_summaries(self.client, mails)
+        self._index.update(mails)
+        return self._index.threads(mails)
+
+
+class ImapSearch:
+    """Filter a list of emails with the server's SEARCH, with the same interface as MailSearch.
+
+    Each word must appear somewhere in the message (SEARCH TEXT matches substrings, so the word still being typed
+    matches as a prefix). Only the UIDs are downloaded, and the results of each query are kept until the next start(),
+    so deleting a character doesn't search again. imaplib only sends ASCII, so any other words are left out.
+    """
+
+    def __init__(self, client: ImapClient) -> None:
+        self.client = client
+        self._mails = []  # type: List[ImapEmail]
+        self._results = {}  # type: Dict[str, Set[int]]
+
+    def start(self, mails: List[ImapEmail]) -> None:
+        self._mails = list(mails)
+        self._results = {}
+
+    def filter(self, text: str) -> List[ImapEmail]:
+        words = [word for word in search_words(text) if all(ord(c) < 128 for c in word)]
+        if not words:
+            return self._mails
+        criteria = ' '.join('TEXT "{}"'.format(word) for word in words)
+        found = self._results.get(criteria)
+        if found is None:
+            found = self._results[criteria] = set(search_imap(self.client, criteria))
+        return [mail for mail in self._mails if mail.uid() in found]
@@ -1,10 +1,18 @@
 import os
 import pathlib
 
+from collections import OrderedDict
+from concurrent.futures import Executor, Future
 from enum import Enum
-from typing import List, Dict
+from typing import Callable, List, Dict, Optional, Tuple
 
-from .email import Email, EmailFlag
+from . import inotify
+from .email import (
+    Email, EmailFlag, FLAG_BITS, FlagChanges, PREVIEW_SIZE, SUMMARY_HEADERS, read_header_block, summary_from_headers,
+)
+from .maildirindex import MaildirIndex
+from .mimestream import extract_body_from_file, extract_preview
+from .stats import timed
 
 
 MAP_FLAG_TO_MAILDIR = {
@@ -15,37 +23,76 @@ MAP_FLAG_TO_MAILDIR = {
     EmailFlag.DRAFT: 'D',
 }   # type: Dict[EmailFlag, str]
 
+MAP_MAILDIR_TO_BIT = {char: FLAG_BITS[flag] for flag, char in MAP_FLAG_TO_MAILDIR.items()}
+
+PARALLEL_LOAD_THRESHOLD = 2000
+LOAD_CHUNK_SIZE = 500
+# The most of a file that's read for a preview, which leaves room for the headers before the text.
+PREVIEW_READ_SIZE = 16 * 1024
+
+SummaryRecord = Tuple[str, int, float, Tuple[str, ...]]
+
 
 class UnknownMaildirFlagsType(Exception):
     pass
 
 
-def parse_maildir_flags(filepath: pathlib.Path) -> List[EmailFlag]:
-    flag_string = filepath.name.split(':')[1]
+def parse_maildir_flags(filepath: pathlib.Path) -> int:
+    """Parse the flags in a maildir filename into a bit mask of EmailFlag.bit values.
+
+    Mail delivered to new/ usually has no info suffix at all, which is the same as having no flags.
+    """
+    _, sep, flag_string = filepath.name.partition(':')
+    if not sep:
+        return 0
     flag_type, flag_chars = flag_string.split(',')
     if int(flag_type) != 2:
         raise UnknownMaildirFlagsType(flag_type)
-    flags = []
-    for flag in EmailFlag:
-        if MAP_FLAG_TO_MAILDIR[flag] in flag_chars:
-            flags.append(flag)
-    return flags
+    mask = 0
+    for char in flag_chars:
+        mask |= MAP_MAILDIR_TO_BIT.get(char, 0)
+    return mask
 
 
-def update_maildir_flags(filepath: pathlib.Path, flags: List[EmailFlag]) -> pathlib.Path:
-    keep_name, flag_string = filepath.name.split(':')
-    flag_type, flag_chars = flag_string.split(',')
+def maildir_key(filepath: pathlib.Path) -> str:
+    """Return the unique part of a maildir filename, which doesn't change when the flags do."""
+    return filepath.name.split(':')[0]
+
+
+@timed('maildir.rename')
+def update_maildir_flags(filepath: pathlib.Path, flags: int) -> pathlib.Path:
+    keep_name, sep, flag_string = filepath.name.partition(':')
+    flag_type, flag_chars = flag_string.split(',') if sep else ('2', '')
     if int(flag_type) != 2:
         raise UnknownMaildirFlagsType(flag_type)
-    newflag_string = ''.join(sorted([MAP_FLAG_TO_MAILDIR[f] for f in flags]))
+    # Keep any flags pynemail doesn't know about, e.g. P (passed).
+    unknown = [c for c in flag_chars if c not in MAP_MAILDIR_TO_BIT]
+    newflag_string = ''.join(sorted(unknown + [c for c, bit in MAP_MAILDIR_TO_BIT.items() if flags & bit]))
     newname = '{}:{},{}'.format(keep_name, flag_type, newflag_string)
     newpath = filepath.parent / newname
     filepath.rename(newpath)
     return newpath
 
 
+def rename_maildir_flags(changes: FlagChanges) -> None:
+    """Write a batch of flag changes, renaming each email once to match all of its current flags."""
+    mails = OrderedDict((id(mail), mail) for batch in changes.values() for mail in batch)
+    for mail in mails.values():
+        try:
+            mail.filepath = update_maildir_flags(mail.filepath, mail.flag_mask())
+        except FileNotFoundError:
+            pass  # Moved or deleted by another program, so the MaildirWatcher will pick up its new flags.
+
+
+@timed('maildir.stat')
+def _stat_mtime(path: str) -> float:
+    return os.stat(path).st_mtime
+
+
 class MaildirEmail(Email):
 
+    __slots__ = ('_path', 'is_new', '_mtime')
+
     def __init__(self, filepath: pathlib.Path, is_new: bool) -> None:
         super().__init__()
         self.filepath = filepath
@@ -59,31 +106,59 @@ class MaildirEmail(Email):
         return self.mtime() < other.mtime()
 
     def __hash__(self) -> int:
-        return hash(self.filepath)
+        return hash(self._path)
 
+    def _get_filepath(self) -> pathlib.Path:
+        return pathlib.Path(self._path)
+
+    def _set_filepath(self, filepath: pathlib.Path) -> None:
+        # A str is a fraction of the size of a Path, which adds up over a whole maildir.
+        self._path = str(filepath)
+
+    filepath = property(_get_filepath, _set_filepath)
+
+    def key(self) -> str:
+        """Return the unique part of the filename, as maildir_key() does, without building a Path."""
+        return os.path.basename(self._path).split(':')[0]
+
+    @timed('maildir.parse')
     def _get_headers(self):
-        return self.message()
+        if self.has_message():
+            return self.message()
+        with self.filepath.open('rb') as fp:
+            return self.header_parser.parsebytes(read_header_block(fp))
 
+    @timed('maildir.parse')
     def _get_message(self):
         with self.filepath.open('rb') as fp:
             return self.parser.parse(fp)
 
+    @timed('maildir.parse')
+    def _get_body(self):
+        with self.filepath.open('rb') as fp:
+            return extract_body_from_file(fp)
+
+    @timed('maildir.parse')
+    def _get_preview(self):
+        with self.filepath.open('rb') as fp:
+            data = fp.read(PREVIEW_READ_SIZE)
+            complete = len(data) < PREVIEW_READ_SIZE
+            preview = extract_preview(data, PREVIEW_SIZE, complete)
+            if preview is None and not complete:
+                # The text doesn't start until later on, e.g. after an attachment, if there is any.
+                body = extract_body_from_file(fp)
+                preview = None if body is None else body[:PREVIEW_SIZE]
+        return preview
+
     def _get_flags(self):
         return parse_maildir_flags(self.filepath)
 
-    def set_flag(self, flag, state):
-        if state and flag not in self._flags:
-            self._flags.append(flag)
-            self.filepath = update_maildir_flags(self.filepath, self._flags)
-            self.clear_flags()
-        elif flag in self._flags:
-            self._flags.remove(flag)
-            self.filepath = update_maildir_flags(self.filepath, self._flags)
-            self.clear_flags()
+    def _write_flags(self, changes):
+        rename_maildir_flags(changes)
 
     def mtime(self) -> float:
         if self._mtime == 0.0:
-            self._mtime = self.filepath.stat().st_mtime
+            self._mtime = _stat_mtime(self._path)
         return self._mtime
 
     def clear(self):
@@ -91,11 +166,221 @@ class MaildirEmail(Email):
         self._mtime = 0.0
 
 
-def poll_maildir(maildir: pathlib.Path, new_mail_event):
-    pass
+def _scan_maildir(maildir: pathlib.Path, index: MaildirIndex,
+                  missing: Optional[List[MaildirEmail]] = None) -> List[MaildirEmail]:
+    mails = []
+    unindexed = []  # type: List[Tuple[MaildirEmail, int, float]]
+    # Deliberately serial: listing and stat-ing is a small part of the scan next to the index lookups, which have to
+    # use the index's connection on this thread, and nearly all the mail is in cur/, so splitting by directory gains
+    # nothing.
+    for subdir, is_new in (('new', True), ('cur', False)):
+        for entry in os.scandir(str(maildir / subdir)):
+            if entry.name.startswith('.') or not entry.is_file():
+                continue
+            stat = entry.stat()
+            mail = MaildirEmail(pathlib.Path(entry.path), is_new)
+            mail._mtime = stat.st_mtime
+            summary = index.lookup(maildir_key(mail.filepath), stat.st_size, stat.st_mtime)
+            if summary is None:
+                unindexed.append((mail, stat.st_size, stat.st_mtime))
+            else:
+                mail.set_summary(summary)
+            mails.append(mail)
+    if missing is not None and len(unindexed) >= PARALLEL_LOAD_THRESHOLD:
+        missing.extend(mail for mail, _, _ in unindexed)
+    else:
+        for mail, size, mtime in unindexed:
+            index.store(maildir_key(mail.filepath), size, mtime, mail.summary())
+    index.prune()
+    index.commit()
+    return mails
+
 
+@timed('maildir.scan')
+def get_mail_from_maildir(maildir: pathlib.Path, index: Optional[MaildirIndex] = None,
+                          missing: Optional[List[MaildirEmail]] = None) -> List[MaildirEmail]:
+    """Load the emails in a maildir, newest first.
 
-def get_mail_from_maildir(maildir: pathlib.Path) -> List[MaildirEmail]:
+    :param pathlib.Path maildir: The maildir to load.
+    :param MaildirIndex index: If given, the summary headers are read from (and saved to) this index, so only new or
+        changed emails are parsed.
+    :param list missing: If given, and there are at least PARALLEL_LOAD_THRESHOLD emails that aren't in the index
+        (e.g. on the first start), they're appended to this list rather than being parsed, so they can be loaded by
+        a SummaryLoader.
+    :return: The emails in the maildir.
+    :rtype: list[MaildirEmail]
+    """
+    if index is not None:
+        return sorted(_scan_maildir(maildir, index, missing), reverse=True)
     newmail = [MaildirEmail(e, True) for e in (maildir / 'new').glob('*')]
     curmail = [MaildirEmail(e, False) for e in (maildir / 'cur').glob('*')]
     return sorted(newmail + curmail, reverse=True)
+
+
+def read_maildir_summaries(paths: List[str]) -> List[SummaryRecord]:
+    """Parse the summary headers of a batch of maildir files, e.g. in a worker process.
+
+    Only small tuples of strings are returned, which are cheap to send back from another process, unlike parsed
+    messages. Files that have been renamed or removed in the meantime are skipped.
+
+    :return: The path, size, mtime and summary tuple (see summary_from_headers()) of each file.
+    :rtype: list[tuple[str, int, float, tuple[str, ...]]]
+    """
+    results = []  # type: List[SummaryRecord]
+    for path in paths:
+        try:
+            with open(path, 'rb') as fp:
+                stat = os.fstat(fp.fileno())
+                headers = Email.header_parser.parsebytes(read_header_block(fp))
+        except FileNotFoundError:
+            continue
+        results.append((path, stat.st_size, stat.st_mtime, summary_from_headers(headers)))
+    return results
+
+
+class SummaryLoader:
+    """Parse the summary headers of many maildir emails in parallel, e.g. on the first start with a large maildir.
+
+    The emails are split into chunks that are parsed by read_maildir_summaries() on the executor, which should be a
+    ProcessPoolExecutor so the parsing isn't limited to one core. Each chunk is handed back through ``call_soon``,
+    e.g. ``EventLoop.call_soon_threadsafe``, so the emails are updated and the index written on the UI thread while the
+    rest are still being parsed. Until then, any email that's drawn parses its own headers as usual.
+
+    :param callable on_done: Called on the UI thread once every chunk has been loaded.
+    """
+
+    def __init__(self, executor: Executor, call_soon: Callable[[Callable[[], None]], None],
+                 index: Optional[MaildirIndex] = None, on_done: Optional[Callable[[], None]] = None,
+                 chunk_size: int = LOAD_CHUNK_SIZE) -> None:
+        self.executor = executor
+        self.call_soon = call_soon
+        self.index = index
+        self.on_done = on_done
+        self.chunk_size = chunk_size
+        self._pending = []  # type: List[Future]
+
+    def load(self, mails: List[MaildirEmail]) -> None:
+        for i in range(0, len(mails), self.chunk_size):
+            chunk = mails[i:i + self.chunk_size]
+            future = self.executor.submit(read_maildir_summaries, [mail._path for mail in chunk])
+            self._pending.append(future)
+            future.add_done_callback(lambda f, chunk=chunk: self.call_soon(lambda: self._loaded(chunk, f)))
+
+    def _loaded(self, chunk: List[MaildirEmail], future: Future) -> None:
+        self._pending.remove(future)
+        if not future.cancelled() and future.exception() is None:
+            by_path = {mail._path: mail for mail in chunk}
+            for path, size, mtime, summary in future.result():
+                mail = by_path.get(path)
+                if mail is None:
+                    continue
+                mail._summary = summary
+                if self.index is not None:
+                    self.index.store(maildir_key(pathlib.Path(path)), size, mtime, dict(zip(SUMMARY_HEADERS, summary)))
+            if self.index is not None:
+                self.index.commit()
+        if not self._pending:
+            self.executor.shutdown(wait=False)  # Free the workers straight away.
+            if self.on_done is not None:
+                self.on_done()
+
+    def close(self) -> None:
+        for future in self._pending:
+            future.cancel()
+        self.executor.shutdown(wait=True)
+
+
+def expunge_maildir_mail(mails: List[MaildirEmail]) -> List[MaildirEmail]:
+    """Permanently remove every email flagged as deleted, in one pass over the list.
+
+    :return: The emails that are left.
+    :rtype: list[MaildirEmail]
+    """
+    kept = []
+    for mail in mails:
+        if not mail.deleted():
+            kept.append(mail)
+            continue
+        try:
+            mail.filepath.unlink()
+        except FileNotFoundError:
+            pass
+    return kept
+
+
+class MaildirWatcher:
+    """Keep a list of emails in step with a maildir, using inotify events from its new/ and cur/ directories.
+
+    Deliveries, deletions and renames (i.e. flag changes, or moves from new/ to cur/) by other programs are applied to
+    the existing list, without rescanning the maildir. The watcher is driven by an event loop: register ``fileno()``
+    and call ``handle_events()`` whenever it's readable.
+    """
+
+    MASK = inotify.IN_MOVED_TO | inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_FROM | inotify.IN_DELETE | inotify.IN_ONLYDIR
+
+    def __init__(self, maildir: pathlib.Path, mails: List[MaildirEmail],
+                 on_change: Callable[[List[MaildirEmail]], None], index: Optional[MaildirIndex] = None) -> None:
+        self.maildir = maildir
+        self.mails = list(mails)
+        self.on_change = on_change
+        self.index = index
+        self._by_key = {maildir_key(m.filepath): m for m in self.mails}
+        self._inotify = inotify.Inotify()
+        self._dirs = {}  # type: Dict[int, Tuple[pathlib.Path, bool]]
+        for subdir, is_new in (('new', True), ('cur', False)):
+            wd = self._inotify.add_watch(str(maildir / subdir), self.MASK)
+            self._dirs[wd] = (maildir / subdir, is_new)
+
+    def fileno(self) -> int:
+        return self._inotify.fileno()
+
+    def close(self) -> None:
+        self._inotify.close()
+
+    def _insert(self, mail: MaildirEmail) -> None:
+        # New mail is almost always the newest, so a scan from the front is cheaper than a bisect on a key list.
+        i = 0
+        while i < len(self.mails) and mail < self.mails[i]:
+            i += 1
+        self.mails.insert(i, mail)
+        self._by_key[maildir_key(mail.filepath)] = mail
+
+    def _rescan(self) -> None:
+        self.mails = get_mail_from_maildir(self.maildir, self.index)
+        self._by_key = {maildir_key(m.filepath): m for m in self.mails}
+
+    def handle_events(self) -> None:
+        removed = {}  # type: Dict[str, MaildirEmail]
+        changed = False
+        for event in self._inotify.read():
+            if event.mask & inotify.IN_Q_OVERFLOW:
+                self._rescan()
+                self.on_change(self.mails)
+                return
+            if event.wd not in self._dirs or not event.name or event.name.startswith('.'):
+                continue
+            directory, is_new = self._dirs[event.wd]
+            path = directory / event.name
+            key = maildir_key(path)
+            mail = self._by_key.get(key)
+            if event.mask & (inotify.IN_MOVED_FROM | inotify.IN_DELETE):
+                # A rename shows up as a removal followed by an addition, so wait for the rest of the batch.
+                if mail is not None and mail.filepath == path:
+                    removed[key] = mail
+            elif mail is None:
+                self._insert(MaildirEmail(path, is_new))
+                changed = True
+            else:
+                removed.pop(key, None)
+                if mail.filepath != path:
+                    mail.filepath = path
+                    mail.is_new = is_new
+                    mail.clear_flags()
+                    changed = True
+        for key, mail in removed.items():
+            if not mail.filepath.exists():
+                del self._by_key[key]
+                self.mails.remove(mail)
+                changed = True
+        if changed:
+            self.on_change(list(self.mails))
@@ -0,0 +1,106 @@
+import hashlib
+import os
+import pathlib
+import sqlite3
+
+from contextlib import contextmanager
+from typing import Dict, Generator, Iterable, Optional, Set, Tuple
+
+from .email import SUMMARY_HEADERS
+
+
+SCHEMA_VERSION = 2
+
+
+def cache_dir() -> pathlib.Path:
+    """Return pynemail's cache directory, according to the XDG base directory spec."""
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return pathlib.Path(base) / 'pynemail'
+
+
+def default_index_path(maildir: pathlib.Path, suffix: str = '.sqlite') -> pathlib.Path:
+    digest = hashlib.sha1(str(maildir.resolve()).encode()).hexdigest()
+    return cache_dir() / (digest + suffix)
+
+
+class MaildirIndex:
+    """A persistent cache of the summary headers of each email in a maildir.
+
+    Entries are keyed by the unique part of the maildir filename, and are only valid while the size and mtime of the
+    file match those stored alongside them.
+    """
+
+    def __init__(self, path: pathlib.Path) -> None:
+        self._columns = ['header_' + name.lower().replace('-', '_') for name in SUMMARY_HEADERS]
+        self._db = sqlite3.connect(str(path))
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._create_schema()
+        self._entries = {}  # type: Dict[str, Tuple[int, float, Dict[str, str]]]
+        self._seen = set()  # type: Set[str]
+        self._load()
+
+    def _create_schema(self) -> None:
+        version = self._db.execute('PRAGMA user_version').fetchone()[0]
+        if version != SCHEMA_VERSION:
+            self._db.execute('DROP TABLE IF EXISTS messages')
+        self._db.execute('CREATE TABLE IF NOT EXISTS messages (key TEXT PRIMARY KEY, size INTEGER, mtime REAL, {})'
+                         .format(', '.join('{} TEXT'.format(c) for c in self._columns)))
+        self._db.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+        self._db.commit()
+
+    def _load(self) -> None:
+        rows = self._db.execute('SELECT key, size, mtime, {} FROM messages'.format(', '.join(self._columns)))
+        for row in rows:
+            self._entries[row[0]] = (row[1], row[2], dict(zip(SUMMARY_HEADERS, row[3:])))
+
+    def lookup(self, key: str, size: int, mtime: float) -> Optional[Dict[str, str]]:
+        """Return the stored summary for the given email, if it is still up to date.
+
+        :param str key: The unique part of the maildir filename.
+        :param int size: The current size of the file.
+        :param float mtime: The current modification time of the file.
+        :return: The summary headers, or None if the email has to be parsed again.
+        :rtype: dict[str, str]
+        """
+        self._seen.add(key)
+        entry = self._entries.get(key)
+        if entry is None or entry[0] != size or entry[1] != mtime:
+            return None
+        return entry[2]
+
+    def store(self, key: str, size: int, mtime: float, summary: Dict[str, str]) -> None:
+        self._seen.add(key)
+        self._entries[key] = (size, mtime, summary)
+        placeholders = ', '.join('?' * len(self._columns))
+        self._db.execute('INSERT OR REPLACE INTO messages VALUES (?, ?, ?, {})'.format(placeholders),
+                         [key, size, mtime] + [summary.get(name, '') for name in SUMMARY_HEADERS])
+
+    def remove(self, keys: Iterable[str]) -> None:
+        keys = list(keys)
+        for key in keys:
+            self._entries.pop(key, None)
+            self._seen.discard(key)
+        self._db.executemany('DELETE FROM messages WHERE key = ?', ((k, ) for k in keys))
+
+    def prune(self) -> None:
+        """Forget every entry that hasn't been looked up or stored since the index was opened."""
+        self.remove([key for key in self._entries if key not in self._seen])
+
+    def commit(self) -> None:
+        self._db.commit()
+
+    def close(self) -> None:
+        self._db.commit()
+        self._db.close()
+
+
+@contextmanager
+def maildir_index(maildir: pathlib.Path, path: Optional[pathlib.Path] = None) -> Generator:
+    path = default_index_path(maildir) if path is None else path
+    path.parent.mkdir(parents=True, exist_ok=True)
+    index = MaildirIndex(path)
+    try:
+        yield index
+    finally:
+        index.close()
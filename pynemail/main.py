@@ -1,15 +1,35 @@
 import argparse
 import curses
+import getpass
 import os
 import pathlib
-import time
+import sqlite3
+import sys
 
-from concurrent.futures import ThreadPoolExecutor
-from contextlib import ExitStack
-from multiprocessing import Event, Process
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack, closing
+from typing import List, Optional
 
-from .imapclient import imap_client, get_mail_from_imap, poll_imap_server
-from .maildirclient import get_mail_from_maildir, poll_maildir
+from .cache import parse_size
+from .email import NO_BODY_TEXT, Email
+from .eventloop import EventLoop
+from .flagqueue import FlagQueue
+from .imapclient import (
+    ImapEmail, ImapFlagWriter, ImapIdleWatcher, connect_imap, fetch_imap_body, fetch_imap_preview, load_imap_summaries,
+)
+from .imapindex import imap_index
+from .imapmailbox import ImapMailbox
+from .imapmirror import ImapMirror, ImapMirrorSyncer
+from .imappool import ImapPool
+from .imapsearch import SORT_ORDERS, ImapSearch, ImapThreads
+from .maildirclient import (
+    MaildirEmail, MaildirWatcher, SummaryLoader, expunge_maildir_mail, get_mail_from_maildir, rename_maildir_flags,
+)
+from .maildirindex import default_index_path, maildir_index
+from .prefetch import PREVIEW_RADIUS, Prefetcher
+from .search import MailSearch, SearchIndex, SearchIndexer
+from .stats import STATS, STATS_HEADING, format_histogram
+from .threads import ThreadIndex
 
 from .ui import InboxPage
 
@@ -43,7 +63,43 @@ def parse_args():
                           help='The location of the maildir')
     mailtype.add_argument('--imap', action=CheckImapServerAction, metavar='SERVER',
                           help='The address (and/or port) of the IMAP server')
+    parser.add_argument('--mirror', metavar='DIR',
+                        help='Keep a mirror of the IMAP inbox in a maildir in DIR, and read it from there, syncing any '
+                             'changes in the background (requires --imap)')
+    parser.add_argument('--prefetch', type=int, default=2, metavar='N',
+                        help='Load the N emails either side of the selected one in the background (default: 2)')
+    parser.add_argument('--preview', type=int, default=0, metavar='LINES',
+                        help='Show the first LINES lines of the selected email below the list. Press v to show or '
+                             'hide it (default: 0, hidden)')
+    parser.add_argument('--cache-size', type=parse_size, default='64M', metavar='SIZE',
+                        help='The memory budget for parsed emails and bodies, e.g. 500K or 1G (default: 64M)')
+    parser.add_argument('--cache-entries', type=int, metavar='N',
+                        help='The maximum number of parsed emails and bodies to keep in memory')
+    parser.add_argument('--cache-stats', action='store_true',
+                        help="Print the cache's hit rate and resident size on exit")
+    parser.add_argument('--profile', metavar='FILE',
+                        help='Time every backend operation and frame, write a trace of them to FILE (in the Chrome '
+                             'trace event format), and print a summary on exit. Press p to see the times as you go')
+    parser.add_argument('--no-index', action='store_true',
+                        help="Don't keep a persistent index of the mailbox's headers (and for IMAP, its flags) in "
+                             "the cache directory")
+    parser.add_argument('--connections', type=int, default=3, metavar='N',
+                        help='The number of IMAP connections to keep open, one of which is kept for the UI, so '
+                             'prefetching never holds it up (default: 3, minimum: 2)')
+    parser.add_argument('--filter', default='ALL', metavar='CRITERIA',
+                        help="Only list the messages matching some IMAP SEARCH criteria, e.g. 'UNSEEN' or "
+                             "'FROM bob SINCE 1-Jan-2018' (IMAP only)")
+    parser.add_argument('--sort', choices=sorted(SORT_ORDERS), default='arrival',
+                        help='The order to list messages in, if the IMAP server supports SORT (default: arrival)')
     args = parser.parse_args()
+    if (args.maildir or args.mirror) and (args.filter != 'ALL' or args.sort != 'arrival'):
+        parser.error('--filter and --sort are only supported with --imap, without --mirror')
+    if args.mirror and not args.imap:
+        parser.error('--mirror requires --imap')
+    if args.preview < 0:
+        parser.error('--preview must not be negative')
+    if args.connections < 2:
+        parser.error('--connections must be at least 2')
     return args
 
 
@@ -58,56 +114,197 @@ def setup_curses(scr):
 def mainloop(scr, args):
     setup_curses(scr)
 
-    new_mail = Event()
-
     with ExitStack() as stack:
-        if args.maildir:
-            maildir = pathlib.Path(args.maildir)
-            get_mail = lambda: get_mail_from_maildir(maildir)
-            background_fn = lambda: poll_maildir(maildir, new_mail)
+        loop = EventLoop()
+        stack.callback(loop.close)
+        missing = []  # type: List[MaildirEmail]
+        maildir = None  # type: Optional[pathlib.Path]
+        if args.mirror:
+            # Everything is read from the mirror, and the syncer carries changes either way in the background.
+            password = scr.getstr().decode()
+            client = stack.enter_context(closing(ImapPool(lambda: connect_imap(args.imap, password),
+                                                          args.connections)))
+            mirror = stack.enter_context(closing(ImapMirror(pathlib.Path(args.mirror), client)))
+            syncer = ImapMirrorSyncer(mirror)
+            # Stopped after the flag queue is flushed, so the last sync includes any changes still queued.
+            stack.callback(syncer.stop)
+        if args.maildir or args.mirror:
+            maildir = pathlib.Path(args.maildir or args.mirror)
+            index = None if args.no_index else stack.enter_context(maildir_index(maildir))
+            get_mail = lambda: get_mail_from_maildir(maildir, index, missing)
+            preload = None
+            fetch = lambda email: email.load_body()
+            fetch_preview = lambda email: email.load_preview()
+            executor = ThreadPoolExecutor(max_workers=4)
+            email_class = MaildirEmail
+            flag_writer = None
+            threads = ThreadIndex()
+            if args.mirror:
+                # Just the files that changed are pushed to the server, rather than syncing the whole mailbox.
+                def _push_flag_changes(changes):
+                    rename_maildir_flags(changes)
+                    syncer.request(mail.filepath for batch in changes.values() for mail in batch)
+
+                def _expunge_and_push(mails):
+                    left = expunge_maildir_mail(mails)
+                    kept = {id(mail) for mail in left}
+                    syncer.request(mail.filepath for mail in mails if id(mail) not in kept)
+                    return left
+                write_flags, expunge_mail = _push_flag_changes, _expunge_and_push
+            else:
+                write_flags, expunge_mail = rename_maildir_flags, expunge_maildir_mail
         elif args.imap:
-            client = stack.enter_context(imap_client(args.imap, scr.getstr().decode()))
-            get_mail = lambda: get_mail_from_imap(client)
-            background_fn = lambda: poll_imap_server(client, new_mail)
+            password = scr.getstr().decode()
+            index = None if args.no_index else stack.enter_context(imap_index(args.imap, getpass.getuser()))
+            client = stack.enter_context(closing(ImapPool(lambda: connect_imap(args.imap, password),
+                                                          args.connections)))
+            mailbox = ImapMailbox(client, index, args.filter, args.sort)
+            stack.callback(mailbox.save)
+            get_mail = lambda: mailbox.list(preload=False)
+            preload = lambda mails: load_imap_summaries(client, mails)
+
+            def fetch(email):
+                # On a background connection, so the UI's requests never wait for it.
+                with client.connection() as con:
+                    return fetch_imap_body(con, email.uid()) or NO_BODY_TEXT
+
+            def fetch_preview(email):
+                with client.connection() as con:
+                    return fetch_imap_preview(con, email.uid()) or NO_BODY_TEXT
+            # One worker for each background connection, as imaplib connections aren't thread-safe.
+            executor = ThreadPoolExecutor(max_workers=client.size - 1)
+            email_class = ImapEmail
+            # Flushes only queue the STOREs, so they never hold up the UI.
+            flag_writer = ImapFlagWriter(client, loop.call_soon_threadsafe)
+            stack.callback(flag_writer.close)
+            write_flags, expunge_mail = flag_writer.write, mailbox.expunge
+            threads = ImapThreads(client, args.filter)
         else:
             raise Exception("Argh! How'd I get here!")
 
         scr.nodelay(True)
+        flag_queue = FlagQueue(write_flags, loop.call_later)
+        email_class.flag_queue = flag_queue
+        stack.callback(flag_queue.flush)
+        prefetcher = Prefetcher(executor, fetch, loop.call_soon_threadsafe, args.prefetch)
+        stack.callback(prefetcher.close)
+        # Previews are small, so a single worker keeps up, and they aren't queued behind the bodies, though for IMAP
+        # they share the background connections with them.
+        previewer = Prefetcher(ThreadPoolExecutor(max_workers=1), fetch_preview, loop.call_soon_threadsafe,
+                               PREVIEW_RADIUS, Email.has_preview, Email.set_preview)
+        stack.callback(previewer.close)
         mail = get_mail()
-        page = InboxPage(scr, mail)
+        if missing:
+            # Start the worker processes now, before any threads are, as they're forked.
+            loader = SummaryLoader(ProcessPoolExecutor(), loop.call_soon_threadsafe, index,
+                                   lambda: set_mail(page.all_mail))
+            stack.callback(loader.close)
+            loader.load(missing)
 
-        #background_process = Process(target=background_fn, daemon=True)
-        #background_process.start()
+        def expunge(mails):
+            # Write any pending deletions first, so they're included.
+            flag_queue.flush()
+            if flag_writer is not None:
+                flag_writer.wait()
+            return expunge_mail(mails)
 
-        while True:
-            page.render()
+        search = None
+        on_change = []  # type: list
+        if maildir is not None and index is not None:
+            search_path = default_index_path(maildir, '.search.sqlite')
+            try:
+                search_index = SearchIndex(search_path)
+            except sqlite3.OperationalError:
+                pass  # SQLite was built without FTS5.
+            else:
+                stack.callback(search_index.close)
+                search = MailSearch(search_index, MaildirEmail.key)
+                indexer = SearchIndexer(search_path, MaildirEmail.key, lambda email: email.load_body())
+                indexer.start()
+                stack.callback(indexer.stop)
+                if not missing:
+                    indexer.update(mail)  # Otherwise, once the summaries have been loaded.
+                on_change.append(indexer.update)
+        elif maildir is None:
+            search = ImapSearch(client)
 
-            page.refresh()
-            key = -1
-            while key == -1:
+        page = InboxPage(scr, mail, preload, prefetcher.update if args.prefetch > 0 else None, expunge, search,
+                         threads.threads, previewer.update, args.preview)
+        on_change.insert(0, page.set_mail)
+        if maildir is not None:
+            on_change.append(threads.update)
+
+        def set_mail(mails):
+            for callback in on_change:
+                callback(mails)
+
+        if maildir is not None:
+            try:
+                watcher = MaildirWatcher(maildir, mail, set_mail, index)
+            except OSError:
+                pass  # No inotify, so new mail only shows up on the next start.
+            else:
+                stack.callback(watcher.close)
+                loop.add_reader(watcher.fileno(), watcher.handle_events)
+        if args.mirror:
+            # Started once the watcher is, so it sees every message the syncer delivers. The IDLE watcher just says
+            # when there's something new to sync.
+            syncer.start()
+            idle_watcher = ImapIdleWatcher(lambda: connect_imap(args.imap, password), lambda updates: syncer.request())
+            idle_watcher.start()
+            stack.callback(idle_watcher.stop)
+        elif args.imap:
+            def apply_updates():
+                # The watcher's sequence numbers may not match the UI connection's, e.g. after an expunge, so its
+                # updates only say when to ask the UI connection what's changed.
+                set_mail(mailbox.refresh(page.all_mail))
+                # The updates may predate local changes that are still queued, so write those now, and let the
+                # server's reply put them back.
+                flag_queue.flush()
+
+            def on_updates(updates):
+                loop.call_soon_threadsafe(apply_updates)
+            idle_watcher = ImapIdleWatcher(lambda: connect_imap(args.imap, password), on_updates)
+            idle_watcher.start()
+            stack.callback(idle_watcher.stop)
+
+        def handle_input():
+            key = scr.getch()
+            while key != -1:
+                if key == curses.KEY_RESIZE:
+                    pass  # TODO: Something!
+                # Pages get the first go at every key, so that e.g. a search can include a q.
+                elif page.keypress(key) and (key == ord('q') or key == ord('Q')):
+                    loop.stop()
+                    return
                 key = scr.getch()
-                time.sleep(0.02)
-                #if new_mail.wait(0.02):
-                #    mail = get_mail()
-                #    page.set_mail(mail)
-                #    scr.clear()
-                #    page.render()
-                #    page.refresh()
-                    #scr.addstr(40, 0, str(client.recent()))
-                    #page.refresh()
-            #scr.addstr(40, 0, str(key))
-            #page.refresh()
-            if key == ord('q') or key == ord('Q'):
-                break
-            elif key == curses.KEY_RESIZE:
-                pass  # TODO: Something!
-            page.keypress(key)
+
+        def redraw():
+            with STATS.timer('ui.render'):
+                page.render()
+            page.refresh()
+
+        loop.add_reader(sys.stdin.fileno(), handle_input)
+        redraw()
+        loop.run(after=redraw)
 
 
 def main():
     args = parse_args()
+    Email.cache.resize(args.cache_size, args.cache_entries)
     os.environ.setdefault('ESCDELAY', '25')
-    curses.wrapper(mainloop, args)
+    if args.profile:
+        STATS.enable(open(args.profile, 'w'))
+    try:
+        curses.wrapper(mainloop, args)
+    finally:
+        STATS.close()
+    if args.cache_stats:
+        print('Cache: {}'.format(Email.cache.stats()), file=sys.stderr)
+    if args.profile:
+        print(STATS_HEADING, file=sys.stderr)
+        for name, histogram in STATS.summary():
+            print(format_histogram(name, histogram), file=sys.stderr)
 
 
 if __name__ == "__main__":
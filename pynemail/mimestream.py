@@ -0,0 +1,165 @@
+import mmap
+import re
+
+from email.message import EmailMessage
+from email.parser import BytesHeaderParser, BytesParser
+from email.policy import default as default_policy
+from typing import BinaryIO, List, Optional, Tuple
+
+# The data can be bytes or an mmap; both support find(), slicing and regex matching, so nothing but the headers of
+# each part and the chosen text part itself is ever copied out of it.
+
+_parser = BytesParser(policy=default_policy)
+_header_parser = BytesHeaderParser(policy=default_policy)
+
+_NEWLINE = re.compile(rb'\r?\n')
+_BLANK_LINE = re.compile(rb'\n\r?\n')
+
+Span = Tuple[int, int]
+
+
+def _parse_headers(data, start: int, end: int) -> Tuple[EmailMessage, int]:
+    """Parse the headers of the entity in data[start:end], returning them and the offset at which its body starts."""
+    match = _NEWLINE.match(data, start, end)
+    if match:
+        return _header_parser.parsebytes(b''), match.end()
+    match = _BLANK_LINE.search(data, start, end)
+    if match is None:
+        return _header_parser.parsebytes(data[start:end]), end
+    return _header_parser.parsebytes(data[start:match.start() + 1]), match.end()
+
+
+def _find_delimiter(data, delimiter: bytes, start: int, end: int) -> int:
+    """Find the next boundary delimiter that starts a line, and isn't just the start of a longer boundary."""
+    i = data.find(delimiter, start, end)
+    while i >= 0:
+        after = data[i + len(delimiter):i + len(delimiter) + 1]
+        if (i == start or data[i - 1:i] == b'\n') and after in (b'', b'-', b'\r', b'\n', b' ', b'\t'):
+            return i
+        i = data.find(delimiter, i + 1, end)
+    return -1
+
+
+def split_multipart(data, start: int, end: int, boundary: str) -> List[Span]:
+    """Return the spans of the parts in the body of a multipart entity, each including the part's own headers.
+
+    The preamble, the epilogue and any empty parts are skipped, and a missing close delimiter ends the last part at the
+    end of the body.
+    """
+    delimiter = b'--' + boundary.encode('ascii', 'replace')
+    spans = []  # type: List[Span]
+    part_start = None  # type: Optional[int]
+    i = _find_delimiter(data, delimiter, start, end)
+    while i >= 0:
+        if part_start is not None:
+            # The line break before a delimiter belongs to the delimiter.
+            part_end = i
+            if data[part_end - 1:part_end] == b'\n':
+                part_end -= 1
+                if data[part_end - 1:part_end] == b'\r':
+                    part_end -= 1
+            if part_end > part_start:
+                spans.append((part_start, part_end))
+            part_start = None
+        if data[i + len(delimiter):i + len(delimiter) + 2] == b'--':
+            return spans
+        line_end = data.find(b'\n', i, end)
+        if line_end < 0:
+            return spans
+        part_start = line_end + 1
+        i = _find_delimiter(data, delimiter, part_start, end)
+    if part_start is not None:
+        spans.append((part_start, end))
+    return spans
+
+
+def find_text_part(data, start: int = 0, end: Optional[int] = None,
+                   default_type: str = 'text/plain') -> Optional[Span]:
+    """Find the plain text body of a message, following the rules of ``EmailMessage.get_body(('plain', ))``.
+
+    Only the headers of each part are parsed, so the cost depends on the number of parts rather than their size.
+
+    :param data: The message, as bytes or an mmap.
+    :return: The span of the text part, including its headers, or None if there isn't one.
+    :rtype: tuple[int, int]
+    """
+    end = len(data) if end is None else end
+    headers, body_start = _parse_headers(data, start, end)
+    headers.set_default_type(default_type)
+    if headers.is_attachment():
+        return None
+    maintype, subtype = headers.get_content_type().split('/')
+    if maintype == 'text':
+        return (start, end) if subtype == 'plain' else None
+    boundary = headers.get_boundary()
+    if maintype != 'multipart' or boundary is None:
+        return None
+    spans = split_multipart(data, body_start, end, boundary)
+    if subtype == 'related' and spans:
+        # Only the root part of a multipart/related can be the body.
+        root = headers.get_param('start')
+        matches = [s for s in spans if root and _parse_headers(data, s[0], s[1])[0]['content-id'] == root]
+        spans = matches[:1] or spans[:1]
+    child_type = 'message/rfc822' if subtype == 'digest' else 'text/plain'
+    for part_start, part_end in spans:
+        found = find_text_part(data, part_start, part_end, child_type)
+        if found is not None:
+            return found
+    return None
+
+
+def decode_text_part(entity: bytes) -> str:
+    """Decode a single text part, given its headers and its (transfer encoded) body."""
+    return _parser.parsebytes(entity).get_content()
+
+
+def extract_body(data) -> Optional[str]:
+    """Return the decoded plain text body of a message, without decoding any of its other parts.
+
+    :param data: The message, as bytes or an mmap.
+    :return: The text, or None if the message doesn't have a plain text body.
+    :rtype: str
+    """
+    span = find_text_part(data)
+    if span is None:
+        return None
+    return decode_text_part(data[span[0]:span[1]])
+
+
+def extract_preview(data, size: int, complete: bool = True) -> Optional[str]:
+    """Return the decoded start of the plain text body of a message, decoding no more than ``size`` bytes of it.
+
+    The text is cut at a line break, so a multi-byte character or a line of base64 is never split.
+
+    :param data: The message, as bytes or an mmap, or just the start of it.
+    :param int size: The most bytes of the (transfer encoded) text part to decode.
+    :param bool complete: False if data is only the start of the message, so the text part may have been cut short.
+    :return: The start of the text, or None if the message doesn't have a plain text body, or if it isn't complete
+        and the text part doesn't start in the data given.
+    :rtype: str
+    """
+    span = find_text_part(data)
+    if span is None:
+        return None
+    start, end = span
+    body_start = _parse_headers(data, start, end)[1]
+    if not complete and body_start >= len(data):
+        return None  # The text part's headers may have been cut short.
+    body = data[body_start:min(end, body_start + size)]
+    cut = end - body_start > size or (not complete and end == len(data))
+    if cut:
+        line_end = body.rfind(b'\n')
+        if line_end >= 0:
+            body = body[:line_end + 1]
+    text = decode_text_part(data[start:body_start] + body)
+    # A line of base64 or quoted-printable can still end part way through a multi-byte character.
+    return text.rstrip('\ufffd\r\n') if cut else text
+
+
+def extract_body_from_file(fp: BinaryIO) -> Optional[str]:
+    """Like extract_body(), but reading the message through an mmap of the file so only the text part is read."""
+    fp.seek(0, 2)
+    if fp.tell() == 0:
+        return extract_body(b'')
+    with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        return extract_body(data)
@@ -0,0 +1,64 @@
+from concurrent.futures import Executor, Future
+from typing import Callable, Dict, List, Tuple
+
+from .email import Email
+
+
+# Previews are small, so many more of them are fetched ahead of the selection than bodies.
+PREVIEW_RADIUS = 10
+
+
+class Prefetcher:
+    """Fetch and decode the bodies of the emails around the selected one in the background.
+
+    ``fetch`` is called on a worker thread and should return the decoded body without touching the email's caches,
+    e.g. ``Email.load_body``.
+
+    Results are handed back through ``call_soon``, e.g. ``EventLoop.call_soon_threadsafe``, so that the emails' caches
+    are only ever filled on the UI thread. Nothing is marked as read until the email is actually opened.
+
+    The same goes for previews, with ``Email.load_preview`` to fetch them, ``loaded=Email.has_preview`` and
+    ``store=Email.set_preview``.
+    """
+
+    def __init__(self, executor: Executor, fetch: Callable[[Email], str],
+                 call_soon: Callable[[Callable[[], None]], None], radius: int = 2,
+                 loaded: Callable[[Email], bool] = Email.has_body,
+                 store: Callable[[Email, str], None] = Email.set_body) -> None:
+        self.executor = executor
+        self.fetch = fetch
+        self.call_soon = call_soon
+        self.radius = radius
+        self.loaded = loaded
+        self.store = store
+        self._pending = {}  # type: Dict[int, Tuple[Email, Future]]
+
+    def _done(self, email: Email, future: Future) -> None:
+        def store():
+            if self._pending.get(id(email), (None, None))[1] is future:
+                del self._pending[id(email)]
+            if not future.cancelled() and future.exception() is None and not self.loaded(email):
+                self.store(email, future.result())
+        self.call_soon(store)
+
+    def update(self, mails: List[Email], selected: int) -> None:
+        """Prefetch the selected email first, then its neighbours, dropping any queued work that's now out of range."""
+        wanted = []  # type: List[Email]
+        for distance in range(self.radius + 1):
+            for i in sorted({selected + distance, selected - distance}):
+                if 0 <= i < len(mails) and not self.loaded(mails[i]):
+                    wanted.append(mails[i])
+        wanted_ids = {id(email) for email in wanted}
+        for key, (email, future) in list(self._pending.items()):
+            if key not in wanted_ids and future.cancel():
+                del self._pending[key]
+        for email in wanted:
+            if id(email) not in self._pending:
+                future = self.executor.submit(self.fetch, email)
+                self._pending[id(email)] = (email, future)
+                future.add_done_callback(lambda f, email=email: self._done(email, f))
+
+    def close(self) -> None:
+        for _, future in self._pending.values():
+            future.cancel()
+        self.executor.shutdown(wait=True)
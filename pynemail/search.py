@@ -0,0 +1,200 @@
+import pathlib
+import queue
+import re
+import sqlite3
+import threading
+
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+from .email import Email
+
+
+SCHEMA_VERSION = 1
+COMMIT_INTERVAL = 500
+
+_WORD = re.compile(r'\w+')
+
+
+def search_words(text: str) -> List[str]:
+    return _WORD.findall(text)
+
+
+def build_query(text: str) -> Optional[str]:
+    """Turn what the user typed into an FTS5 query matching every word, the last one (still being typed) as a prefix.
+
+    >>> build_query('bob lun')
+    '"bob" "lun"*'
+    """
+    words = search_words(text)
+    if not words:
+        return None
+    terms = ['"{}"'.format(word) for word in words]
+    if not text[-1:].isspace():
+        terms[-1] += '*'
+    return ' '.join(terms)
+
+
+class SearchIndex:
+    """A persistent full text index of the sender, subject and body of each email, using SQLite's FTS5.
+
+    Emails are identified by a string key that mustn't change for the lifetime of the email, e.g. the unique part of a
+    maildir filename. The sender and subject are indexed as soon as an email is added, and its body may follow later.
+
+    :raises sqlite3.OperationalError: If SQLite was built without FTS5.
+    """
+
+    def __init__(self, path: pathlib.Path) -> None:
+        self._db = sqlite3.connect(str(path), timeout=30)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._create_schema()
+
+    def _create_schema(self) -> None:
+        version = self._db.execute('PRAGMA user_version').fetchone()[0]
+        if version != SCHEMA_VERSION:
+            self._db.execute('DROP TABLE IF EXISTS documents')
+            self._db.execute('DROP TABLE IF EXISTS search')
+        self._db.execute('CREATE TABLE IF NOT EXISTS documents (id INTEGER PRIMARY KEY, key TEXT UNIQUE, '
+                         'has_body INTEGER)')
+        self._db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS search USING fts5(sender, subject, body, prefix='2 3')")
+        self._db.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+        self._db.commit()
+
+    def documents(self) -> Dict[str, bool]:
+        """Return the key of every indexed email, and whether its body has been indexed."""
+        return {key: bool(has_body) for key, has_body in self._db.execute('SELECT key, has_body FROM documents')}
+
+    def add(self, key: str, sender: str, subject: str, body: Optional[str] = None) -> None:
+        """Index an email, replacing any earlier entry with the same key."""
+        self.remove([key])
+        cursor = self._db.execute('INSERT INTO documents (key, has_body) VALUES (?, ?)', (key, body is not None))
+        self._db.execute('INSERT INTO search (rowid, sender, subject, body) VALUES (?, ?, ?, ?)',
+                         (cursor.lastrowid, sender, subject, body or ''))
+
+    def set_body(self, key: str, body: str) -> None:
+        row = self._db.execute('SELECT id FROM documents WHERE key = ?', (key, )).fetchone()
+        if row is None:
+            return
+        self._db.execute('UPDATE search SET body = ? WHERE rowid = ?', (body, row[0]))
+        self._db.execute('UPDATE documents SET has_body = 1 WHERE id = ?', (row[0], ))
+
+    def remove(self, keys: Iterable[str]) -> None:
+        for key in keys:
+            row = self._db.execute('SELECT id FROM documents WHERE key = ?', (key, )).fetchone()
+            if row is not None:
+                self._db.execute('DELETE FROM search WHERE rowid = ?', (row[0], ))
+                self._db.execute('DELETE FROM documents WHERE id = ?', (row[0], ))
+
+    def search(self, text: str) -> Set[str]:
+        """Return the keys of the emails matching every word of the given text.
+
+        :param str text: The words to search for, as typed by the user.
+        :return: The matching keys, or an empty set if the text has no words in it.
+        :rtype: set[str]
+        """
+        query = build_query(text)
+        if query is None:
+            return set()
+        rows = self._db.execute('SELECT documents.key FROM search JOIN documents ON documents.id = search.rowid '
+                                'WHERE search MATCH ?', (query, ))
+        return {key for key, in rows}
+
+    def commit(self) -> None:
+        self._db.commit()
+
+    def close(self) -> None:
+        self._db.commit()
+        self._db.close()
+
+
+class SearchIndexer(threading.Thread):
+    """Keep a SearchIndex in step with a list of emails, on a background thread with its own connection.
+
+    Whenever the list changes, pass it to update(). Emails that have gone are removed from the index, new ones have
+    their sender and subject indexed at once, and then their bodies are loaded and indexed one at a time, committing
+    as it goes so searches find them straight away. Starting over whenever a newer list arrives keeps the work
+    proportional to what has changed, as everything already indexed is skipped.
+
+    :param pathlib.Path path: The index's database file.
+    :param callable key: Returns an email's key in the index.
+    :param callable load_body: Loads an email's body; it's called on the indexer's thread.
+    """
+
+    def __init__(self, path: pathlib.Path, key: Callable[[Email], str], load_body: Callable[[Email], str]) -> None:
+        super().__init__(daemon=True)
+        self.path = path
+        self.key = key
+        self.load_body = load_body
+        self._queue = queue.Queue()  # type: queue.Queue
+        self._stopped = threading.Event()
+
+    def update(self, mails: List[Email]) -> None:
+        self._queue.put(list(mails))
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._queue.put(None)
+        self.join()
+
+    def _next(self) -> Optional[List[Email]]:
+        mails = self._queue.get()
+        while not self._queue.empty():
+            mails = self._queue.get()
+        return mails
+
+    def run(self) -> None:
+        index = SearchIndex(self.path)
+        try:
+            mails = self._next()
+            while mails is not None and not self._stopped.is_set():
+                self.sync(index, mails)
+                mails = self._next()
+        finally:
+            index.close()
+
+    def sync(self, index: SearchIndex, mails: List[Email]) -> None:
+        by_key = {self.key(mail): mail for mail in mails}
+        documents = index.documents()
+        index.remove(key for key in documents if key not in by_key)
+        for key, mail in by_key.items():
+            if key not in documents:
+                try:
+                    index.add(key, mail.summary()['From'], mail.subject())
+                except OSError:
+                    continue  # As for the bodies, below.
+        index.commit()
+        pending = [(key, mail) for key, mail in by_key.items() if not documents.get(key)]
+        for i, (key, mail) in enumerate(pending, 1):
+            if self._stopped.is_set() or not self._queue.empty():
+                break
+            try:
+                index.set_body(key, self.load_body(mail))
+            except OSError:
+                continue  # Gone, or renamed under us; the next update will catch up with it.
+            if i % COMMIT_INTERVAL == 0:
+                index.commit()
+        index.commit()
+
+
+class MailSearch:
+    """Filter a list of emails through a SearchIndex, keeping their order.
+
+    The emails' keys are worked out once by start(), so that each query (i.e. each key press) only costs an index
+    lookup and one pass over the list.
+    """
+
+    def __init__(self, index: SearchIndex, key: Callable[[Email], str]) -> None:
+        self.index = index
+        self.key = key
+        self._mails = []  # type: List[Email]
+        self._keys = []  # type: List[str]
+
+    def start(self, mails: List[Email]) -> None:
+        self._mails = list(mails)
+        self._keys = [self.key(mail) for mail in mails]
+
+    def filter(self, text: str) -> List[Email]:
+        if build_query(text) is None:
+            return self._mails
+        found = self.index.search(text)
+        return [mail for mail, key in zip(self._mails, self._keys) if key in found]
@@ -0,0 +1,167 @@
+import functools
+import os
+import threading
+import time
+
+from typing import Any, Callable, Dict, List, Optional, TextIO, Tuple
+
+
+# Bucket i of a histogram counts the operations that took less than 2 ** i microseconds (and at least half that);
+# the last one also counts anything slower.
+HISTOGRAM_BUCKETS = 25
+
+
+class Histogram:
+    """The number and total time of an operation, and a histogram of its latencies on a log scale."""
+
+    __slots__ = ('buckets', 'count', 'total', 'max')
+
+    def __init__(self) -> None:
+        self.buckets = [0] * HISTOGRAM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float) -> None:
+        micros = int(seconds * 1000000)
+        self.buckets[min(micros.bit_length(), HISTOGRAM_BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, percent: float) -> float:
+        """Return an upper bound on the given percentile, in seconds, to within a factor of two.
+
+        >>> histogram = Histogram()
+        >>> for seconds in (0.001, 0.002, 0.003, 0.1):
+        ...     histogram.add(seconds)
+        >>> histogram.percentile(50), histogram.percentile(100)
+        (0.002048, 0.1)
+        """
+        remaining = self.count * percent / 100
+        for i, count in enumerate(self.buckets):
+            remaining -= count
+            if remaining <= 0 and count and i < HISTOGRAM_BUCKETS - 1:
+                return min((1 << i) / 1000000, self.max)
+        return self.max
+
+
+class _Timer:
+
+    __slots__ = ('stats', 'name', 'start')
+
+    def __init__(self, stats: 'Stats', name: str) -> None:
+        self.stats = stats
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self) -> None:
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stats.record(self.name, self.start, time.perf_counter() - self.start)
+
+
+class _NullTimer:
+
+    def __enter__(self) -> None:
+        pass
+
+    def __exit__(self, *exc_info) -> None:
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Stats:
+    """Latency histograms for named operations, e.g. 'imap.fetch' or 'ui.render', and optionally a trace of each one.
+
+    Nothing is recorded until ``enable()`` is called. Until then, ``timed()`` functions just check ``enabled`` before
+    calling the original, and ``timer()`` returns a shared object that does nothing, so instrumentation can be left in
+    the hot paths.
+
+    The trace is written in the Chrome trace event format, one complete ("X") event per line, so it can be loaded
+    into chrome://tracing or Perfetto even if pynemail didn't exit cleanly.
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.histograms = {}  # type: Dict[str, Histogram]
+        self._trace = None  # type: Optional[TextIO]
+        self._epoch = 0.0
+        self._lock = threading.Lock()
+
+    def enable(self, trace: Optional[TextIO] = None) -> None:
+        """Start recording, and if given, writing a trace to the file."""
+        with self._lock:
+            if trace is not None and self._trace is None:
+                self._trace = trace
+                self._epoch = time.perf_counter()
+                trace.write('[\n')
+            self.enabled = True
+
+    def disable(self) -> None:
+        """Stop recording, keeping what has been recorded so far."""
+        with self._lock:
+            self.enabled = False
+
+    def close(self) -> None:
+        """Stop recording, and close the trace file, if there is one."""
+        with self._lock:
+            self.enabled = False
+            if self._trace is not None:
+                self._trace.close()
+                self._trace = None
+
+    def record(self, name: str, start: float, seconds: float) -> None:
+        """Record an operation that started at the given time.perf_counter() value and took the given time."""
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(seconds)
+            if self._trace is not None:
+                self._trace.write('{{"name":"{}","ph":"X","ts":{:.1f},"dur":{:.1f},"pid":{},"tid":{}}},\n'.format(
+                    name, (start - self._epoch) * 1000000, seconds * 1000000, os.getpid(), threading.get_ident()))
+
+    def timer(self, name: str) -> Any:
+        """Return a context manager that records the time taken by its body, if recording is enabled."""
+        return _Timer(self, name) if self.enabled else _NULL_TIMER
+
+    def timed(self, name: str) -> Callable[[Callable], Callable]:
+        """Decorate a function to record the time taken by each call, if recording is enabled."""
+        def decorator(func: Callable) -> Callable:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.record(name, start, time.perf_counter() - start)
+            return wrapper
+        return decorator
+
+    def summary(self) -> List[Tuple[str, Histogram]]:
+        with self._lock:
+            return sorted(self.histograms.items())
+
+
+STATS = Stats()
+timed = STATS.timed
+
+
+def format_histogram(name: str, histogram: Histogram) -> str:
+    return '{:<16} {:>7} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}'.format(
+        name, histogram.count, histogram.mean * 1000, histogram.percentile(50) * 1000,
+        histogram.percentile(95) * 1000, histogram.max * 1000)
+
+
+STATS_HEADING = '{:<16} {:>7} {:>9} {:>9} {:>9} {:>9}'.format('operation', 'count', 'mean ms', 'p50 ms', 'p95 ms',
+                                                              'max ms')
@@ -0,0 +1,178 @@
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+
+from .email import Email
+
+
+class Container:
+    """A node in a thread: a message, or a placeholder for one that's referred to but missing (JWZ's "container")."""
+
+    __slots__ = ('email', 'parent', 'children')
+
+    def __init__(self, email: Optional[Email] = None) -> None:
+        self.email = email
+        self.parent = None  # type: Optional[Container]
+        # Keyed by id(), so a reply can be moved to another parent without searching a long thread for it.
+        self.children = OrderedDict()  # type: Dict[int, Container]
+
+    def is_ancestor_of(self, other: 'Container') -> bool:
+        while other is not None:
+            if other is self:
+                return True
+            other = other.parent
+        return False
+
+    def root(self) -> 'Container':
+        container = self
+        while container.parent is not None:
+            container = container.parent
+        return container
+
+    def set_parent(self, parent: Optional['Container']) -> None:
+        if self.parent is not None:
+            del self.parent.children[id(self)]
+        self.parent = parent
+        if parent is not None:
+            parent.children[id(self)] = self
+
+
+class ThreadIndex:
+    """Group emails into conversations by their Message-ID and References, using JWZ's threading algorithm.
+
+    See https://www.jwz.org/doc/threading.html. The id table is kept between calls, so adding an email only links it
+    into the threads it refers to, at a cost proportional to the length of its References; new mail never causes a
+    full re-thread. Missing messages are kept as empty containers rather than being pruned from the tree, and are
+    skipped when a thread is flattened, so removing an email is as cheap as adding one. Emails are only grouped by
+    their references, not by subject.
+    """
+
+    def __init__(self) -> None:
+        self._by_id = {}  # type: Dict[str, Container]
+        self._by_email = {}  # type: Dict[int, Container]
+
+    def __len__(self) -> int:
+        return len(self._by_email)
+
+    def _container(self, message_id: str) -> Container:
+        container = self._by_id.get(message_id)
+        if container is None:
+            container = self._by_id[message_id] = Container()
+        return container
+
+    def _link(self, parent: Container, child: Container) -> None:
+        # Never introduce a loop, e.g. from two messages that each claim to reply to the other.
+        if child is not parent and not child.is_ancestor_of(parent):
+            child.set_parent(parent)
+
+    def add(self, email: Email) -> None:
+        message_id = email.message_id()
+        container = self._by_id.get(message_id) if message_id is not None else None
+        if container is None or container.email is not None:
+            # A message without an id, or a duplicate id, starts a container of its own.
+            container = Container()
+            if message_id is not None and message_id not in self._by_id:
+                self._by_id[message_id] = container
+        container.email = email
+        self._by_email[id(email)] = container
+        references = [self._container(message_id) for message_id in email.references()]
+        for parent, child in zip(references, references[1:]):
+            if child.parent is None:
+                self._link(parent, child)
+        # The message's own References are the best evidence of where it belongs, so they override any guess made
+        # from the References of its replies.
+        if references and container.parent is not references[-1]:
+            self._link(references[-1], container)
+
+    def remove(self, email: Email) -> None:
+        container = self._by_email.pop(id(email), None)
+        if container is None:
+            return
+        container.email = None
+        # Drop empty leaves, which no listed email refers to; empty containers with replies hold the thread together.
+        while container is not None and container.email is None and not container.children:
+            parent = container.parent
+            container.set_parent(None)
+            container = parent
+
+    def update(self, mails: List[Email]) -> None:
+        """Add any new emails in the list, and remove any emails that are no longer in it."""
+        present = {id(m): m for m in mails}
+        for key in [key for key in self._by_email if key not in present]:
+            self.remove(self._by_email[key].email)
+        for mail in mails:
+            if id(mail) not in self._by_email:
+                self.add(mail)
+
+    def threads(self, mails: List[Email]) -> List[Container]:
+        """Return the roots of the threads containing the given emails, ordered by their first email in the list.
+
+        Any emails not yet in the index are added to it, so a filtered list can be threaded without losing the rest.
+        """
+        for mail in mails:
+            if id(mail) not in self._by_email:
+                self.add(mail)
+        return thread_roots(mails, self._by_email)
+
+
+def thread_roots(mails: List[Email], containers: Dict[int, Container]) -> List[Container]:
+    """Return the roots of the threads containing the given emails, ordered by their first email in the list.
+
+    :param list[Email] mails: The emails, in the order they're listed.
+    :param dict containers: The container of each email, keyed by id(); emails without one are left out.
+    :return: The roots of the threads.
+    :rtype: list[Container]
+    """
+    roots = []  # type: List[Container]
+    seen = set()  # type: Set[int]
+    for mail in mails:
+        container = containers.get(id(mail))
+        if container is None:
+            continue
+        root = container.root()
+        if id(root) not in seen:
+            seen.add(id(root))
+            roots.append(root)
+    return roots
+
+
+def flatten_thread(root: Container, order: Dict[int, int]) -> List[Tuple[Email, int]]:
+    """List the emails in a thread depth first, with their depth, leaving out any not in ``order``.
+
+    Empty containers, and emails that aren't listed (e.g. they've been filtered out), are skipped without indenting
+    their replies. Replies are ordered oldest first, assuming the list is newest first.
+
+    :param Container root: The root of the thread.
+    :param dict order: The position of each listed email in the list, keyed by id().
+    :return: The emails and their depths.
+    :rtype: list[tuple[Email, int]]
+    """
+    flattened = []  # type: List[Tuple[Email, int]]
+    stack = [(root, 0)]
+    while stack:
+        container, depth = stack.pop()
+        if container.email is not None and id(container.email) in order:
+            flattened.append((container.email, depth))
+            depth += 1
+        children = list(container.children.values())
+        if len(children) > 1:
+            children.sort(key=lambda c: _position(c, order))
+        # Pushed in reverse, so the oldest reply (i.e. the one furthest down the list) is popped first.
+        stack.extend((child, depth) for child in children)
+    return flattened
+
+
+def _position(container: Container, order: Dict[int, int]) -> int:
+    """The position of a reply in the list, i.e. how old it is, for ordering it among its siblings.
+
+    Replies are newer than what they reply to, so only an empty or unlisted container needs to look further down its
+    subtree, for its oldest listed email. It's -1 if there aren't any.
+    """
+    stack = [container]
+    position = -1
+    while stack:
+        node = stack.pop()
+        if node.email is not None and id(node.email) in order:
+            position = max(position, order[id(node.email)])
+        else:
+            stack.extend(node.children.values())
+    return position
@@ -1,13 +1,34 @@
 import curses
 import functools
-import math
 
 from typing import Callable
 
+from ..cache import CacheStats, LRUCache
 from ..email import EmailFlag, Email
 
 from .page import Page
-from .utils import center, fit_text_to_cols, wrap_text_to_cols
+from .utils import WrappedText, center, fit_text_to_cols, wrap_text_to_cols
+
+
+WRAP_CACHE_ENTRIES = 16
+
+# Recently wrapped bodies, keyed by email and width, so going back to an email (or a width) doesn't wrap it again.
+_wrapped_bodies = LRUCache(max_entries=WRAP_CACHE_ENTRIES)
+
+
+def wrap_body(email: Email, cols: int) -> WrappedText:
+    body = email.body()
+    cached_email, cached_body, wrapped = _wrapped_bodies.get((id(email), cols), (None, None, None))
+    # Holding on to the email stops its id being reused, and the body may have been reloaded since.
+    if cached_email is not email or cached_body is not body:
+        wrapped = WrappedText(body, cols)
+        _wrapped_bodies.put((id(email), cols), (email, body, wrapped))
+    return wrapped
+
+
+def wrap_cache_stats() -> CacheStats:
+    """Return the hit rate and size of the cache of wrapped bodies, e.g. for the stats overlay."""
+    return _wrapped_bodies.stats()
 
 
 class DetailPage(Page):
@@ -34,10 +55,11 @@ class DetailPage(Page):
         self.win.hline(body_window_y, 1, curses.ACS_HLINE, body_columns + 2)
         self.win.addch(body_window_y, 0, curses.ACS_LTEE)
         self.win.addch(body_window_y, body_columns + 3, curses.ACS_RTEE)
-        for i, line in enumerate(self.lines[body_lines * self.page:body_lines * (self.page + 1) - 1]):
+        self.bodywin.erase()
+        # The last row is left empty, as curses can't write to the bottom right corner of a window.
+        rows = body_lines - 1
+        for i, line in enumerate(self.lines.lines(rows * self.page, rows * (self.page + 1))):
             self.bodywin.addstr(i, 0, line)
-        for j in range(i + 1, body_lines - 1):
-            self.bodywin.addstr(j, 0,  ' ' * body_columns)
 
     def _keypress(self, key):
         if key == 9:  # TAB
@@ -50,7 +72,7 @@ class DetailPage(Page):
                 self.page -= 1
             return False
         elif key == 338:  # PageDn
-            if self.page < self.pages - 1:
+            if self.lines.has_line((self.bodywin.getmaxyx()[0] - 1) * (self.page + 1)):
                 self.page += 1
             return False
         return True
@@ -64,20 +86,19 @@ class DetailPage(Page):
     def _set_email(self, email: Email) -> None:
         self._email = email
         self.page = 0
-        body = self._email.body()
         body_lines, body_columns = self.bodywin.getmaxyx()
         self.subject_lines = wrap_text_to_cols(self._email.subject(), body_columns - 10)
         if len(self.subject_lines) > 1:
             self.bodywin = self.win.subwin(self.height - 4 - len(self.subject_lines), self.width - 4, self.y + 4 + len(self.subject_lines), self.x + 2)
             body_lines, body_columns = self.bodywin.getmaxyx()
-        self.lines = wrap_text_to_cols(body, body_columns)
-        self.pages = int(math.ceil(len(self.lines) / body_lines))
+        self.lines = wrap_body(self._email, body_columns)
 
     email = property(_get_email, _set_email)
 
     def _refresh(self):
-        self.win.refresh()
-        self.bodywin.refresh()
+        self.win.touchwin()
+        self.win.noutrefresh()
+        self.bodywin.noutrefresh()
 
     def toggle_read(self) -> None:
         newstate = self._email.unread()
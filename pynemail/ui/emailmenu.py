@@ -21,25 +21,36 @@ class MenuOption:
 
 
 class EmailMenu(Page):
+    """Actions on the selected email, or on all the marked emails at once.
 
-    def __init__(self, window, email, removeme):
+    Flag changes go through each email's flag queue, so a bulk change is written with one command per flag.
+    """
+
+    def __init__(self, window, emails, removeme, expunge=None):
         super().__init__()
-        self.email = email
-        self.height, self.width = 4, 30
-        y, x = center(self.height, self.width)
-        self.menuwin = window.subwin(self.height, self.width, y, x)
+        self.emails = emails
         self.removeme = removeme
+        self.expunge = expunge
         self.selected_row = 0
-        self.options = [
-            MenuOption(self.menuwin, 'Toggle (un)read', self.toggle_read),
-            MenuOption(self.menuwin, 'Toggle important', self.toggle_important),
+        options = [
+            ('Toggle (un)read', self.toggle_read),
+            ('Toggle important', self.toggle_important),
+            ('Toggle deleted', self.toggle_deleted),
         ]
+        if expunge is not None:
+            options.append(('Expunge deleted', self.expunge_deleted))
+        self.height, self.width = len(options) + 2, 30
+        y, x = center(self.height, self.width)
+        self.menuwin = window.subwin(self.height, self.width, y, x)
+        self.options = [MenuOption(self.menuwin, text, action) for text, action in options]
 
     def _render(self):
         for i, menuitem in enumerate(self.options):
             selected = self.selected_row == i
             menuitem.render(selected, i + 1, self.width - 2)
         self.menuwin.box()
+        if len(self.emails) > 1:
+            self.menuwin.addstr(0, 2, ' {} emails '.format(len(self.emails)))
 
     def _keypress(self, key):
         if key == curses.KEY_UP:
@@ -65,17 +76,25 @@ class EmailMenu(Page):
         pass
 
     def _refresh(self):
-        self.menuwin.refresh()
+        self.menuwin.noutrefresh()
 
     def _get_selected_option(self):
         return self.options[self.selected_row]
 
-    def toggle_read(self):
-        newstate = self.email.unread()
-        self.email.set_flag(EmailFlag.SEEN, newstate)
+    def _set_flag(self, flag, state):
+        for email in self.emails:
+            email.set_flag(flag, state)
         self.removeme(self)
 
+    def toggle_read(self):
+        self._set_flag(EmailFlag.SEEN, any(email.unread() for email in self.emails))
+
     def toggle_important(self):
-        newstate = not self.email.important()
-        self.email.set_flag(EmailFlag.FLAGGED, newstate)
+        self._set_flag(EmailFlag.FLAGGED, not all(email.important() for email in self.emails))
+
+    def toggle_deleted(self):
+        self._set_flag(EmailFlag.DELETED, not all(email.deleted() for email in self.emails))
+
+    def expunge_deleted(self):
         self.removeme(self)
+        self.expunge()
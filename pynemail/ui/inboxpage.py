@@ -1,122 +1,412 @@
 import curses
 
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from ..email import Email
+from ..search import MailSearch
+from ..threads import Container
+
 from .detailpage import DetailPage
 from .emailmenu import EmailMenu
+from .listview import ListView
+from .marks import Marks
 from .page import Page
-from .utils import fit_text_to_cols
+from .statspage import StatsPage
+from .threadview import ThreadLayout
+from .utils import WrappedText, fit_text_to_cols
+
+
+MAX_FROM_WIDTH = 30
+PRELOAD_MARGIN = 20
+MAX_THREAD_INDENT = 8
+DEFAULT_PREVIEW_LINES = 8
+
+Cells = Tuple[Tuple[int, str, int], ...]
 
 
 class EmailField:
+    """The layout of a single row of the inbox."""
 
-    def __init__(self, email, selected):
-        self.email = email
-        self.selected = selected
-        self.from_width = 0
-        self.subject_width = 0
+    FLAG_COLUMNS = (
+        (Email.important, 'I', 3),
+        (Email.replied, 'R', 2),
+        (Email.deleted, 'X', 1),
+        (Email.draft, 'D', 4),
+    )
+
+    def __init__(self, from_width, screen_width):
         self.date_width = 26
         self.flags_width = 6
-
-    def resize(self, from_width, screen_width):
         self.from_width = from_width
         self.subject_width = screen_width - (self.date_width + self.from_width + self.flags_width)
 
-    def flags(self):
-        return '{}   '.format(
-            'I' if self.email.important() else ' ',
-        )
+    def cells(self, email: Email, selected: bool, marked: bool = False, depth: int = 0,
+              collapsed: Optional[List[Email]] = None) -> Cells:
+        """Return the text to draw for the given email, as a tuple of (x, text, attributes) tuples.
 
-    def render(self, window, column):
+        :param int depth: How deep the email is in an expanded thread, which indents its subject.
+        :param list[Email] collapsed: If the email stands for a collapsed thread, the emails in it.
+        """
         extra = 0
-        if self.email.unread():
+        if any(m.unread() for m in collapsed) if collapsed else email.unread():
             extra |= curses.A_BOLD
-        if self.selected:
+        if selected:
             extra |= curses.A_STANDOUT
-        from_text = self.email.sender().ljust(self.from_width)
-        subject_text = fit_text_to_cols(self.email.subject(), self.subject_width - 1)
+        from_text = fit_text_to_cols(email.sender(), self.from_width - 1) + ' '
+        prefix = '  ' * (min(depth, MAX_THREAD_INDENT) - 1) + '> ' if depth else ''
+        if collapsed:
+            prefix = '({}) '.format(len(collapsed))
+        subject_text = fit_text_to_cols(prefix + email.subject(), self.subject_width - 1)
         subject_text = subject_text.ljust(self.subject_width)
-        text = '{}{}{}'.format(from_text, subject_text, self.email.date())
-        window.addstr(column, 1, text, extra)
+        text = '{}{}{} '.format(from_text, subject_text, email.date())
+        cells = [(0, '*' if marked else ' ', extra), (1, text, extra)]
         flag_x = self.from_width + self.subject_width + self.date_width + 1
-        window.addstr(column, flag_x - 1, ' ', extra)
-        if self.email.important():
-            window.addstr(column, flag_x, 'I', curses.color_pair(3) | extra)
-        else:
-            window.addstr(column, flag_x, ' ', extra)
-        if self.email.replied():
-            window.addstr(column, flag_x + 1, 'R', curses.color_pair(2) | extra)
-        else:
-            window.addstr(column, flag_x + 1, ' ', extra)
-        if self.email.deleted():
-            window.addstr(column, flag_x + 2, 'X', curses.color_pair(1) | extra)
-        else:
-            window.addstr(column, flag_x + 2, ' ', extra)
-        if self.email.draft():
-            window.addstr(column, flag_x + 3, 'D', curses.color_pair(4) | extra)
-        else:
-            window.addstr(column, flag_x + 3, ' ', extra)
+        for i, (is_set, char, colour) in enumerate(self.FLAG_COLUMNS):
+            if is_set(email):
+                cells.append((flag_x + i, char, curses.color_pair(colour) | extra))
+            else:
+                cells.append((flag_x + i, ' ', extra))
+        return tuple(cells)
+
+    def heading(self) -> Cells:
+        heading = '|' + 'FROM'.center(self.from_width - 1) + '|' + 'SUBJECT'.center(self.subject_width - 1) + \
+            '|' + 'DATE'.center(self.date_width - 1) + '|' + 'FLAGS'.center(self.flags_width - 1)
+        return ((0, heading, curses.A_UNDERLINE), )
 
 
 class InboxPage(Page):
+    """The list of emails.
+
+    Space marks the selected email, shift and the arrow keys mark a range, and s or S mark every email from the same
+    sender or with the same subject. The menu opened with Tab then acts on all the marked emails at once; Escape
+    clears the marks.
+
+    / starts a search, which filters the list as you type. Enter keeps the filter, and Escape removes it.
+
+    t switches to a list of conversations, if the mail store can group emails into threads. The right and left arrow
+    keys expand and collapse the selected thread, and Tab on a collapsed thread acts on every email in it.
+
+    v shows (and hides) a preview of the selected email's text below the list, so emails can be triaged without
+    opening them, or marking them as read. Previews are only the start of the text, and are fetched in the background,
+    ahead of the selection, if there's a ``preview`` prefetcher.
 
-    def __init__(self, screen, mail):
+    p shows (and hides) the latency of each backend operation and the caches' hit rates.
+    """
+
+    def __init__(self, screen, mail: List[Email], preload: Optional[Callable[[List[Email]], None]] = None,
+                 prefetch: Optional[Callable[[List[Email], int], None]] = None,
+                 expunge: Optional[Callable[[List[Email]], List[Email]]] = None,
+                 search: Optional[MailSearch] = None,
+                 threads: Optional[Callable[[List[Email]], List[Container]]] = None,
+                 preview: Optional[Callable[[List[Email], int], None]] = None, preview_lines: int = 0) -> None:
         super().__init__()
         self.window = screen.subwin(0, 0)
+        self.all_mail = mail
+        self.listed = mail
         self.mail = mail
-        self.resize(curses.LINES, curses.COLS)
-        self.selected_row = 0
+        self.preload = preload
+        self.prefetch = prefetch
+        self.expunge = expunge
+        self.search = search
+        self.threads = threads
+        self.preview = preview
+        self.previewing = preview_lines > 0
+        self.preview_lines = preview_lines or DEFAULT_PREVIEW_LINES
+        self._pane_lines = 0  # How many lines of the preview fit, while it's shown.
+        self._preview = (None, None, [])  # type: Tuple[Optional[Email], Optional[str], List[str]]
+        self.threaded = False
+        self.layout = None  # type: Optional[ThreadLayout]
+        self.expanded = set()  # type: Set[int]
+        self.query = None  # type: Optional[str]
+        self.searching = False
+        self.marks = Marks()
+        self.width = curses.COLS
+        self.height = curses.LINES
+        self.view = ListView(len(mail), curses.LINES - 1)
+        self.from_width = 0
         self.redraw = True
+        self._drawn_rows = {}  # type: Dict[int, Cells]
+        self.resize(curses.LINES, curses.COLS)
+        self._update_child_pages()
+
+    def _visible_mail(self) -> List[Email]:
+        visible = self.view.visible()
+        if self.preload is not None:
+            ahead = self.view.visible(PRELOAD_MARGIN)
+            mails = self.mail[ahead.start:ahead.stop]
+            if self.layout is not None:
+                # A collapsed thread's row is bold if any email in it is unread, so their flags are needed too.
+                for row in range(ahead.start, ahead.stop):
+                    if self.layout.is_collapsed(row):
+                        mails.extend(self.layout.thread(row))
+            self.preload(mails)
+        return self.mail[visible.start:visible.stop]
+
+    def _draw_row(self, row: int, cells: Cells) -> None:
+        """Draw a row of the window, unless it already shows exactly the same thing."""
+        if self._drawn_rows.get(row) == cells:
+            return
+        self.window.move(row, 0)
+        self.window.clrtoeol()
+        for x, text, attributes in cells:
+            self.window.addstr(row, x, text, attributes)
+        self._drawn_rows[row] = cells
 
     def _render(self):
         if self.redraw:
-            self.window.clear()
-        for i, m in enumerate(self.mail[:curses.LINES]):
-            if self.redraw or self.selected_row - 1 <= i <= self.selected_row + 1:
-                selected = i == self.selected_row
-                e = EmailField(m, selected)
-                e.resize(self.from_width, curses.COLS)
-                e.render(self.window, i + 1)
-        if self.redraw:
-            heading = '|' + 'FROM'.center(self.from_width - 1) + '|' + 'SUBJECT'.center(e.subject_width - 1) + '|' + 'DATE'.center(e.date_width - 1) + '|' + 'FLAGS'.center(e.flags_width - 1)
-            self.window.addstr(0, 0, heading, curses.A_UNDERLINE)
-        self.redraw = False
+            self.window.erase()
+            self._drawn_rows = {}
+            self.redraw = False
+        if self.query is None:
+            self._draw_row(0, self.field.heading())
+        else:
+            prompt = '/{}{}'.format(self.query, '_' if self.searching else '')
+            status = '{} of {} emails'.format(len(self.listed), len(self.all_mail))
+            self._draw_row(0, ((0, prompt.ljust(self.width - len(status) - 1) + status, curses.A_UNDERLINE), ))
+        visible = self._visible_mail()
+        for i, m in enumerate(visible):
+            index = self.view.top + i
+            depth, collapsed = 0, None
+            if self.layout is not None:
+                depth = self.layout.depth(index)
+                collapsed = self.layout.thread(index) if self.layout.is_collapsed(index) else None
+            self._draw_row(i + 1, self.field.cells(m, index == self.view.selected, m in self.marks, depth, collapsed))
+        for row in range(len(visible) + 1, self.view.height + 1):
+            self._draw_row(row, ())
+        if self._pane_lines > 0:
+            self._render_preview(self.view.height + 1)
+
+    def _render_preview(self, row: int) -> None:
+        email = self.mail[self.view.selected] if self.mail else None
+        heading = '' if email is None else ' {}: {}'.format(email.sender(), email.subject())
+        self._draw_row(row, ((0, fit_text_to_cols(heading, self.width - 1), curses.A_REVERSE), ))
+        lines = self._preview_text(email)
+        for i in range(self._pane_lines):
+            # The last column is left empty, as curses can't write to the bottom right corner of a window.
+            self._draw_row(row + 1 + i, ((0, lines[i], 0), ) if i < len(lines) else ())
+
+    def _preview_text(self, email: Optional[Email]) -> List[str]:
+        if email is None:
+            return []
+        if self.preview is not None and not email.has_preview():
+            return ['Loading...']
+        text = email.preview()
+        cached_email, cached_text, lines = self._preview
+        if cached_email is not email or cached_text != text:
+            lines = WrappedText(text, self.width - 1).lines(0, self._pane_lines)
+            self._preview = (email, text, lines)
+        return lines
+
+    def _toggle_preview(self) -> None:
+        self.previewing = not self.previewing
+        self._preview = (None, None, [])
+        self.resize(self.height, self.width)
+        self._update_child_pages()
 
     def _resize(self, h, w):
-        self.from_width = max([len(m.sender()) for m in self.mail]) + 1
+        # The list keeps at least one row, under its heading, and the preview has a heading of its own.
+        self._pane_lines = max(0, min(self.preview_lines, h - 3)) if self.previewing else 0
+        self.view.resize(h - 1 - (self._pane_lines + 1 if self._pane_lines else 0))
+        senders = [len(m.sender()) for m in self._visible_mail()]
+        self.from_width = min(max(senders + [len('FROM')]), MAX_FROM_WIDTH, w // 3) + 1
+        self.field = EmailField(self.from_width, w)
+        self.width, self.height = w, h
+        self._preview = (None, None, [])
+        self.redraw = True
 
     def _update_child_pages(self):
+        if self.prefetch is not None:
+            self.prefetch(self.mail, self.view.selected)
+        if self.preview is not None and self._pane_lines > 0:
+            self.preview(self.mail, self.view.selected)
         for child_page in self.child_pages:
-            if hasattr(child_page, 'email'):
-                child_page.email = self.mail[self.selected_row]
+            if hasattr(child_page, 'email') and self.mail:
+                child_page.email = self.mail[self.view.selected]
+
+    def _move(self, action: Callable[[], None]) -> None:
+        selected = self.view.selected
+        action()
+        if self.view.selected != selected:
+            self._update_child_pages()
+
+    def _mark_and_move(self, delta: int) -> None:
+        self.marks.add([self.mail[self.view.selected]])
+        self._move(lambda: self.view.move(delta))
+        self.marks.add([self.mail[self.view.selected]])
+
+    def _arrange(self) -> None:
+        """Lay out the listed emails as rows, in threads if they're switched on."""
+        if self.threaded:
+            self.layout = ThreadLayout(self.threads(self.listed), self.listed, self.expanded)
+            self.mail = self.layout.emails
+        else:
+            self.layout = None
+            self.mail = self.listed
+
+    def _row_of(self, email: Optional[Email]) -> Optional[int]:
+        """Return the row showing the given email, or its thread if that's collapsed."""
+        if self.layout is not None:
+            return self.layout.find(email)
+        return self.mail.index(email) if email is not None and email in self.mail else None
+
+    def _toggle_threads(self) -> None:
+        selected = self.mail[self.view.selected] if self.mail else None
+        self.threaded = not self.threaded
+        self._arrange()
+        self.view.set_length(len(self.mail))
+        self.view.select(self._row_of(selected) or 0)
+        self._update_child_pages()
+
+    def _expand(self, expanded: bool) -> None:
+        if self.layout is None or len(self.layout.thread(self.view.selected)) == 1:
+            return
+        row = self.layout.set_expanded(self.view.selected, expanded)
+        self.mail = self.layout.emails
+        self.view.set_length(len(self.mail))
+        self._move(lambda: self.view.select(row))
+
+    def _filter(self, query: Optional[str]) -> None:
+        self.query = query
+        self._show(self.all_mail if query is None else self.search.filter(query))
+
+    def _search_keypress(self, key: int) -> bool:
+        if key == 27:  # ESC
+            self.searching = False
+            self._filter(None)
+        elif key == 10:  # ENTER
+            self.searching = False
+            if not self.query:
+                self._filter(None)
+        elif key in (curses.KEY_BACKSPACE, 127, 8):
+            self._filter(self.query[:-1])
+        elif 32 <= key < 127:
+            self._filter(self.query + chr(key))
+        else:
+            return True
+        return False
 
     def _keypress(self, key):
+        if self.searching and not self._search_keypress(key):
+            return False
+        if key == ord('/') and self.search is not None:
+            self.searching = True
+            self.search.start(self.all_mail)
+            self._filter(self.query or '')
+            return False
+        if key == 27 and self.query is not None:  # ESC
+            self._filter(None)
+            return False
+        if key == ord('t') and self.threads is not None:
+            self._toggle_threads()
+            return False
+        if key == ord('p'):
+            self._toggle_stats()
+            return False
+        if key == ord('v'):
+            self._toggle_preview()
+            return False
+        if not self.mail:
+            return True
         if key == curses.KEY_UP:
-            if self.selected_row > 0:
-                self.selected_row -= 1
-                self._update_child_pages()
+            self._move(lambda: self.view.move(-1))
             return False
         elif key == curses.KEY_DOWN:
-            if self.selected_row < curses.LINES - 2 and self.selected_row < len(self.mail) - 1:
-                self.selected_row += 1
-                self._update_child_pages()
+            self._move(lambda: self.view.move(1))
+            return False
+        elif key == curses.KEY_PPAGE:
+            self._move(lambda: self.view.page(-1))
+            return False
+        elif key == curses.KEY_NPAGE:
+            self._move(lambda: self.view.page(1))
+            return False
+        elif key == curses.KEY_HOME:
+            self._move(self.view.home)
+            return False
+        elif key == curses.KEY_END:
+            self._move(self.view.end)
+            return False
+        elif key == curses.KEY_RIGHT:
+            self._expand(True)
+            return False
+        elif key == curses.KEY_LEFT:
+            self._expand(False)
+            return False
+        elif key == ord(' '):
+            self.marks.toggle(self.mail[self.view.selected])
+            self._move(lambda: self.view.move(1))
+            return False
+        elif key == curses.KEY_SF:  # Shift + Down
+            self._mark_and_move(1)
+            return False
+        elif key == curses.KEY_SR:  # Shift + Up
+            self._mark_and_move(-1)
+            return False
+        elif key == ord('s'):
+            self.marks.add_same_sender(self.listed, self.mail[self.view.selected], self.preload)
+            return False
+        elif key == ord('S'):
+            self.marks.add_same_subject(self.listed, self.mail[self.view.selected], self.preload)
+            return False
+        elif key == 27:  # ESC
+            self.marks.clear()
             return False
         #elif key == curses.KEY_ENTER:
         elif key == 10:  # ENTER
-            page = DetailPage(self.window, self.mail[self.selected_row], self._remove_child_page)
+            page = DetailPage(self.window, self.mail[self.view.selected], self._remove_child_page)
             self.child_pages.append(page)
             return False
         elif key == 9:  # TAB
-            page = EmailMenu(self.window, self.mail[self.selected_row], self._remove_child_page)
+            emails = self.marks.emails() or self._selected_thread()
+            expunge = self._expunge if self.expunge is not None else None
+            page = EmailMenu(self.window, emails, self._remove_child_page, expunge)
             self.child_pages.append(page)
             return False
         return True
 
+    def _selected_thread(self) -> List[Email]:
+        """Return the selected email, or every email in the selected thread if it's collapsed."""
+        if self.layout is not None and self.layout.is_collapsed(self.view.selected):
+            return self.layout.thread(self.view.selected)
+        return [self.mail[self.view.selected]]
+
+    def _toggle_stats(self) -> None:
+        pages = [page for page in self.child_pages if isinstance(page, StatsPage)]
+        if pages:
+            pages[0].close()
+            self._remove_child_page(pages[0])
+        else:
+            self.child_pages.append(StatsPage())
+
+    def _expunge(self) -> None:
+        self.set_mail(self.expunge(self.all_mail))
+
     def _remove_child_page(self, page):
         self.child_pages.remove(page)
         self.redraw = True
 
     def _refresh(self):
-        self.window.refresh()
+        self.window.noutrefresh()
+
+    def _show(self, mail: List[Email]) -> None:
+        """Show a filtered list of emails from the top."""
+        self.listed = mail
+        self._arrange()
+        self.view.set_length(len(self.mail))
+        self.view.home()
+        self._update_child_pages()
 
     def set_mail(self, mail) -> None:
-        self.mail = mail
+        """Replace the list of emails, keeping the same email selected if it's still there."""
+        selected = self.mail[self.view.selected] if self.mail else None
+        self.all_mail = mail
+        if self.query is not None:
+            self.search.start(mail)
+            mail = self.search.filter(self.query)
+        self.listed = mail
+        self._arrange()
+        self.marks.retain(self.all_mail)
+        self.view.set_length(len(self.mail))
+        row = self._row_of(selected)
+        if row is not None:
+            self.view.select(row)
         self._update_child_pages()
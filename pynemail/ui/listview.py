@@ -0,0 +1,52 @@
+class ListView:
+    """The selection and scroll position of a list that may be longer than the window showing it.
+
+    Only the indexes in ``visible()`` need to be loaded or drawn, so the cost of a frame follows the height of the
+    window rather than the length of the list.
+    """
+
+    def __init__(self, length: int, height: int) -> None:
+        self.length = length
+        self.height = max(height, 1)
+        self.top = 0
+        self.selected = 0
+
+    def _clamp(self) -> None:
+        self.selected = max(0, min(self.selected, self.length - 1))
+        if self.selected < self.top:
+            self.top = self.selected
+        elif self.selected >= self.top + self.height:
+            self.top = self.selected - self.height + 1
+        self.top = max(0, min(self.top, self.length - self.height))
+
+    def resize(self, height: int) -> None:
+        self.height = max(height, 1)
+        self._clamp()
+
+    def set_length(self, length: int) -> None:
+        self.length = length
+        self._clamp()
+
+    def select(self, index: int) -> None:
+        self.selected = index
+        self._clamp()
+
+    def move(self, delta: int) -> None:
+        self.select(self.selected + delta)
+
+    def page(self, pages: int) -> None:
+        """Move the selection and the window by whole pages, keeping the selection at the same row on the screen."""
+        row = self.selected - self.top
+        self.top += pages * self.height
+        self.top = max(0, min(self.top, self.length - self.height))
+        self.select(self.top + row)
+
+    def home(self) -> None:
+        self.select(0)
+
+    def end(self) -> None:
+        self.select(self.length - 1)
+
+    def visible(self, margin: int = 0) -> range:
+        """Return the indexes shown in the window, optionally widened by a read-ahead margin on each side."""
+        return range(max(0, self.top - margin), min(self.length, self.top + self.height + margin))
@@ -0,0 +1,60 @@
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional
+
+from ..email import Email, base_subject
+
+
+class Marks:
+    """The set of emails marked for a bulk operation.
+
+    Emails are keyed by identity, as a maildir email's hash changes whenever its flags are written to its filename.
+    """
+
+    def __init__(self) -> None:
+        self._emails = OrderedDict()  # type: Dict[int, Email]
+
+    def __contains__(self, email: Email) -> bool:
+        return id(email) in self._emails
+
+    def __len__(self) -> int:
+        return len(self._emails)
+
+    def toggle(self, email: Email) -> None:
+        if self._emails.pop(id(email), None) is None:
+            self._emails[id(email)] = email
+
+    def add(self, emails: Iterable[Email]) -> None:
+        for email in emails:
+            self._emails[id(email)] = email
+
+    def add_matching(self, mails: List[Email], email: Email, key: Callable[[Email], str],
+                     preload: Optional[Callable[[List[Email]], None]] = None) -> None:
+        """Mark every email in the list with the same key as the given one, e.g. the same sender.
+
+        :param preload: Loads the summaries of a list of emails in bulk, e.g. ``load_imap_summaries``, so that the
+            key of each one isn't fetched separately.
+        """
+        if preload is not None:
+            preload(mails)
+        value = key(email)
+        self.add(m for m in mails if key(m) == value)
+
+    def add_same_sender(self, mails: List[Email], email: Email,
+                        preload: Optional[Callable[[List[Email]], None]] = None) -> None:
+        self.add_matching(mails, email, Email.sender_address, preload)
+
+    def add_same_subject(self, mails: List[Email], email: Email,
+                         preload: Optional[Callable[[List[Email]], None]] = None) -> None:
+        self.add_matching(mails, email, lambda m: base_subject(m.subject()).lower(), preload)
+
+    def clear(self) -> None:
+        self._emails.clear()
+
+    def retain(self, mails: List[Email]) -> None:
+        """Forget any marked emails that are no longer in the list."""
+        present = {id(m) for m in mails}
+        for key in [key for key in self._emails if key not in present]:
+            del self._emails[key]
+
+    def emails(self) -> List[Email]:
+        return list(self._emails.values())
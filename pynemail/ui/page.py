@@ -1,5 +1,9 @@
+import curses
+
 from typing import List
 
+from ..stats import timed
+
 
 class Page:
 
@@ -35,7 +39,14 @@ class Page:
         for page in self.child_pages:
             page.resize(h, w)
 
-    def refresh(self) -> None:
+    def noutrefresh(self) -> None:
+        """Copy the windows of this page and its children to the virtual screen, without updating the terminal."""
         self._refresh()
         for page in self.child_pages:
-            page.refresh()
+            page.noutrefresh()
+
+    @timed('ui.refresh')
+    def refresh(self) -> None:
+        """Update the terminal with the whole page tree, using a single doupdate() to minimise output."""
+        self.noutrefresh()
+        curses.doupdate()
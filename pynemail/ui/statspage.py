@@ -0,0 +1,62 @@
+import curses
+
+from typing import List
+
+from ..email import Email
+from ..stats import STATS, STATS_HEADING, Stats, format_histogram
+
+from .detailpage import wrap_cache_stats
+from .page import Page
+from .utils import fit_text_to_cols
+
+
+class StatsPage(Page):
+    """An overlay showing the latency of each instrumented operation and the caches' hit rates, as they happen.
+
+    Opening it starts recording, if ``--profile`` hasn't already, and closing it stops recording again, unless
+    ``--profile`` started it. Every key is passed on, so the pages underneath can still be used.
+    """
+
+    def __init__(self, stats: Stats = STATS) -> None:
+        super().__init__()
+        self.stats = stats
+        self._started = not stats.enabled
+        self.stats.enable()
+        self.win = None
+        self.screen_size = (curses.LINES, curses.COLS)
+
+    def _lines(self) -> List[str]:
+        lines = [STATS_HEADING]
+        lines.extend(format_histogram(name, histogram) for name, histogram in self.stats.summary())
+        lines.append('')
+        lines.append('Email cache:   {}'.format(Email.cache.stats()))
+        lines.append('Wrapped cache: {}'.format(wrap_cache_stats()))
+        return lines
+
+    def _render(self):
+        lines = self._lines()
+        # Sized to fit, in the bottom right corner, which means a new window whenever another operation shows up.
+        h, w = self.screen_size
+        height, width = min(len(lines) + 2, h - 2), min(110, w - 2)
+        if self.win is None or self.win.getmaxyx() != (height, width):
+            self.win = curses.newwin(height, width, h - height - 1, w - width - 1)
+        self.win.erase()
+        self.win.box()
+        self.win.addstr(0, 2, ' Stats ')
+        for i, line in enumerate(lines[:height - 2]):
+            self.win.addstr(i + 1, 2, fit_text_to_cols(line, width - 4))
+
+    def close(self) -> None:
+        """Stop recording, if the overlay started it."""
+        if self._started:
+            self.stats.disable()
+
+    def _keypress(self, key):
+        return True
+
+    def _resize(self, h, w):
+        self.screen_size = (h, w)
+        self.win = None
+
+    def _refresh(self):
+        self.win.noutrefresh()
@@ -0,0 +1,81 @@
+from typing import List, Optional, Set, Tuple
+
+from ..email import Email
+from ..threads import Container, flatten_thread
+
+
+class ThreadLayout:
+    """The rows of an inbox showing collapsible threads.
+
+    A collapsed thread is shown as its newest email, so its row has the date and sender of the latest reply; an
+    expanded one shows every email, from the first, indented by depth. Each thread is flattened once, so expanding or
+    collapsing one only rebuilds the list of rows.
+
+    :param list[Container] roots: The threads, in the order they're listed.
+    :param list[Email] mails: The listed emails, newest first; any others in the threads are left out.
+    :param set[int] expanded: The id() of the first email of each expanded thread. It's shared with the caller, so it
+        survives the layout being rebuilt when the list changes.
+    """
+
+    def __init__(self, roots: List[Container], mails: List[Email], expanded: Set[int]) -> None:
+        order = {id(mail): i for i, mail in enumerate(mails)}
+        threads = (flatten_thread(root, order) for root in roots)
+        self.threads = [thread for thread in threads if thread]  # type: List[List[Tuple[Email, int]]]
+        # The position of each thread's newest email, which stands for it while it's collapsed.
+        self._newest = [min(enumerate(thread), key=lambda row: order[id(row[1][0])])[0] for thread in self.threads]
+        self.expanded = expanded
+        self.emails = []  # type: List[Email]
+        self._rows = []  # type: List[Tuple[int, int]]
+        self._layout()
+
+    def _layout(self) -> None:
+        self.emails = []
+        self._rows = []  # The thread and the position within it of each row.
+        for t, thread in enumerate(self.threads):
+            positions = range(len(thread)) if id(thread[0][0]) in self.expanded else [self._newest[t]]
+            for i in positions:
+                self.emails.append(thread[i][0])
+                self._rows.append((t, i))
+
+    def depth(self, row: int) -> int:
+        if self.is_collapsed(row):
+            return 0
+        t, i = self._rows[row]
+        return self.threads[t][i][1]
+
+    def thread(self, row: int) -> List[Email]:
+        """Return every email in the thread shown at the given row."""
+        return [email for email, _ in self.threads[self._rows[row][0]]]
+
+    def is_collapsed(self, row: int) -> bool:
+        """Whether the row stands for a collapsed thread of more than one email."""
+        thread = self.threads[self._rows[row][0]]
+        return len(thread) > 1 and id(thread[0][0]) not in self.expanded
+
+    def find(self, email: Email) -> Optional[int]:
+        """Return the row showing the given email, or its thread if that's collapsed, or None if it isn't listed."""
+        row = 0
+        for thread in self.threads:
+            expanded = id(thread[0][0]) in self.expanded
+            for i, (member, _) in enumerate(thread):
+                if member is email:
+                    return row + (i if expanded else 0)
+            row += len(thread) if expanded else 1
+        return None
+
+    def set_expanded(self, row: int, expanded: bool) -> int:
+        """Expand or collapse the thread shown at the given row.
+
+        :return: The row the thread's first email is now on.
+        :rtype: int
+        """
+        t, i = self._rows[row]
+        first = id(self.threads[t][0][0])
+        if first not in self.expanded:
+            i = 0  # A collapsed thread has just the one row.
+        if expanded:
+            self.expanded.add(first)
+        else:
+            self.expanded.discard(first)
+        self._layout()
+        return row - i
@@ -1,5 +1,18 @@
 import curses
 import functools
+import re
+
+from array import array
+from typing import Iterator, List, Optional, Tuple
+
+from ..stats import timed
+
+
+TAB_SIZE = 4
+
+# The same line boundaries as str.splitlines().
+_LINE_BREAK = re.compile('\r\n|[\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]')
+_UP_TO_LAST_SPACE = re.compile(r'.*\s', re.DOTALL)
 
 
 def center(height, width, screen_h=None, screen_w=None):
@@ -17,18 +30,90 @@ def fit_text_to_cols(text, cols):
 
 
 def _split_line_at_space_if_possible(line, cols):
-    for i, c in enumerate(line[cols-1::-1]):
-        if c.isspace():
-            return line[:cols-i], line[cols-i:]
-    return line[:cols], line[cols:]
+    match = _UP_TO_LAST_SPACE.match(line, 0, cols)
+    end = match.end() if match else cols
+    return line[:end], line[end:]
+
+
+def _wrap_points(text: str, start: int, stop: int, cols: int) -> Iterator[Tuple[int, int]]:
+    """Yield the (start, end) offsets of the pieces text[start:stop] wraps into, breaking after a space if possible."""
+    while stop - start > cols:
+        match = _UP_TO_LAST_SPACE.match(text, start, start + cols)
+        end = match.end() if match else start + cols
+        yield start, end
+        start = end
+    yield start, stop
+
+
+class WrappedText:
+    """Text wrapped to a number of columns, one page at a time.
+
+    Lines are only wrapped when they're first asked for, so the first page of a huge body is ready straight away,
+    however long the rest is. The wrapped lines are kept as offsets into the text rather than copies of it, and they
+    aren't padded to the full width.
+    """
+
+    def __init__(self, text: str, cols: int) -> None:
+        self.text = text
+        self.cols = max(cols, 1)
+        # Three numbers per wrapped line: the start of its source line, then the start and end of the piece. For lines
+        # without tabs the piece is text[start:end]. Lines with tabs are stored as -(line start + 1), and the piece is
+        # a slice of the line after its tabs have been expanded.
+        self._index = array('q')
+        self._wrapper = self._wrap()  # type: Optional[Iterator[Tuple[int, int, int]]]
+        self._expanded = (-1, '')
+
+    def _wrap(self) -> Iterator[Tuple[int, int, int]]:
+        text, pos = self.text, 0
+        while pos < len(text):
+            match = _LINE_BREAK.search(text, pos)
+            end = match.start() if match else len(text)
+            if text.find('\t', pos, end) == -1:
+                for start, stop in _wrap_points(text, pos, end, self.cols):
+                    yield pos, start, stop
+            else:
+                line = text[pos:end].expandtabs(TAB_SIZE)
+                for start, stop in _wrap_points(line, 0, len(line), self.cols):
+                    yield -(pos + 1), start, stop
+            pos = match.end() if match else len(text)
+
+    def _wrap_until(self, count: int) -> None:
+        while self._wrapper is not None and len(self._index) < count * 3:
+            try:
+                self._index.extend(next(self._wrapper))
+            except StopIteration:
+                self._wrapper = None
+
+    def has_line(self, n: int) -> bool:
+        """Return whether there are more than n wrapped lines, wrapping only as far as line n to find out."""
+        self._wrap_until(n + 1)
+        return len(self._index) > n * 3
+
+    def __len__(self) -> int:
+        """Return the number of wrapped lines, which means wrapping the whole text."""
+        self._wrap_until(len(self.text) + 1)  # Every wrapped line uses up at least one character.
+        return len(self._index) // 3
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.lines(0, len(self)))
+
+    def _line(self, i: int) -> str:
+        key, start, stop = self._index[i * 3:i * 3 + 3]
+        if key >= 0:
+            return self.text[start:stop]
+        pos = -key - 1
+        if self._expanded[0] != pos:
+            match = _LINE_BREAK.search(self.text, pos)
+            end = match.start() if match else len(self.text)
+            self._expanded = (pos, self.text[pos:end].expandtabs(TAB_SIZE))
+        return self._expanded[1][start:stop]
+
+    @timed('ui.wrap')
+    def lines(self, start: int, stop: int) -> List[str]:
+        """Return the wrapped lines from start up to (but not including) stop, or as many of them as there are."""
+        self._wrap_until(stop)
+        return [self._line(i) for i in range(start, min(stop, len(self._index) // 3))]
 
 
 def wrap_text_to_cols(text, cols):
-    wrapped_text = []
-    append_line = lambda l: wrapped_text.append(l + ' ' * (cols - len(l)))
-    for line in text.expandtabs(4).splitlines():
-        while len(line) > cols:
-            l, line = _split_line_at_space_if_possible(line, cols)
-            append_line(l)
-        append_line(line)
-    return wrapped_text
+    return [line.ljust(cols) for line in WrappedText(text, cols)]
@@ -0,0 +1,104 @@
+import pytest
+
+from pynemail.email import Email
+
+
+class FakeEmail(Email):
+    """An email made of just the given headers and body, whose flags are only ever kept in memory.
+
+    :param dict headers: The headers, which are its summary too, if given; e.g. {'From': ..., 'Subject': ...}.
+    :param str body: The plain text body.
+    :param key: Anything to tell it apart by, e.g. its key in a SearchIndex.
+    """
+
+    def __init__(self, headers=None, body='', key=None):
+        super().__init__()
+        self.headers = dict(headers or {})
+        self.body_text = body
+        self.key = key
+        self._flags = 0
+        if headers is not None:
+            self.set_summary(self.headers)
+
+    def _get_message(self):
+        text = ''.join('{}: {}\n'.format(name, value) for name, value in self.headers.items()) + '\n' + self.body_text
+        return self.parser.parsebytes(text.encode())
+
+    def _write_flags(self, changes):
+        pass
+
+    def __repr__(self):
+        return 'FakeEmail({!r})'.format(self.key if self.key is not None else self.headers)
+
+
+def numbered_email(num):
+    """Return an email whose subject and body are both its number, e.g. 'Body 3'."""
+    return FakeEmail({'Subject': str(num)}, 'Body {}\n'.format(num), num)
+
+
+def thread_email(message_id, references=''):
+    """Return an email with the given Message-ID and References, for threading."""
+    return FakeEmail({'Message-ID': '<{}>'.format(message_id), 'References': references}, key=message_id)
+
+
+@pytest.fixture
+def make_emails():
+    """Return a factory for a list of numbered emails."""
+    return lambda count: [numbered_email(num) for num in range(count)]
+
+
+# The summary headers of a message, as a FETCH response returns them.
+HEADER = b'From: "Alice" <alice@example.com>\r\nSubject: Hello\r\nDate: Mon, 1 Jan 2018 10:00:00 +0000\r\n\r\n'
+
+
+class FakeImap:
+    """An imaplib connection that records the commands it's sent, and replies to each with the next of ``responses``."""
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.commands = []
+
+    def fetch(self, message_set, message_parts):
+        self.commands.append(('FETCH', message_set, message_parts))
+        return 'OK', self.responses.pop(0)
+
+    def uid(self, command, *args):
+        self.commands.append(('UID', command) + args)
+        return 'OK', self.responses.pop(0)
+
+
+class FakeUpdateImap(FakeImap):
+    """A connection that has received untagged responses, as a mailbox does while it's selected."""
+
+    def __init__(self, responses):
+        super().__init__(responses)
+        self.untagged_responses = {'EXISTS': [b'4']}
+
+    def noop(self):
+        return 'OK', [b'']
+
+
+class FakeSearchImap(FakeImap):
+    """A connection with the given capabilities, whose ESEARCH responses are the next of ``responses``."""
+
+    def __init__(self, capabilities, responses):
+        super().__init__(responses)
+        self.capabilities = capabilities
+        self.untagged_responses = {}
+
+    def _simple_command(self, name, *args):
+        self.commands.append((name, ) + args)
+        self.untagged_responses['ESEARCH'] = self.responses.pop(0)
+        return 'OK', [b'done']
+
+    def _untagged_response(self, typ, data, name):
+        return typ, self.untagged_responses.pop(name)
+
+
+# A message with a text and an HTML alternative, followed by an attachment.
+MIXED_STRUCTURE = (
+    b'1 (BODYSTRUCTURE ((("text" "plain" ("charset" "utf-8") NIL NIL "quoted-printable" 12 1 NIL NIL NIL NIL)'
+    b'("text" "html" ("charset" "utf-8") NIL NIL "7bit" 30 1 NIL NIL NIL NIL) "alternative" ("boundary" "a") NIL NIL)'
+    b'("application" "pdf" ("name" "a.pdf") NIL NIL "base64" 90000 NIL ("attachment" ("filename" "a.pdf")) NIL NIL)'
+    b' "mixed" ("boundary" "m") NIL NIL))'
+)
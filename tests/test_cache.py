@@ -0,0 +1,59 @@
+import pytest
+
+from pynemail import cache
+
+
+@pytest.mark.parametrize("text, size", [
+    ('100', 100),
+    ('4K', 4096),
+    ('64M', 64 * 1024 ** 2),
+    ('1.5g', 3 * 1024 ** 3 // 2),
+    ('10MB', 10 * 1024 ** 2),
+])
+def test_parse_size(text, size):
+    assert cache.parse_size(text) == size
+
+
+def test_lru_cache_evicts_least_recently_used_by_size():
+    lru = cache.LRUCache(max_size=10)
+    lru.put('a', 'A', 4)
+    lru.put('b', 'B', 4)
+    assert lru.get('a') == 'A'
+    lru.put('c', 'C', 4)
+    assert 'b' not in lru
+    assert lru.get('b') is None
+    assert lru.get('c') == 'C'
+    stats = lru.stats()
+    assert (stats.hits, stats.misses, stats.evictions, stats.entries, stats.size) == (2, 1, 1, 2, 8)
+    assert stats.hit_rate == pytest.approx(2 / 3)
+
+
+def test_lru_cache_evicts_by_entry_count_and_keeps_oversized_values():
+    lru = cache.LRUCache(max_size=10, max_entries=2)
+    for key in 'abc':
+        lru.put(key, key.upper(), 1)
+    assert len(lru) == 2 and 'a' not in lru
+    lru.put('huge', 'H', 100)
+    assert len(lru) == 1 and lru.get('huge') == 'H'
+
+
+def test_email_bodies_are_dropped_from_the_shared_cache(monkeypatch):
+    from pynemail.email import Email
+
+    class FakeEmail(Email):
+        def _get_message(self):
+            return self.parser.parsebytes(b'Subject: x\n\n' + b'x' * 5000)
+
+        def _get_flags(self):
+            return 0
+
+        def set_flag(self, flag, state):
+            pass
+
+    monkeypatch.setattr(Email, 'cache', cache.LRUCache(max_size=20000))
+    mails = [FakeEmail() for _ in range(5)]
+    for mail in mails:
+        assert len(mail.body()) == 5000
+    assert not mails[0].has_body()
+    assert mails[-1].has_body()
+    assert Email.cache.stats().size <= 20000
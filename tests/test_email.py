@@ -0,0 +1,40 @@
+import io
+
+import pytest
+
+from pynemail import email
+
+
+@pytest.mark.parametrize("data, headers, rest", [
+    (b'From: a\nTo: b\n\nbody\n', b'From: a\nTo: b\n', b'body\n'),
+    (b'From: a\r\nTo: b\r\n\r\nbody\r\n', b'From: a\r\nTo: b\r\n', b'body\r\n'),
+    (b'From: a\n', b'From: a\n', b''),
+])
+def test_read_header_block_stops_at_the_body(data, headers, rest):
+    fp = io.BytesIO(data)
+    assert email.read_header_block(fp) == headers
+    assert fp.read() == rest
+
+
+@pytest.mark.parametrize("subject, base", [
+    ('Lunch?', 'Lunch?'),
+    ('Re: Fwd: RE: Lunch?', 'Lunch?'),
+    ('Re[2]:Lunch?', 'Lunch?'),
+    ('AW: Fw:  Lunch? ', 'Lunch?'),
+    ('Regarding lunch', 'Regarding lunch'),
+])
+def test_base_subject(subject, base):
+    assert email.base_subject(subject) == base
+
+
+@pytest.mark.parametrize("summary, message_id, references", [
+    ({}, None, []),
+    ({'Message-ID': '<c@x>', 'References': '<a@x>\t<b@x>', 'In-Reply-To': '<b@x>'}, 'c@x', ['a@x', 'b@x']),
+    ({'Message-ID': '<c@x>', 'In-Reply-To': '<b@x> (Bob\'s message of today)'}, 'c@x', ['b@x']),
+    ({'Message-ID': 'not an id', 'References': 'nor <this'}, None, []),
+])
+def test_message_id_and_references(summary, message_id, references):
+    mail = email.Email()
+    mail.set_summary(summary)
+    assert mail.message_id() == message_id
+    assert mail.references() == references
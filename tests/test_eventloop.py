@@ -0,0 +1,47 @@
+import os
+import threading
+
+import pytest
+
+from pynemail.eventloop import EventLoop
+
+
+@pytest.fixture
+def loop():
+    loop = EventLoop()
+    yield loop
+    loop.close()
+
+
+def test_timers_run_in_order_and_can_be_cancelled(loop):
+    calls = []
+    loop.call_later(0.02, lambda: calls.append('second'))
+    loop.call_later(0.01, lambda: calls.append('first'))
+    loop.call_later(0.015, lambda: calls.append('cancelled')).cancel()
+    loop.call_later(0.03, loop.stop)
+    loop.run()
+    assert calls == ['first', 'second']
+
+
+def test_call_soon_threadsafe_wakes_the_loop(loop):
+    calls = []
+    thread = threading.Thread(target=lambda: loop.call_soon_threadsafe(lambda: calls.append(1) or loop.stop()))
+    loop.call_later(5, loop.stop)
+    thread.start()
+    loop.run()
+    thread.join()
+    assert calls == [1]
+
+
+def test_readers_are_called_when_readable_and_after_runs_once_per_batch(loop):
+    read_fd, write_fd = os.pipe()
+    data = []
+    batches = []
+    loop.add_reader(read_fd, lambda: data.append(os.read(read_fd, 10)) or loop.stop())
+    os.write(write_fd, b'abc')
+    loop.run(after=lambda: batches.append(1))
+    loop.remove_reader(read_fd)
+    os.close(read_fd)
+    os.close(write_fd)
+    assert data == [b'abc']
+    assert batches == []
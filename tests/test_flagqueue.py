@@ -0,0 +1,67 @@
+from conftest import FakeEmail
+from pynemail.email import EmailFlag
+from pynemail.flagqueue import FlagQueue
+
+
+class FakeTimer:
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+def make_queue():
+    writes = []
+    timers = []
+    queue = FlagQueue(writes.append, lambda delay, callback: timers.append(FakeTimer(callback)) or timers[-1])
+    return queue, writes, timers
+
+
+def test_flag_queue_groups_changes_by_flag_and_state():
+    queue, writes, timers = make_queue()
+    mails = [FakeEmail(key=i) for i in range(4)]
+    for mail in mails:
+        queue.add(mail, EmailFlag.SEEN, True)
+    queue.add(mails[1], EmailFlag.FLAGGED, True)
+    queue.add(mails[2], EmailFlag.FLAGGED, False)
+    assert len(timers) == 1
+    assert writes == []
+    timers[0].callback()
+    assert writes == [{
+        (EmailFlag.SEEN, True): mails,
+        (EmailFlag.FLAGGED, True): [mails[1]],
+        (EmailFlag.FLAGGED, False): [mails[2]],
+    }]
+    assert len(queue) == 0
+
+
+def test_flag_queue_drops_changes_that_cancel_out():
+    queue, writes, timers = make_queue()
+    mail = FakeEmail(key=1)
+    queue.add(mail, EmailFlag.SEEN, True)
+    queue.add(mail, EmailFlag.SEEN, False)
+    queue.add(mail, EmailFlag.FLAGGED, True)
+    queue.add(mail, EmailFlag.FLAGGED, False)
+    queue.add(mail, EmailFlag.FLAGGED, True)
+    queue.flush()
+    assert writes == [{(EmailFlag.FLAGGED, True): [mail]}]
+    assert timers[0].cancelled
+    queue.flush()
+    assert len(writes) == 1
+
+
+def test_set_flag_updates_the_email_before_the_queue_is_flushed():
+    queue, writes, _ = make_queue()
+    FakeEmail.flag_queue = queue
+    try:
+        mail = FakeEmail(key=1)
+        mail.set_flag(EmailFlag.SEEN, True)
+        mail.set_flag(EmailFlag.SEEN, True)
+        assert not mail.unread()
+        assert len(queue) == 1
+        assert writes == []
+    finally:
+        FakeEmail.flag_queue = None
@@ -0,0 +1,105 @@
+from conftest import HEADER, MIXED_STRUCTURE, FakeImap, FakeUpdateImap
+from pynemail.email import EmailFlag, flags_to_mask
+from pynemail import imapclient, imapparse
+
+
+def test_load_imap_summaries_batches_fetches():
+    responses = [
+        [(b'1 (UID 11 FLAGS (\\Seen) BODY[HEADER.FIELDS (FROM TO SUBJECT DATE)] {91}', HEADER), b')',
+         (b'2 (UID 12 FLAGS () BODY[HEADER.FIELDS (FROM TO SUBJECT DATE)] {91}', HEADER), b')'],
+        [(b'3 (UID 13 FLAGS () BODY[HEADER.FIELDS (FROM TO SUBJECT DATE)] {91}', HEADER), b')'],
+    ]
+    client = FakeImap(responses)
+    mails = [imapclient.ImapEmail(client, uid) for uid in (b'11', b'12', b'13')]
+    imapclient.load_imap_summaries(client, mails, batch_size=2)
+    assert [c[2] for c in client.commands] == ['11:12', '13']
+    assert mails[0].sender() == 'Alice'
+    assert mails[2].subject() == 'Hello'
+    assert not mails[0].unread()
+    assert mails[1].unread()
+    assert len(client.commands) == 2
+
+
+def test_load_imap_summaries_only_fetches_the_flags_of_known_summaries():
+    client = FakeImap([[b'1 (UID 7 FLAGS (\\Flagged))']])
+    mail = imapclient.ImapEmail(client, 7)
+    mail._summary = ('Alice', '', 'Hello', '', '', '', '')
+    imapclient.load_imap_summaries(client, [mail])
+    assert client.commands == [('UID', 'FETCH', '7', imapclient.FLAGS_FETCH_ITEMS)]
+    assert mail.important()
+
+
+def test_poll_imap_updates_applies_expunges_first():
+    client = FakeUpdateImap([])
+    client.untagged_responses = {
+        'EXISTS': [b'9'], 'FETCH': [b'2 (FLAGS (\\Seen))'], 'EXPUNGE': [b'4', b'4'], 'RECENT': [b'1'],
+        'VANISHED': [b'(EARLIER) 7'],
+    }
+    assert imapclient.poll_imap_updates(client) == [
+        imapparse.ImapUpdate('VANISHED', 7, None),
+        imapparse.ImapUpdate('EXPUNGE', 4, None),
+        imapparse.ImapUpdate('EXPUNGE', 4, None),
+        imapparse.ImapUpdate('FETCH', 2, EmailFlag.SEEN.bit),
+        imapparse.ImapUpdate('EXISTS', 9, None),
+    ]
+    assert client.untagged_responses == {}
+
+
+def test_store_imap_flags_sends_one_store_per_flag_and_state():
+    client = FakeImap([
+        [b'4 (UID 1 FLAGS (\\Seen))', b'5 (FLAGS (\\Seen \\Flagged) UID 2)', b'6 (UID 3 FLAGS (\\Seen))'],
+        [b'9 (UID 5 FLAGS ())'],
+    ])
+    mails = {uid: imapclient.ImapEmail(client, uid) for uid in (1, 2, 3, 5)}
+    changes = {
+        (EmailFlag.SEEN, True): [mails[3], mails[1], mails[2]],
+        (EmailFlag.FLAGGED, False): [mails[5]],
+    }
+    imapclient.store_imap_flags(client, changes)
+    assert client.commands == [('UID', 'STORE', '1:3', '+FLAGS', r'\Seen'), ('UID', 'STORE', '5', '-FLAGS', r'\Flagged')]
+    assert mails[2].flags() == [EmailFlag.SEEN, EmailFlag.FLAGGED]
+    assert mails[5].flags() == []
+
+
+def test_flag_writer_stores_in_the_background_and_keeps_newer_changes():
+    client = FakeImap([[b'4 (UID 1 FLAGS (\\Seen))', b'5 (UID 2 FLAGS (\\Seen \\Answered))']])
+    mails = [imapclient.ImapEmail(client, uid) for uid in (1, 2)]
+    for mail in mails:
+        mail._flags = flags_to_mask([EmailFlag.SEEN])
+    callbacks = []
+    writer = imapclient.ImapFlagWriter(client, callbacks.append)
+    writer.write({(EmailFlag.SEEN, True): mails})
+    writer.wait()
+    writer.close()
+    assert client.commands == [('UID', 'STORE', '1:2', '+FLAGS', r'\Seen')]
+    # Nothing changes until the reply is handed back, by which time the first email has been flagged.
+    assert mails[1].flags() == [EmailFlag.SEEN]
+    mails[0]._flags = flags_to_mask([EmailFlag.SEEN, EmailFlag.FLAGGED])
+    for callback in callbacks:
+        callback()
+    assert mails[0].flags() == [EmailFlag.SEEN, EmailFlag.FLAGGED]
+    assert mails[1].flags() == [EmailFlag.ANSWERED, EmailFlag.SEEN]
+
+
+def test_fetch_imap_body_only_fetches_the_text_part():
+    client = FakeImap([[MIXED_STRUCTURE], [(b'1 (UID 8 BODY[1.1] {12}', b'Caf=C3=A9 au\r\n'), b')']])
+    assert imapclient.fetch_imap_body(client, 8) == 'Café au\r\n'
+    assert client.commands == [('UID', 'FETCH', '8', '(BODYSTRUCTURE)'), ('UID', 'FETCH', '8', '(BODY.PEEK[1.1])')]
+
+
+def test_fetch_imap_preview_finds_the_text_part_in_the_start_of_the_text():
+    text = (b'--m\r\nContent-Type: multipart/alternative; boundary="a"\r\n\r\n--a\r\n'
+            b'Content-Type: text/plain; charset=utf-8\r\nContent-Transfer-Encoding: quoted-printable\r\n\r\n'
+            b'Caf=C3=A9 au\r\nlait\r\n--a\r\n')
+    client = FakeImap([[(MIXED_STRUCTURE[:-1] + ' BODY[TEXT]<0> {{{}}}'.format(len(text)).encode(), text), b')']])
+    assert imapclient.fetch_imap_preview(client, 8) == 'Café au\r\nlait'
+    assert client.commands == [('UID', 'FETCH', '8', '(BODYSTRUCTURE BODY.PEEK[TEXT]<0.2048>)')]
+
+
+def test_fetch_imap_preview_falls_back_to_the_text_section():
+    # The start of the text is all attachment, so the text part is fetched by itself.
+    text = b'--m\r\nContent-Type: application/pdf\r\n\r\n' + b'JVBERi0x\r\n' * 4
+    client = FakeImap([[(MIXED_STRUCTURE[:-1] + b' BODY[TEXT]<0> {46}', text[:46]), b')'],
+                       [(b'1 (UID 8 BODY[1.1]<0> {12}', b'Caf=C3=A9 au\r\n'), b')']])
+    assert imapclient.fetch_imap_preview(client, 8, 46) == 'Café au\r\n'
+    assert client.commands[1] == ('UID', 'FETCH', '8', '(BODY.PEEK[1.1]<0.46>)')
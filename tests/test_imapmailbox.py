@@ -0,0 +1,168 @@
+import re
+
+import pytest
+
+from conftest import HEADER, FakeSearchImap, FakeUpdateImap
+from pynemail.email import EmailFlag, flags_to_mask
+from pynemail import imapclient, imapmailbox, imapparse
+from pynemail.imapindex import imap_index
+
+
+def listed_mailbox(client, uids, criteria='ALL'):
+    """Return an ImapMailbox that has listed the given UIDs on the client, and the emails it listed, newest first."""
+    mailbox = imapmailbox.ImapMailbox(client, criteria=criteria)
+    mailbox.uids = list(uids)
+    mailbox._connection = client
+    mails = [mailbox._email(uid) for uid in reversed(uids)]
+    for mail in mails:
+        mail._flags = 0
+    return mailbox, mails
+
+
+def test_mailbox_follows_sequence_numbers_to_uids():
+    new_mail = [(b'3 (UID 40 FLAGS () BODY[HEADER.FIELDS (FROM TO SUBJECT DATE)] {91}', HEADER), b')']
+    client = FakeUpdateImap([[b'3 (UID 40)'], new_mail])
+    mailbox, mails = listed_mailbox(client, [10, 20, 30])
+    updates = [
+        imapparse.ImapUpdate('EXPUNGE', 2, None),
+        imapparse.ImapUpdate('FETCH', 1, EmailFlag.SEEN.bit),
+        imapparse.ImapUpdate('EXISTS', 3, None),
+    ]
+    result = mailbox.apply(mails, updates)
+    assert [m.uid() for m in result] == [40, 30, 10]
+    assert result[1] is mails[0]
+    assert result[0].subject() == 'Hello'
+    assert not result[2].unread()
+    assert mailbox.uids == [10, 30, 40]
+    assert client.commands == [('FETCH', '3:3', '(UID)'), ('UID', 'FETCH', '40', imapclient.SUMMARY_FETCH_ITEMS)]
+
+
+def test_mailbox_applies_vanished_uids():
+    client = FakeUpdateImap([])
+    mailbox, mails = listed_mailbox(client, [10, 20, 30])
+    client.untagged_responses = {'VANISHED': [b'20:30'], 'FETCH': [b'1 (FLAGS (\\Seen))']}
+    result = mailbox.refresh(mails)
+    assert result == [mails[2]]
+    assert not result[0].unread()
+    assert mailbox.uids == [10]
+
+
+@pytest.mark.parametrize("capabilities, commands", [
+    ((), []),
+    (('UIDPLUS', ), [('UID', 'EXPUNGE', '2,5')]),
+])
+def test_mailbox_expunge_removes_the_expunged_uids(capabilities, commands):
+    client = FakeUpdateImap([[None]])
+    client.capabilities = capabilities
+    client.expunge = lambda: ('OK', [b'2', b'2'])
+    mailbox, mails = listed_mailbox(client, [1, 2, 5, 6])
+    mails[1]._flags = mails[2]._flags = flags_to_mask([EmailFlag.DELETED])
+    client.untagged_responses = {'EXPUNGE': [b'2', b'2']}
+    result = mailbox.expunge(mails)
+    assert client.commands == commands
+    assert result == [mails[0], mails[3]]
+    assert [m.uid() for m in result] == [6, 1]
+    assert mailbox.uids == [1, 6]
+
+
+def test_mailbox_only_adds_new_mail_matching_the_criteria():
+    new_mail = [(b'5 (UID 50 FLAGS () BODY[HEADER.FIELDS (FROM TO SUBJECT DATE)] {91}', HEADER), b')']
+    client = FakeSearchImap((), [[b'4 (UID 40)', b'5 (UID 50)'], [b'50'], new_mail])
+    mailbox, mails = listed_mailbox(client, [10, 30], 'UNSEEN')
+    mailbox.uids = [10, 20, 30]
+    result = mailbox.apply(mails, [imapparse.ImapUpdate('EXISTS', 5, None)])
+    assert [m.uid() for m in result] == [50, 30, 10]
+    assert client.commands == [
+        ('FETCH', '4:5', '(UID)'), ('UID', 'SEARCH', 'UID 40,50 UNSEEN'),
+        ('UID', 'FETCH', '50', imapclient.SUMMARY_FETCH_ITEMS),
+    ]
+
+
+def test_sorted_mailbox_sorts_new_mail_into_the_list():
+    new_mail = [(b'4 (UID 40 FLAGS () BODY[HEADER.FIELDS (FROM TO SUBJECT DATE)] {91}', HEADER), b')']
+    client = FakeSearchImap(('SORT', ), [[b'4 (UID 40)'], new_mail, [b'30 40 10']])
+    mailbox, mails = listed_mailbox(client, [10, 30])
+    mailbox.uids, mailbox.sort = [10, 20, 30], 'from'
+    result = mailbox.apply(mails, [imapparse.ImapUpdate('EXISTS', 4, None)])
+    assert [m.uid() for m in result] == [30, 40, 10]
+    assert client.commands[-1] == ('UID', 'SORT', '(FROM)', 'UTF-8', 'UID 10,30,40')
+
+
+class FakeSyncImap:
+    """A mailbox of messages with flags and MODSEQs, with just the commands ImapMailbox needs to resynchronise."""
+
+    def __init__(self, capabilities, uids):
+        self.capabilities = capabilities
+        self.uidvalidity = 1
+        self.modseq = 1
+        self.messages = {uid: ('', 1) for uid in uids}
+        self.expunged = {}
+        self.untagged_responses = {}
+        self.commands = []
+
+    def change(self, uid, flags=''):
+        self.modseq += 1
+        self.messages[uid] = (flags, self.modseq)
+
+    def remove(self, uid):
+        self.modseq += 1
+        del self.messages[uid]
+        self.expunged[uid] = self.modseq
+
+    def select(self):
+        self.commands.append(('SELECT', ))
+        self.untagged_responses = {'UIDVALIDITY': [str(self.uidvalidity).encode()]}
+        if 'CONDSTORE' in self.capabilities:
+            self.untagged_responses['HIGHESTMODSEQ'] = [str(self.modseq).encode()]
+        return 'OK', [str(len(self.messages)).encode()]
+
+    def uid(self, command, *args):
+        self.commands.append(('UID', command) + args)
+        if command == 'SEARCH':
+            return 'OK', [' '.join(str(uid) for uid in sorted(self.messages)).encode()]
+        since = int(re.search(r'CHANGEDSINCE (\d+)', args[1]).group(1))
+        if 'VANISHED' in args[1]:
+            vanished = [uid for uid, modseq in self.expunged.items() if modseq > since]
+            self.untagged_responses['VANISHED'] = [b'(EARLIER) ' + imapparse.compress_sequence_set(vanished).encode()]
+        return 'OK', ['{} (UID {} FLAGS ({}) MODSEQ ({}))'.format(i, uid, flags, modseq).encode()
+                      for i, (uid, (flags, modseq)) in enumerate(sorted(self.messages.items()), 1) if modseq > since]
+
+
+@pytest.mark.parametrize("capabilities, commands, flags", [
+    ((), [('SELECT', ), ('UID', 'SEARCH', 'ALL')], [None, None, None]),
+    (('CONDSTORE', ), [('SELECT', ), ('UID', 'FETCH', '1:*', '(FLAGS) (CHANGEDSINCE 1)'), ('UID', 'SEARCH', 'ALL')],
+     [0, 0, EmailFlag.SEEN.bit]),
+    (('CONDSTORE', 'QRESYNC'), [('SELECT', ), ('UID', 'FETCH', '1:*', '(FLAGS) (CHANGEDSINCE 1 VANISHED)')],
+     [0, 0, EmailFlag.SEEN.bit]),
+])
+def test_mailbox_resync_only_fetches_what_has_changed(tmp_path, capabilities, commands, flags):
+    client = FakeSyncImap(capabilities, [1, 2, 3])
+    with imap_index('server', 'user', path=tmp_path / 'index.sqlite') as index:
+        mailbox = imapmailbox.ImapMailbox(client, index)
+        for mail in mailbox.list(preload=False):
+            mail._summary = ('Alice', '', 'Message {}'.format(mail.uid()), '', '', '', '')
+            mail._flags = 0
+        mailbox.save()
+    client.change(1, r'\Seen')
+    client.remove(2)
+    client.change(4)
+    client.commands = []
+    with imap_index('server', 'user', path=tmp_path / 'index.sqlite') as index:
+        mails = imapmailbox.ImapMailbox(client, index).list(preload=False)
+    assert client.commands == commands
+    assert [m.uid() for m in mails] == [4, 3, 1]
+    assert [m._summary is not None for m in mails] == [False, True, True]
+    assert [m._flags for m in mails] == flags
+
+
+def test_mailbox_forgets_everything_when_the_uidvalidity_changes(tmp_path):
+    client = FakeSyncImap(('CONDSTORE', ), [1, 2])
+    with imap_index('server', 'user', path=tmp_path / 'index.sqlite') as index:
+        mailbox = imapmailbox.ImapMailbox(client, index)
+        for mail in mailbox.list(preload=False):
+            mail._summary, mail._flags = ('Alice', '', 'Hello', '', '', '', ''), 0
+        mailbox.save()
+    client.uidvalidity = 2
+    with imap_index('server', 'user', path=tmp_path / 'index.sqlite') as index:
+        mails = imapmailbox.ImapMailbox(client, index).list(preload=False)
+        assert [(m._summary, m._flags) for m in mails] == [(None, None), (None, None)]
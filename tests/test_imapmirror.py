@@ -0,0 +1,252 @@
+import os
+import re
+import threading
+
+import pytest
+
+from pynemail import imapmirror
+from pynemail.imapparse import compress_sequence_set, expand_sequence_set
+from pynemail.imapmirror import ImapMirror, ImapMirrorSyncer, MirrorState, STATE_FILENAME
+
+
+DATE = '01-Jan-2018 10:00:00 +0000'
+
+
+class FakeMirrorImap:
+    """A mailbox of messages with flags and MODSEQs, with just the commands ImapMirror needs."""
+
+    def __init__(self, capabilities=(), messages=()):
+        self.capabilities = capabilities
+        self.uidvalidity = 1
+        self.modseq = 1
+        self.uidnext = 1
+        self.messages = {}
+        self.expunged = {}
+        self.untagged_responses = {}
+        self.commands = []
+        for data, flags in messages:
+            self.append(data, flags)
+
+    def append(self, data, flags=''):
+        self.modseq += 1
+        self.messages[self.uidnext] = [data, set(flags.split()), self.modseq]
+        self.uidnext += 1
+
+    def change(self, uid, flags):
+        self.modseq += 1
+        self.messages[uid][1:] = [set(flags.split()), self.modseq]
+
+    def remove(self, uid):
+        self.modseq += 1
+        del self.messages[uid]
+        self.expunged[uid] = self.modseq
+
+    def select(self):
+        self.untagged_responses = {'UIDVALIDITY': [str(self.uidvalidity).encode()]}
+        if 'CONDSTORE' in self.capabilities:
+            self.untagged_responses['HIGHESTMODSEQ'] = [str(self.modseq).encode()]
+        return 'OK', [str(len(self.messages)).encode()]
+
+    def _uids(self, spec):
+        uids = sorted(self.messages) if spec == '1:*' else expand_sequence_set(spec)
+        return [uid for uid in uids if uid in self.messages]
+
+    def uid(self, command, spec, *args):
+        self.commands.append((command, spec) + args)
+        if command == 'SEARCH':
+            return 'OK', [' '.join(str(uid) for uid in sorted(self.messages)).encode()]
+        if command == 'STORE':
+            for uid in self._uids(spec):
+                flags = self.messages[uid][1]
+                (flags.add if args[0].startswith('+') else flags.discard)(args[1])
+                self.change(uid, ' '.join(flags))
+            return 'OK', [None]
+        if command == 'EXPUNGE':
+            for uid in self._uids(spec):
+                if '\\Deleted' in self.messages[uid][1]:
+                    self.remove(uid)
+            return 'OK', [None]
+        return 'OK', self._fetch(spec, args[0])
+
+    def _fetch(self, spec, items):
+        since = re.search(r'CHANGEDSINCE (\d+)', items)
+        if since and 'VANISHED' in items:
+            vanished = [uid for uid, modseq in self.expunged.items() if modseq > int(since.group(1))]
+            self.untagged_responses['VANISHED'] = [b'(EARLIER) ' + compress_sequence_set(vanished).encode()]
+        partial = re.search(r'<(\d+)\.(\d+)>', items)
+        data = []
+        for num, uid in enumerate(self._uids(spec), 1):
+            body, flags, modseq = self.messages[uid]
+            if since and modseq <= int(since.group(1)):
+                continue
+            prefix = '{} (UID {} '.format(num, uid)
+            if 'BODY' not in items:
+                prefix += 'FLAGS ({})'.format(' '.join(sorted(flags)))
+                if 'INTERNALDATE' in items:
+                    prefix += ' INTERNALDATE "{}" RFC822.SIZE {}'.format(DATE, len(body))
+                data.append((prefix + ')').encode())
+            elif partial:
+                start = int(partial.group(1))
+                chunk = body[start:start + int(partial.group(2))]
+                data += [('{}BODY[]<{}> {{{}}}'.format(prefix, start, len(chunk)).encode(), chunk), b')']
+            else:
+                data += [('{}BODY[] {{{}}}'.format(prefix, len(body)).encode(), body), b')']
+        return data
+
+
+def mirrored(maildir):
+    """Return the UID and maildir flags of every mirrored message."""
+    files = [name for subdir in ('cur', 'new') for name in os.listdir(str(maildir / subdir))]
+    return sorted((int(re.search(r'\.U(\d+)V', name).group(1)), name.partition(':2,')[2]) for name in files)
+
+
+def body_fetches(client):
+    return [command for command in client.commands if 'BODY' in command[-1]]
+
+
+def test_sync_downloads_every_message_into_the_maildir(tmp_path):
+    client = FakeMirrorImap(messages=[(b'Subject: One\r\n\r\n1\r\n', '\\Seen'), (b'Subject: Two\r\n\r\n2\r\n', '')])
+    ImapMirror(tmp_path, client).sync()
+    assert mirrored(tmp_path) == [(1, 'S'), (2, '')]
+    paths = sorted((tmp_path / 'cur').iterdir())
+    assert paths[0].read_bytes() == b'Subject: One\r\n\r\n1\r\n'
+    assert paths[0].stat().st_mtime == 1514800800
+    assert os.listdir(str(tmp_path / 'tmp')) == []
+    # Both small messages come in a single FETCH.
+    assert body_fetches(client) == [('FETCH', '1:2', '(BODY.PEEK[])')]
+
+
+@pytest.mark.parametrize("capabilities", [(), ('CONDSTORE', ), ('CONDSTORE', 'QRESYNC')])
+def test_sync_only_carries_changes_in_either_direction(tmp_path, capabilities):
+    client = FakeMirrorImap(capabilities, [(b'1', ''), (b'2', ''), (b'3', '\\Seen'), (b'4', '')])
+    mirror = ImapMirror(tmp_path, client)
+    mirror.sync()
+    client.change(1, '\\Flagged')
+    client.remove(2)
+    client.append(b'5', '')
+    # Flagged locally, and marked as read on the server, so both changes are kept.
+    path = next(p for p in (tmp_path / 'cur').iterdir() if '.U4V' in p.name)
+    path.rename(path.with_name(path.name.replace(':2,', ':2,F')))
+    client.change(4, '\\Seen')
+    client.commands = []
+    mirror.sync()
+    assert mirrored(tmp_path) == [(1, 'F'), (3, 'S'), (4, 'FS'), (5, '')]
+    assert client.messages[4][1] == {'\\Seen', '\\Flagged'}
+    assert body_fetches(client) == [('FETCH', '5', '(BODY.PEEK[])')]
+    client.commands = []
+    mirror.sync()
+    assert [c for c in client.commands if c[0] != 'SEARCH' and 'CHANGEDSINCE' not in c[-1]] == \
+        ([('FETCH', '1:*', '(FLAGS)')] if not capabilities else [])
+
+
+@pytest.mark.parametrize("capabilities, remaining", [(('UIDPLUS', ), [2]), ((), [1, 2])])
+def test_local_deletions_are_expunged_on_the_server(tmp_path, capabilities, remaining):
+    client = FakeMirrorImap(capabilities, [(b'1', ''), (b'2', '')])
+    mirror = ImapMirror(tmp_path, client)
+    mirror.sync()
+    next(p for p in (tmp_path / 'cur').iterdir() if '.U1V' in p.name).unlink()
+    mirror.sync()
+    assert sorted(client.messages) == remaining
+    if 1 in client.messages:
+        assert '\\Deleted' in client.messages[1][1]
+    # Either way, it isn't downloaded again.
+    mirror.sync()
+    assert mirrored(tmp_path) == [(2, '')]
+
+
+def test_push_only_sends_the_changes_of_the_given_files(tmp_path):
+    client = FakeMirrorImap(messages=[(b'1', ''), (b'2', '\\Seen'), (b'3', '')])
+    mirror = ImapMirror(tmp_path, client)
+    mirror.sync()
+    paths = {int(re.search(r'\.U(\d+)V', p.name).group(1)): p for p in (tmp_path / 'cur').iterdir()}
+    client.change(1, '\\Answered')
+    paths[1].rename(paths[1].with_name(paths[1].name + 'F'))
+    paths[2].unlink()
+    client.commands = []
+    # The first file has been renamed since, so it's found by its key.
+    mirror.push([paths[1], paths[2]])
+    mirror.close()
+    assert client.commands == [('STORE', '1', '+FLAGS.SILENT', '\\Flagged'),
+                               ('STORE', '2', '+FLAGS.SILENT', '\\Deleted')]
+    # The change made on the server in the meantime is kept.
+    assert client.messages[1][1] == {'\\Answered', '\\Flagged'}
+
+
+def test_large_messages_are_fetched_in_chunks_and_resumed(tmp_path, monkeypatch):
+    monkeypatch.setattr(imapmirror, 'LARGE_MESSAGE_SIZE', 10)
+    monkeypatch.setattr(imapmirror, 'CHUNK_SIZE', 4)
+    body = b'0123456789abcdef'
+    client = FakeMirrorImap(messages=[(body, '')])
+    mirror = ImapMirror(tmp_path, client)
+    # As if the last sync was interrupted after the first two chunks.
+    key = imapmirror.mirror_key(1, 1, 1514800800)
+    (tmp_path / 'tmp' / key).write_bytes(body[:8])
+    mirror.sync()
+    assert body_fetches(client) == [('FETCH', '1', '(BODY.PEEK[]<8.4>)'), ('FETCH', '1', '(BODY.PEEK[]<12.4>)'),
+                                    ('FETCH', '1', '(BODY.PEEK[]<16.4>)')]
+    assert next((tmp_path / 'cur').iterdir()).read_bytes() == body
+
+
+def test_a_new_uidvalidity_starts_the_mirror_again(tmp_path):
+    client = FakeMirrorImap(messages=[(b'1', ''), (b'2', '')])
+    mirror = ImapMirror(tmp_path, client)
+    mirror.sync()
+    client.uidvalidity = 2
+    client.remove(1)
+    mirror.sync()
+    assert [name.split('.')[1] for name in os.listdir(str(tmp_path / 'cur'))] == ['U2V2']
+    state = MirrorState(tmp_path / STATE_FILENAME)
+    assert (state.uidvalidity, sorted(state.entries)) == (2, [2])
+    state.close()
+
+
+class CountingMirror:
+
+    def __init__(self):
+        self.syncs = 0
+        self.synced = threading.Condition()
+
+    def sync(self):
+        with self.synced:
+            self.syncs += 1
+            self.synced.notify_all()
+
+    def wait_for(self, syncs):
+        with self.synced:
+            assert self.synced.wait_for(lambda: self.syncs >= syncs, 5)
+
+
+def test_syncer_syncs_at_once_and_whenever_asked_to():
+    mirror = CountingMirror()
+    syncer = ImapMirrorSyncer(mirror, interval=60)
+    syncer.start()
+    mirror.wait_for(1)
+    syncer.request()
+    mirror.wait_for(2)
+    # Nothing's been asked for since, so there's no need for another sync on the way out.
+    syncer.stop()
+    assert mirror.syncs == 2
+
+
+class UnreachableMirror(CountingMirror):
+
+    def __init__(self):
+        super().__init__()
+        self.release = threading.Event()
+
+    def sync(self):
+        super().sync()
+        self.release.wait(5)
+        raise OSError('Network is unreachable')
+
+
+def test_syncer_skips_the_last_sync_when_the_server_is_out_of_reach():
+    mirror = UnreachableMirror()
+    syncer = ImapMirrorSyncer(mirror, interval=60)
+    syncer.start()
+    mirror.wait_for(1)
+    syncer.request()
+    threading.Timer(0.1, mirror.release.set).start()
+    syncer.stop()
+    assert mirror.syncs == 1
+    assert isinstance(syncer.error, OSError)
@@ -0,0 +1,83 @@
+import pytest
+
+from conftest import HEADER, MIXED_STRUCTURE
+from pynemail.email import EmailFlag, flags_to_mask
+from pynemail import imapparse
+
+
+@pytest.mark.parametrize("nums, result", [
+    ([1], '1'),
+    ([3, 1, 2, 7], '1:3,7'),
+    ([5, 4, 4, 9, 10, 12], '4:5,9:10,12'),
+])
+def test_compress_sequence_set(nums, result):
+    assert imapparse.compress_sequence_set(nums) == result
+
+
+def test_parse_fetch_response_with_flags_before_literal():
+    data = [
+        (b'1 (FLAGS (\\Seen \\Flagged) BODY[HEADER.FIELDS (FROM TO SUBJECT DATE)] {91}', HEADER),
+        b')',
+    ]
+    results = imapparse.parse_fetch_response(data)
+    assert list(results) == [1]
+    assert results[1].literal(b'BODY[HEADER') == HEADER
+    assert results[1].flags() == flags_to_mask([EmailFlag.SEEN, EmailFlag.FLAGGED])
+
+
+def test_parse_fetch_response_with_flags_after_literal():
+    data = [
+        (b'7 (BODY[HEADER.FIELDS (FROM TO SUBJECT DATE)] {91}', HEADER),
+        b' FLAGS ())',
+        (b'8 (BODY[HEADER.FIELDS (FROM TO SUBJECT DATE)] {91}', HEADER),
+        b' FLAGS (\\Draft))',
+    ]
+    results = imapparse.parse_fetch_response(data)
+    assert results[7].flags() == 0
+    assert results[8].flags() == EmailFlag.DRAFT.bit
+
+
+@pytest.mark.parametrize("flagstr, flags", [
+    (b'1 (FLAGS (\\Seen \\Answered $Junk))', [EmailFlag.ANSWERED, EmailFlag.SEEN]),
+    (b'1 (FLAGS (\\flagged \\Deleted))', [EmailFlag.FLAGGED, EmailFlag.DELETED]),
+    (b'1 (FLAGS ())', []),
+])
+def test_parse_imap_flags(flagstr, flags):
+    assert imapparse.parse_imap_flags([flagstr]) == flags_to_mask(flags)
+
+
+@pytest.mark.parametrize("line, updates", [
+    (b'* 23 EXISTS\r\n', [imapparse.ImapUpdate('EXISTS', 23, None)]),
+    (b'* 5 EXPUNGE\r\n', [imapparse.ImapUpdate('EXPUNGE', 5, None)]),
+    (b'* 2 FETCH (FLAGS (\\Seen \\Draft))\r\n', [imapparse.ImapUpdate('FETCH', 2, EmailFlag.SEEN.bit | EmailFlag.DRAFT.bit)]),
+    (b'* 2 FETCH (UID 7)\r\n', []),
+    (b'* VANISHED 4,7:8\r\n', [imapparse.ImapUpdate('VANISHED', uid, None) for uid in (4, 7, 8)]),
+    (b'* VANISHED (EARLIER) 3\r\n', [imapparse.ImapUpdate('VANISHED', 3, None)]),
+    (b'* 1 RECENT\r\n', []),
+    (b'+ idling\r\n', []),
+])
+def test_parse_imap_updates(line, updates):
+    assert imapparse.parse_imap_updates(line) == updates
+
+
+@pytest.mark.parametrize("response, section", [
+    ([MIXED_STRUCTURE], '1.1'),
+    ([b'1 (BODYSTRUCTURE ("TEXT" "PLAIN" NIL NIL NIL "7BIT" 5 1 NIL NIL NIL NIL))'], '1'),
+    ([b'1 (BODYSTRUCTURE ("text" "plain" NIL NIL NIL "7bit" 5 1 NIL ("attachment" NIL) NIL NIL))'], None),
+    ([b'1 (BODYSTRUCTURE (("text" "html" NIL NIL NIL "7bit" 5 1 NIL NIL NIL NIL) "alternative" NIL NIL NIL))'], None),
+    ([(b'1 (BODYSTRUCTURE ("text" "plain" ("name" {3}', b'a"b'), b') NIL NIL "7bit" 5 1))'], '1'),
+    ([b'1 (BODYSTRUCTURE (("text" "html" NIL NIL NIL "7bit" 5 1 NIL NIL NIL NIL)'
+      b'("text" "plain" NIL NIL NIL "7bit" 5 1 NIL NIL NIL NIL) "alternative" ("boundary" "a") NIL NIL))'], '2'),
+])
+def test_find_text_section(response, section):
+    structure = imapparse.fetch_item(imapparse.parse_imap_list(response), b'BODYSTRUCTURE')
+    assert imapparse.find_text_section(structure) == section
+
+
+@pytest.mark.parametrize("sequence_set, nums", [
+    ('7', [7]),
+    ('1:3,7', [1, 2, 3, 7]),
+    ('9,5:3,1', [9, 5, 4, 3, 1]),
+])
+def test_expand_sequence_set(sequence_set, nums):
+    assert imapparse.expand_sequence_set(sequence_set) == nums
@@ -0,0 +1,136 @@
+import imaplib
+import threading
+
+import pytest
+
+from pynemail.imappool import ImapPool, checkout
+
+
+class FakeConnection:
+
+    def __init__(self, num, healthy=True):
+        self.num = num
+        self.healthy = healthy
+        self.closed = False
+        self.logged_out = False
+        self.untagged_responses = {}
+
+    def noop(self):
+        if not self.healthy:
+            raise imaplib.IMAP4.abort('connection lost')
+        return 'OK', [b'']
+
+    def close(self):
+        self.closed = True
+
+    def logout(self):
+        self.logged_out = True
+
+
+class Connector:
+
+    def __init__(self):
+        self.connections = []
+
+    def __call__(self):
+        con = FakeConnection(len(self.connections))
+        self.connections.append(con)
+        return con
+
+
+def test_connections_are_opened_lazily_and_reused():
+    connect = Connector()
+    pool = ImapPool(connect, 3)
+    assert connect.connections == []
+    with pool.connection() as first:
+        pass
+    with pool.connection() as second:
+        pass
+    assert first is second
+    with pool.connection(interactive=True) as interactive:
+        assert interactive is not first
+    assert len(connect.connections) == 2
+
+
+def test_checkout_is_reentrant():
+    pool = ImapPool(Connector(), 2)
+    with checkout(pool) as outer:
+        with checkout(pool) as inner:
+            assert inner is outer
+    with pool.connection() as outer:
+        with pool.connection() as inner:
+            assert inner is outer
+
+
+def test_background_work_never_uses_the_interactive_connection():
+    connect = Connector()
+    pool = ImapPool(connect, 2)
+    started, release = threading.Event(), threading.Event()
+
+    def background():
+        with pool.connection():
+            started.set()
+            release.wait(5)
+    worker = threading.Thread(target=background)
+    worker.start()
+    started.wait(5)
+    # The only background connection is busy, but the UI doesn't have to wait for it.
+    with pool.connection(interactive=True) as con:
+        assert con is connect.connections[1]
+    release.set()
+    worker.join()
+
+
+def test_background_work_waits_for_a_free_connection():
+    pool = ImapPool(Connector(), 2)
+    order = []
+
+    def background():
+        with pool.connection():
+            order.append('second')
+    with pool.connection():
+        worker = threading.Thread(target=background)
+        worker.start()
+        worker.join(0.1)
+        order.append('first')
+    worker.join(5)
+    assert order == ['first', 'second']
+
+
+def test_idle_connections_are_checked_and_replaced():
+    connect = Connector()
+    pool = ImapPool(connect, 2, check_interval=0)
+    with pool.connection() as first:
+        pass
+    with pool.connection() as second:
+        pass
+    assert second is first
+    first.healthy = False
+    with pool.connection() as third:
+        assert third is not first
+    assert first.logged_out
+
+
+def test_broken_connections_are_replaced():
+    pool = ImapPool(Connector(), 2)
+    with pytest.raises(imaplib.IMAP4.abort):
+        with pool.connection() as first:
+            raise imaplib.IMAP4.abort('connection lost')
+    assert first.logged_out
+    with pool.connection() as second:
+        assert second is not first
+
+
+def test_close_logs_out_and_closes_the_mailbox():
+    connect = Connector()
+    pool = ImapPool(connect, 3)
+    with pool.connection(interactive=True):
+        pass
+    with pool.connection() as background:
+        background.untagged_responses['EXISTS'] = [b'3']
+    assert background.untagged_responses == {}
+    pool.close()
+    assert [(con.closed, con.logged_out) for con in connect.connections] == [(True, True), (False, True)]
+    with pytest.raises(imaplib.IMAP4.error):
+        with pool.connection():
+            pass
@@ -0,0 +1,51 @@
+import pytest
+
+from conftest import FakeSearchImap
+from pynemail import imapclient, imapsearch
+from pynemail.threads import flatten_thread
+
+
+@pytest.mark.parametrize("capabilities, sort, responses, command, uids", [
+    ((), None, [[b'1 2 5']], ('UID', 'SEARCH', 'UNSEEN'), [5, 2, 1]),
+    ((), 'date', [[b'1 2 5']], ('UID', 'SEARCH', 'UNSEEN'), [5, 2, 1]),
+    (('ESEARCH', ), None, [[b'(TAG "A1") UID ALL 1:2,5']], ('UID', 'SEARCH', 'RETURN (ALL)', 'UNSEEN'), [5, 2, 1]),
+    (('ESEARCH', ), None, [[b'(TAG "A1") UID']], ('UID', 'SEARCH', 'RETURN (ALL)', 'UNSEEN'), []),
+    (('SORT', ), 'date', [[b'2 5 1']], ('UID', 'SORT', '(REVERSE DATE)', 'UTF-8', 'UNSEEN'), [2, 5, 1]),
+    (('SORT', ), 'arrival', [[b'1 2 5']], ('UID', 'SEARCH', 'UNSEEN'), [5, 2, 1]),
+    (('SORT', 'ESORT'), 'subject', [[b'(TAG "A1") UID ALL 2,5,1']],
+     ('UID', 'SORT', 'RETURN (ALL)', '(SUBJECT)', 'UTF-8', 'UNSEEN'), [2, 5, 1]),
+    (('SORT', 'ESORT'), 'date', [[b'(TAG "A1") UID ALL 7']],
+     ('UID', 'SORT', 'RETURN (ALL)', '(REVERSE DATE)', 'UTF-8', 'UNSEEN'), [7]),
+])
+def test_search_imap_uses_the_best_command_available(capabilities, sort, responses, command, uids):
+    client = FakeSearchImap(capabilities, responses)
+    assert imapsearch.search_imap(client, 'UNSEEN', sort) == uids
+    assert client.commands == [command]
+
+
+def test_imap_search_filters_the_list_with_the_servers_search():
+    client = FakeSearchImap((), [[b'1 5'], [b'5']])
+    mails = [imapclient.ImapEmail(client, uid) for uid in (5, 2, 1)]
+    search = imapsearch.ImapSearch(client)
+    search.start(mails)
+    assert search.filter(' ') == mails
+    assert search.filter('lunch') == [mails[0], mails[2]]
+    assert search.filter('lunch bob') == [mails[0]]
+    # Going back to an earlier query doesn't search again.
+    assert search.filter('lunch ') == [mails[0], mails[2]]
+    assert client.commands == [('UID', 'SEARCH', 'TEXT "lunch"'), ('UID', 'SEARCH', 'TEXT "lunch" TEXT "bob"')]
+
+
+def test_thread_imap_builds_containers_from_the_thread_response():
+    client = FakeSearchImap(('THREAD=REFERENCES', ), [[b'(2)(3 6 (4 23)(44 7 96))((5)(8))']])
+    mails = {uid: imapclient.ImapEmail(client, uid) for uid in (2, 3, 4, 5, 6, 7, 8, 23, 96)}
+    listed = [mails[uid] for uid in (96, 23, 8, 7, 6, 5, 4, 3, 2)]
+    roots = imapsearch.thread_imap(client, listed, 'UNSEEN')
+    assert client.commands == [('UID', 'THREAD', 'REFERENCES', 'UTF-8', 'UNSEEN')]
+    order = {id(m): i for i, m in enumerate(listed)}
+    flattened = [[(m.uid(), depth) for m, depth in flatten_thread(root, order)] for root in roots]
+    assert flattened == [
+        [(3, 0), (6, 1), (4, 2), (23, 3), (7, 2), (96, 3)],
+        [(5, 0), (8, 0)],
+        [(2, 0)],
+    ]
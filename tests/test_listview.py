@@ -0,0 +1,45 @@
+import pytest
+
+from pynemail.ui.listview import ListView
+
+
+def test_moving_past_the_window_scrolls():
+    view = ListView(100, 10)
+    view.move(12)
+    assert (view.selected, view.top) == (12, 3)
+    view.move(-5)
+    assert (view.selected, view.top) == (7, 3)
+    view.move(-10)
+    assert (view.selected, view.top) == (0, 0)
+
+
+@pytest.mark.parametrize("start, pages, exp_selected, exp_top", [
+    (2, 1, 12, 10),
+    (2, 20, 92, 90),
+    (95, -1, 85, 76),
+    (50, -20, 9, 0),
+])
+def test_paging_keeps_the_selection_on_the_same_row(start, pages, exp_selected, exp_top):
+    view = ListView(100, 10)
+    view.select(start)
+    view.page(pages)
+    assert (view.selected, view.top) == (exp_selected, exp_top)
+
+
+def test_home_end_and_visible_range():
+    view = ListView(100, 10)
+    view.end()
+    assert (view.selected, view.top) == (99, 90)
+    assert view.visible() == range(90, 100)
+    assert view.visible(5) == range(85, 100)
+    view.home()
+    assert view.visible(5) == range(0, 15)
+
+
+def test_shrinking_the_list_keeps_the_selection_valid():
+    view = ListView(100, 10)
+    view.end()
+    view.set_length(5)
+    assert (view.selected, view.top) == (4, 0)
+    view.set_length(0)
+    assert view.visible() == range(0, 0)
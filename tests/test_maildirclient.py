@@ -0,0 +1,212 @@
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from pynemail.email import EmailFlag, flags_to_mask
+from pynemail import maildirclient
+from pynemail.flagqueue import FlagQueue
+from pynemail.maildirindex import maildir_index
+
+
+MESSAGE = '''From: "Bob" <bob@example.com>
+To: alice@example.com
+Subject: {subject}
+Date: Tue, 2 Jan 2018 10:00:00 +0000
+
+Hello Alice!
+'''
+
+
+@pytest.fixture
+def maildir(tmp_path):
+    for subdir in ('new', 'cur', 'tmp'):
+        (tmp_path / subdir).mkdir()
+    for i, name in enumerate(['1.abc:2,', '2.abc:2,S', '3.abc:2,FS']):
+        path = tmp_path / ('new' if i == 0 else 'cur') / name
+        path.write_text(MESSAGE.format(subject='Message {}'.format(i)))
+        os.utime(str(path), (1000 + i, 1000 + i))
+    return tmp_path
+
+
+def test_get_mail_from_maildir_sorts_newest_first(maildir):
+    mails = maildirclient.get_mail_from_maildir(maildir)
+    assert [m.subject() for m in mails] == ['Message 2', 'Message 1', 'Message 0']
+    assert mails[0].flags() == [EmailFlag.SEEN, EmailFlag.FLAGGED]
+    assert mails[2].is_new
+
+
+@pytest.mark.parametrize("name, flags, newname", [
+    ('1.abc:2,', [EmailFlag.SEEN], '1.abc:2,S'),
+    ('1.abc:2,FS', [EmailFlag.SEEN], '1.abc:2,S'),
+    ('1.abc:2,PS', [EmailFlag.ANSWERED, EmailFlag.SEEN, EmailFlag.FLAGGED], '1.abc:2,FPRS'),
+    ('1.abc', [EmailFlag.SEEN], '1.abc:2,S'),
+])
+def test_maildir_flags_round_trip(tmp_path, name, flags, newname):
+    path = tmp_path / name
+    path.write_text('')
+    newpath = maildirclient.update_maildir_flags(path, flags_to_mask(flags))
+    assert newpath.name == newname
+    assert maildirclient.parse_maildir_flags(newpath) == flags_to_mask(flags)
+
+
+def test_maildir_index_avoids_parsing_unchanged_mail(maildir, tmp_path_factory, monkeypatch):
+    index_path = tmp_path_factory.mktemp('cache') / 'index.sqlite'
+    with maildir_index(maildir, index_path) as index:
+        cold = maildirclient.get_mail_from_maildir(maildir, index)
+    assert [m.sender() for m in cold] == ['Bob'] * 3
+
+    changed = maildir / 'cur' / '2.abc:2,S'
+    changed.write_text(MESSAGE.format(subject='Edited'))
+    parsed = []
+    original = maildirclient.MaildirEmail._get_headers
+    monkeypatch.setattr(maildirclient.MaildirEmail, '_get_headers',
+                        lambda self: parsed.append(self.filepath.name) or original(self))
+    with maildir_index(maildir, index_path) as index:
+        warm = maildirclient.get_mail_from_maildir(maildir, index)
+    assert parsed == ['2.abc:2,S']
+    assert sorted(m.subject() for m in warm) == ['Edited', 'Message 0', 'Message 2']
+
+
+def test_maildir_index_forgets_removed_mail(maildir, tmp_path_factory):
+    index_path = tmp_path_factory.mktemp('cache') / 'index.sqlite'
+    with maildir_index(maildir, index_path) as index:
+        maildirclient.get_mail_from_maildir(maildir, index)
+    (maildir / 'new' / '1.abc:2,').unlink()
+    with maildir_index(maildir, index_path) as index:
+        assert len(maildirclient.get_mail_from_maildir(maildir, index)) == 2
+    with maildir_index(maildir, index_path) as index:
+        assert index.lookup('1.abc', 0, 0.0) is None
+
+
+def test_headers_are_parsed_without_the_body(maildir):
+    path = maildir / 'cur' / '4.abc:2,'
+    path.write_bytes(MESSAGE.format(subject='Big').encode() + b'x' * 100000)
+    mail = maildirclient.MaildirEmail(path, False)
+    assert mail.subject() == 'Big'
+    assert not mail.has_message()
+
+
+def test_preview_only_reads_the_start_of_the_body(maildir, monkeypatch):
+    path = maildir / 'new' / '4.abc:2,'
+    path.write_bytes(MESSAGE.format(subject='Big').encode() + b'x' * 100 + b'\n' + b'y' * 100000)
+    monkeypatch.setattr(maildirclient, 'extract_body_from_file', None)
+    mail = maildirclient.MaildirEmail(path, False)
+    assert mail.preview() == 'Hello Alice!\n' + 'x' * 100
+    assert mail.has_preview() and not mail.has_body()
+    assert mail.unread()
+
+
+def test_maildir_watcher_applies_changes_incrementally(maildir):
+    mails = maildirclient.get_mail_from_maildir(maildir)
+    updates = []
+    watcher = maildirclient.MaildirWatcher(maildir, mails, updates.append)
+    try:
+        delivered = maildir / 'tmp' / '9.abc'
+        delivered.write_text(MESSAGE.format(subject='Delivered'))
+        delivered.rename(maildir / 'new' / '9.abc:2,')
+        (maildir / 'cur' / '2.abc:2,S').rename(maildir / 'cur' / '2.abc:2,FS')
+        (maildir / 'cur' / '3.abc:2,FS').unlink()
+        watcher.handle_events()
+    finally:
+        watcher.close()
+    assert len(updates) == 1
+    subjects = [m.subject() for m in updates[0]]
+    assert subjects == ['Delivered', 'Message 1', 'Message 0']
+    assert updates[0][1] is mails[1]
+    assert updates[0][1].important()
+
+
+def test_maildir_watcher_accepts_deliveries_without_flags(maildir):
+    mails = maildirclient.get_mail_from_maildir(maildir)
+    updates = []
+    watcher = maildirclient.MaildirWatcher(maildir, mails, updates.append)
+    try:
+        delivered = maildir / 'tmp' / '9.abc'
+        delivered.write_text(MESSAGE.format(subject='Delivered'))
+        delivered.rename(maildir / 'new' / '9.abc')
+        watcher.handle_events()
+    finally:
+        watcher.close()
+    mail = updates[0][0]
+    assert (mail.subject(), mail.flags(), mail.unread()) == ('Delivered', [], True)
+    mail.set_flag(EmailFlag.SEEN, True)
+    assert sorted(os.listdir(str(maildir / 'new'))) == ['1.abc:2,', '9.abc:2,S']
+
+
+def test_maildir_watcher_keeps_queued_flag_changes_when_another_program_renames_the_file(maildir):
+    mails = maildirclient.get_mail_from_maildir(maildir)
+    queue = FlagQueue(maildirclient.rename_maildir_flags, lambda delay, callback: None)
+    maildirclient.MaildirEmail.flag_queue = queue
+    watcher = maildirclient.MaildirWatcher(maildir, mails, lambda mails: None)
+    try:
+        mail = mails[2]
+        mail.set_flag(EmailFlag.SEEN, True)
+        (maildir / 'new' / '1.abc:2,').rename(maildir / 'cur' / '1.abc:2,F')
+        watcher.handle_events()
+        assert mail.flags() == [EmailFlag.SEEN, EmailFlag.FLAGGED]
+        queue.flush()
+    finally:
+        watcher.close()
+        maildirclient.MaildirEmail.flag_queue = None
+    assert sorted(os.listdir(str(maildir / 'cur'))) == ['1.abc:2,FS', '2.abc:2,S', '3.abc:2,FS']
+
+
+def test_rename_maildir_flags_renames_each_email_once(maildir, monkeypatch):
+    mails = maildirclient.get_mail_from_maildir(maildir)
+    renames = []
+    update = maildirclient.update_maildir_flags
+    monkeypatch.setattr(maildirclient, 'update_maildir_flags',
+                        lambda path, flags: renames.append(path) or update(path, flags))
+    mails[2]._flags = flags_to_mask([EmailFlag.SEEN, EmailFlag.FLAGGED])
+    mails[1]._flags = flags_to_mask([EmailFlag.SEEN, EmailFlag.FLAGGED])
+    maildirclient.rename_maildir_flags({
+        (EmailFlag.SEEN, True): [mails[2]],
+        (EmailFlag.FLAGGED, True): [mails[2], mails[1]],
+    })
+    assert len(renames) == 2
+    assert sorted(p.name for p in (maildir / 'new').iterdir()) == ['1.abc:2,FS']
+    assert sorted(p.name for p in (maildir / 'cur').iterdir()) == ['2.abc:2,FS', '3.abc:2,FS']
+
+
+def test_expunge_maildir_mail_removes_deleted_mail(maildir):
+    mails = maildirclient.get_mail_from_maildir(maildir)
+    mails[0]._flags = EmailFlag.DELETED.bit
+    mails[2]._flags = EmailFlag.DELETED.bit
+    result = maildirclient.expunge_maildir_mail(mails)
+    assert result == [mails[1]]
+    assert list((maildir / 'new').iterdir()) == []
+    assert [p.name for p in (maildir / 'cur').iterdir()] == ['2.abc:2,S']
+
+
+def test_summary_loader_parses_missing_mail_in_chunks(maildir, tmp_path_factory, monkeypatch):
+    monkeypatch.setattr(maildirclient, 'PARALLEL_LOAD_THRESHOLD', 2)
+    index_path = tmp_path_factory.mktemp('cache') / 'index.sqlite'
+    with maildir_index(maildir, index_path) as index:
+        missing = []
+        mails = maildirclient.get_mail_from_maildir(maildir, index, missing)
+        assert sorted(map(id, missing)) == sorted(map(id, mails))
+        assert all(m._summary is None for m in mails)
+        done = []
+        callbacks = []
+        executor = ThreadPoolExecutor(max_workers=1)
+        loader = maildirclient.SummaryLoader(executor, callbacks.append, index, lambda: done.append(True), chunk_size=2)
+        loader.load(missing)
+        executor.shutdown(wait=True)
+        for callback in callbacks:
+            callback()
+        assert done == [True]
+        assert [m._summary[2] for m in mails] == ['Message 2', 'Message 1', 'Message 0']
+    with maildir_index(maildir, index_path) as index:
+        missing = []
+        maildirclient.get_mail_from_maildir(maildir, index, missing)
+        assert missing == []
+
+
+def test_read_maildir_summaries_skips_missing_files(maildir):
+    paths = [str(maildir / 'cur' / '2.abc:2,S'), str(maildir / 'cur' / 'gone:2,')]
+    [(path, size, mtime, summary)] = maildirclient.read_maildir_summaries(paths)
+    assert path == paths[0]
+    assert (size, mtime) == (os.path.getsize(path), 1001)
+    assert summary[:3] == ('Bob <bob@example.com>', 'alice@example.com', 'Message 1')
@@ -0,0 +1,37 @@
+from pynemail.ui.marks import Marks
+
+from conftest import FakeEmail
+
+
+MAILS = [FakeEmail({'From': sender, 'Subject': subject}) for sender, subject in [
+    ('Alice <alice@example.com>', 'Lunch?'),
+    ('Bob <bob@example.com>', 'Re: Lunch?'),
+    ('"Alice A." <Alice@Example.com>', 'Minutes'),
+    ('Carol <carol@example.com>', 'FW: RE: lunch?'),
+]]
+
+
+def test_marks_toggle_and_retain():
+    marks = Marks()
+    marks.toggle(MAILS[1])
+    marks.toggle(MAILS[2])
+    marks.toggle(MAILS[1])
+    assert marks.emails() == [MAILS[2]]
+    marks.retain(MAILS[:2])
+    assert len(marks) == 0
+
+
+def test_marks_same_sender():
+    marks = Marks()
+    preloaded = []
+    marks.add_same_sender(MAILS, MAILS[2], preloaded.append)
+    assert marks.emails() == [MAILS[0], MAILS[2]]
+    # Every summary is loaded at once, before any of them is needed.
+    assert preloaded == [MAILS]
+
+
+def test_marks_same_subject():
+    marks = Marks()
+    marks.add_same_subject(MAILS, MAILS[0])
+    assert marks.emails() == [MAILS[0], MAILS[1], MAILS[3]]
+    assert MAILS[2] not in marks
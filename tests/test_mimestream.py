@@ -0,0 +1,80 @@
+from email.message import EmailMessage
+from email.policy import default
+
+import pytest
+
+from pynemail import mimestream
+
+
+def plain():
+    message = EmailMessage()
+    message.set_content('Just text\n')
+    return message
+
+
+def alternative_with_attachment():
+    message = EmailMessage()
+    message.set_content('Café au lait\n', cte='quoted-printable')
+    message.add_alternative('<p>Café</p>', subtype='html')
+    message.add_attachment(b'\0' * 10000, maintype='application', subtype='octet-stream', filename='big.bin')
+    return message
+
+
+def html_only():
+    message = EmailMessage()
+    message.add_alternative('<p>Only HTML</p>', subtype='html')
+    return message
+
+
+def text_attachment_only():
+    message = EmailMessage()
+    message.add_attachment('Not the body\n', filename='notes.txt')
+    return message
+
+
+@pytest.mark.parametrize("make_message", [plain, alternative_with_attachment, html_only, text_attachment_only])
+@pytest.mark.parametrize("linesep", ['\n', '\r\n'])
+def test_extract_body_matches_get_body(make_message, linesep):
+    data = make_message().as_bytes(policy=default.clone(linesep=linesep))
+    expected = EmailMessage.get_body(mimestream._parser.parsebytes(data), preferencelist=('plain', ))
+    expected = None if expected is None else expected.get_content()
+    assert mimestream.extract_body(data) == expected
+
+
+def test_text_part_span_excludes_the_attachment():
+    data = alternative_with_attachment().as_bytes()
+    start, end = mimestream.find_text_part(data)
+    assert end - start < 200
+    assert b'big.bin' not in data[start:end]
+
+
+@pytest.mark.parametrize("body, boundary, parts", [
+    (b'preamble\n--b\nA\n--b\n\nB\n--b--\nepilogue', 'b', [b'A', b'\nB']),
+    (b'--b\r\nA\r\n--bc\r\n--b\r\n--b\r\nC', 'b', [b'A\r\n--bc', b'C']),
+])
+def test_split_multipart(body, boundary, parts):
+    assert [body[s:e] for s, e in mimestream.split_multipart(body, 0, len(body), boundary)] == parts
+
+
+def test_extract_body_from_file_uses_an_mmap(tmp_path):
+    path = tmp_path / 'message'
+    path.write_bytes(alternative_with_attachment().as_bytes())
+    with path.open('rb') as fp:
+        assert mimestream.extract_body_from_file(fp) == 'Café au lait\n'
+    path.write_bytes(b'')
+    with path.open('rb') as fp:
+        assert mimestream.extract_body_from_file(fp) == ''
+
+
+@pytest.mark.parametrize("data, size, complete, preview", [
+    (plain().as_bytes(), 2048, True, 'Just text\n'),
+    (b'Subject: a\n\none\ntwo\nthree\n', 9, True, 'one\ntwo'),
+    (b'Subject: a\n\none\ntwo\nthr', 100, False, 'one\ntwo'),
+    (alternative_with_attachment().as_bytes(), 2048, True, 'Café au lait\n'),
+    (alternative_with_attachment().as_bytes()[:200], 2048, False, None),
+    (html_only().as_bytes(), 2048, True, None),
+    # Base64 is cut at a line break, but that can still be part way through a character.
+    (b'Content-Transfer-Encoding: base64\n\nQULi\ngqwK\n', 5, True, 'AB'),
+])
+def test_extract_preview(data, size, complete, preview):
+    assert mimestream.extract_preview(data, size, complete) == preview
@@ -0,0 +1,38 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from pynemail.email import Email, EmailFlag
+from pynemail.prefetch import Prefetcher
+
+
+def test_prefetcher_loads_the_neighbours_of_the_selection_without_marking_them_read(make_emails):
+    mails = make_emails(10)
+    callbacks = []
+    fetched = []
+    executor = ThreadPoolExecutor(max_workers=1)
+    prefetcher = Prefetcher(executor, lambda e: fetched.append(e.key) or e.load_body(), callbacks.append, radius=2)
+    prefetcher.update(mails, 5)
+    executor.shutdown(wait=True)
+    for callback in callbacks:
+        callback()
+    assert fetched[0] == 5
+    assert sorted(fetched) == [3, 4, 5, 6, 7]
+    assert [m.has_body() for m in mails] == [False] * 3 + [True] * 5 + [False] * 2
+    assert all(m.unread() for m in mails)
+    assert mails[4].body() == 'Body 4\n'
+    assert mails[4].flags() == [EmailFlag.SEEN]
+
+
+def test_prefetcher_can_load_previews_instead(make_emails):
+    mails = make_emails(5)
+    callbacks = []
+    executor = ThreadPoolExecutor(max_workers=1)
+    prefetcher = Prefetcher(executor, lambda e: e.load_preview(), callbacks.append, 1, Email.has_preview,
+                            Email.set_preview)
+    prefetcher.update(mails, 0)
+    executor.shutdown(wait=True)
+    for callback in callbacks:
+        callback()
+    assert [m.has_preview() for m in mails] == [True, True, False, False, False]
+    assert not any(m.has_body() for m in mails)
+    assert mails[1].preview() == 'Body 1\n'
+    assert all(m.unread() for m in mails)
@@ -0,0 +1,100 @@
+import pytest
+
+from conftest import FakeEmail
+from pynemail.search import MailSearch, SearchIndex, SearchIndexer, build_query
+
+
+def make_mails():
+    return [
+        FakeEmail({'From': 'Bob <bob@example.com>', 'Subject': 'Lunch?'}, 'Shall we go to the usual place', 'a'),
+        FakeEmail({'From': 'Alice <alice@example.com>', 'Subject': 'Re: Lunch?'}, 'Yes, at noon', 'b'),
+        FakeEmail({'From': 'Carol <carol@example.com>', 'Subject': 'Minutes'}, 'Bob said lunch was too long', 'c'),
+    ]
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = SearchIndex(tmp_path / 'search.sqlite')
+    yield index
+    index.close()
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('', None),
+    ('  ', None),
+    ('bob', '"bob"*'),
+    ('bob ', '"bob"'),
+    ('bob lun', '"bob" "lun"*'),
+    ('"bob" OR', '"bob" "OR"*'),
+])
+def test_build_query(text, expected):
+    assert build_query(text) == expected
+
+
+def test_search_index_matches_every_word(index):
+    index.add('a', 'bob@example.com', 'Lunch?')
+    index.add('b', 'alice@example.com', 'Dinner', 'Bob is coming too')
+    assert index.search('bob') == {'a', 'b'}
+    assert index.search('bob lun') == {'a'}
+    assert index.search('bob ') == {'a', 'b'}
+    assert index.search('coming') == {'b'}
+    assert index.search('') == set()
+    assert index.documents() == {'a': False, 'b': True}
+
+
+def test_search_index_set_body_and_remove(index):
+    index.add('a', 'bob@example.com', 'Lunch?')
+    index.set_body('a', 'sandwiches')
+    index.set_body('missing', 'ignored')
+    assert index.search('sandwich') == {'a'}
+    assert index.documents() == {'a': True}
+    index.remove(['a', 'missing'])
+    assert index.search('sandwich') == set()
+    assert index.documents() == {}
+
+
+def test_search_index_persists(tmp_path):
+    index = SearchIndex(tmp_path / 'search.sqlite')
+    index.add('a', 'bob@example.com', 'Lunch?', 'sandwiches')
+    index.close()
+    index = SearchIndex(tmp_path / 'search.sqlite')
+    assert index.search('sandwiches') == {'a'}
+    index.close()
+
+
+def test_search_indexer_sync(tmp_path, index):
+    mails = make_mails()
+    loaded = []
+    indexer = SearchIndexer(tmp_path / 'search.sqlite', lambda m: m.key, lambda m: loaded.append(m) or m.body_text)
+    indexer.sync(index, mails)
+    assert index.documents() == {'a': True, 'b': True, 'c': True}
+    assert index.search('noon') == {'b'}
+    indexer.sync(index, mails[1:])
+    assert index.documents() == {'b': True, 'c': True}
+    assert len(loaded) == 3
+
+
+class GoneEmail(FakeEmail):
+
+    def summary(self):
+        raise FileNotFoundError('Renamed by another client')
+
+
+def test_search_indexer_skips_emails_that_have_gone(tmp_path, index):
+    mails = make_mails()
+    mails.insert(1, GoneEmail(key='gone'))
+    indexer = SearchIndexer(tmp_path / 'search.sqlite', lambda m: m.key, lambda m: m.body_text)
+    indexer.sync(index, mails)
+    assert index.documents() == {'a': True, 'b': True, 'c': True}
+
+
+def test_mail_search_filter_keeps_order(index):
+    mails = make_mails()
+    for mail in mails:
+        index.add(mail.key, mail.summary()['From'], mail.subject(), mail.body_text)
+    search = MailSearch(index, lambda m: m.key)
+    search.start(mails)
+    assert search.filter('') == mails
+    assert search.filter('lunch') == mails
+    assert search.filter('bob lunch') == [mails[0], mails[2]]
+    assert search.filter('nothing') == []
@@ -0,0 +1,74 @@
+import io
+import json
+
+import pytest
+
+from pynemail.stats import Histogram, Stats
+
+
+@pytest.mark.parametrize('times, percent, expected', [
+    ([], 50, 0.0),
+    ([0.001], 50, 0.001),
+    ([0.001, 0.002, 0.003, 0.1], 50, 0.002048),
+    ([0.001, 0.002, 0.003, 0.1], 95, 0.1),
+    ([0.0000001] * 10, 99, 0.0000001),
+    ([100.0], 50, 100.0),
+])
+def test_histogram_percentile(times, percent, expected):
+    histogram = Histogram()
+    for seconds in times:
+        histogram.add(seconds)
+    assert histogram.percentile(percent) == pytest.approx(expected)
+    assert histogram.count == len(times)
+
+
+def test_timed_does_nothing_until_enabled():
+    stats = Stats()
+    calls = []
+
+    @stats.timed('op')
+    def op(value):
+        calls.append(value)
+        return value * 2
+
+    assert op(1) == 2
+    with stats.timer('block'):
+        pass
+    assert stats.summary() == []
+    stats.enable()
+    assert op(2) == 4
+    with stats.timer('block'):
+        pass
+    assert [(name, h.count) for name, h in stats.summary()] == [('block', 1), ('op', 1)]
+    # Disabling it stops recording, but keeps what's been recorded.
+    stats.disable()
+    assert op(3) == 6
+    assert [(name, h.count) for name, h in stats.summary()] == [('block', 1), ('op', 1)]
+    assert calls == [1, 2, 3]
+
+
+def test_timed_records_failures():
+    stats = Stats()
+    stats.enable()
+
+    @stats.timed('op')
+    def op():
+        raise ValueError()
+
+    with pytest.raises(ValueError):
+        op()
+    assert stats.histograms['op'].count == 1
+
+
+def test_trace_is_chrome_trace_events():
+    trace = io.StringIO()
+    trace.close = lambda: None
+    stats = Stats()
+    stats.enable(trace)
+    stats.record('imap.fetch', stats._epoch + 0.5, 0.25)
+    stats.close()
+    events = json.loads(trace.getvalue().rstrip(',\n') + ']')
+    assert len(events) == 1
+    assert events[0]['name'] == 'imap.fetch'
+    assert (events[0]['ph'], events[0]['ts'], events[0]['dur']) == ('X', 500000.0, 250000.0)
+    assert not stats.enabled
@@ -0,0 +1,79 @@
+from conftest import thread_email
+from pynemail.threads import Container, ThreadIndex, flatten_thread
+
+
+def layout(index, mails):
+    order = {id(m): i for i, m in enumerate(mails)}
+    return [[(m.message_id(), depth) for m, depth in flatten_thread(root, order)] for root in index.threads(mails)]
+
+
+def test_container_set_parent_moves_it_between_parents_in_order():
+    old, new = Container(), Container()
+    children = [Container() for _ in range(3)]
+    for child in children:
+        child.set_parent(old)
+    children[1].set_parent(new)
+    children[1].set_parent(new)
+    assert list(old.children.values()) == [children[0], children[2]]
+    assert list(new.children.values()) == [children[1]]
+    children[1].set_parent(None)
+    assert not new.children and children[1].parent is None
+
+
+def test_thread_index_builds_threads_in_list_order():
+    a = thread_email('a')
+    b = thread_email('b', '<a>')
+    c = thread_email('c', '<a> <b>')
+    d = thread_email('d', '<a>')
+    e = thread_email('e')
+    mails = [d, e, c, b, a]  # Newest first.
+    assert layout(ThreadIndex(), mails) == [
+        [('a', 0), ('b', 1), ('c', 2), ('d', 1)],
+        [('e', 0)],
+    ]
+
+
+def test_thread_index_is_incremental_and_order_independent():
+    index = ThreadIndex()
+    c = thread_email('c', '<a> <b>')
+    d = thread_email('d', '<missing> <c>')
+    index.update([c])
+    assert layout(index, [c]) == [[('c', 0)]]
+    # The parent arrives after its reply, and fills in the placeholder made for it.
+    b = thread_email('b', '<a>')
+    index.update([c, b])
+    assert layout(index, [c, b]) == [[('b', 0), ('c', 1)]]
+    assert len(index) == 2
+    index.update([d, c])
+    assert layout(index, [d, c]) == [[('c', 0), ('d', 1)]]
+
+
+def test_thread_index_ignores_loops_and_duplicates():
+    a = thread_email('a', '<b>')
+    b = thread_email('b', '<a>')
+    assert layout(ThreadIndex(), [b, a]) == [[('a', 0), ('b', 1)]]
+    dup = thread_email('a')
+    reply = thread_email('r', '<a>')
+    assert layout(ThreadIndex(), [reply, dup, a]) == [[('a', 0), ('r', 1)], [('a', 0)]]
+
+
+def test_thread_index_remove_keeps_replies_together():
+    a = thread_email('a')
+    b = thread_email('b', '<a>')
+    c = thread_email('c', '<a>')
+    index = ThreadIndex()
+    index.update([c, b, a])
+    index.update([c, b])
+    assert layout(index, [c, b]) == [[('b', 0), ('c', 0)]]
+    index.update([])
+    assert len(index) == 0
+    assert layout(index, [a]) == [[('a', 0)]]
+
+
+def test_flatten_thread_skips_unlisted_emails():
+    a = thread_email('a')
+    b = thread_email('b', '<a>')
+    c = thread_email('c', '<a> <b>')
+    index = ThreadIndex()
+    index.update([c, b, a])
+    assert layout(index, [c, a]) == [[('a', 0), ('c', 1)]]
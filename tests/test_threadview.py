@@ -0,0 +1,24 @@
+from conftest import thread_email
+from pynemail.threads import ThreadIndex
+from pynemail.ui.threadview import ThreadLayout
+
+
+def test_thread_layout_expands_and_collapses_threads():
+    a, b, c, d = thread_email('a'), thread_email('b', '<a>'), thread_email('c'), thread_email('d', '<a> <b>')
+    mails = [d, c, b, a]
+    expanded = set()
+    layout = ThreadLayout(ThreadIndex().threads(mails), mails, expanded)
+    assert layout.emails == [d, c]
+    assert layout.is_collapsed(0) and not layout.is_collapsed(1)
+    assert layout.depth(0) == 0
+    assert layout.thread(0) == [a, b, d]
+    assert layout.find(d) == 0
+    assert layout.set_expanded(0, True) == 0
+    assert layout.emails == [a, b, d, c]
+    assert [layout.depth(row) for row in range(4)] == [0, 1, 2, 0]
+    assert layout.find(d) == 2
+    assert layout.find(thread_email('x')) is None
+    # The expanded threads survive a new layout, e.g. when new mail arrives.
+    assert ThreadLayout(ThreadIndex().threads(mails), mails, expanded).emails == [a, b, d, c]
+    assert layout.set_expanded(2, False) == 0
+    assert layout.emails == [d, c]
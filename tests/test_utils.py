@@ -34,3 +34,15 @@ def test_wrap_text_to_cols(text, cols, result):
     assert len(wrapped_text) == len(result)
     for l_exp, l_act in zip(result, wrapped_text):
         assert l_exp == l_act
+
+
+def test_wrapped_text_only_wraps_as_far_as_asked():
+    text = 'word ' * 1000 + '\n\n\tindented\n' + 'x' * 25
+    wrapped = utils.WrappedText(text, 10)
+    assert wrapped.lines(0, 2) == ['word word ', 'word word ']
+    assert len(wrapped._index) == 6
+    assert wrapped.has_line(499)
+    assert wrapped.lines(499, 503) == ['word word ', '', '    ', 'indented']
+    assert wrapped.lines(503, 600) == ['xxxxxxxxxx', 'xxxxxxxxxx', 'xxxxx']
+    assert len(wrapped) == 506
+    assert not wrapped.has_line(506)